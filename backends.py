@@ -0,0 +1,241 @@
+import asyncio
+import contextlib
+import logging
+import random
+import time
+import httpx
+import ollama
+import config
+import metrics
+from cache import LRUCache
+
+logger = logging.getLogger('evil_bot')
+
+# Spreads generations over every host in OLLAMA_HOSTS. Requests go to the healthy host with the
+# fewest requests in flight, preferring hosts that already have the model loaded. Hosts that fail
+# get ejected and are probed again with exponential backoff until /api/tags answers.
+
+class Backend:
+    def __init__(self, host):
+        self.host = host
+        # httpx keeps the connections to each host pooled for us
+        self.client = ollama.AsyncClient(host=host)
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        self.retry_at = 0.0
+        self.loaded_models = set()
+        # everything pulled on the host, from the last /api/tags probe
+        self.models = set()
+
+    def __repr__(self):
+        return f"<Backend {self.host}>"
+
+def is_retryable(error):
+    # connection problems and server side errors are worth another host, bad requests aren't
+    if isinstance(error, (ConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(error, ollama.ResponseError):
+        return error.status_code >= 500
+    return False
+
+class BackendPool:
+    def __init__(self, hosts, probe_interval, backoff, max_backoff, affinity_slack=2):
+        self.backends = [Backend(host) for host in hosts]
+        # which host each channel used last, its kv cache still has that channel's prompt in it
+        self._affinity = LRUCache(config.HISTORY_CACHE_CHANNELS)
+        self.affinity_slack = affinity_slack
+        self.probe_interval = probe_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        for backend in self.backends:
+            metrics.backend_healthy.set(1, backend.host)
+
+    def pick(self, model_name, exclude=(), affinity=None):
+        candidates = [b for b in self.backends if b.healthy and b not in exclude]
+        if not candidates:
+            # everything is down, try whichever host is closest to coming back rather than failing outright
+            candidates = sorted((b for b in self.backends if b not in exclude), key=lambda b: b.retry_at)[:1]
+        if not candidates:
+            raise ConnectionError("No Ollama hosts left to try")
+
+        warm = [b for b in candidates if model_name in b.loaded_models]
+        if warm:
+            candidates = warm
+        fewest = min(b.outstanding for b in candidates)
+        # stick with the channel's last host unless it's much busier than the others
+        previous = self._affinity.get(affinity) if affinity is not None else None
+        if previous in candidates and previous.outstanding <= fewest + self.affinity_slack:
+            return previous
+        return random.choice([b for b in candidates if b.outstanding == fewest])
+
+    def known_models(self):
+        models = set()
+        for backend in self.backends:
+            models.update(backend.models)
+        return models
+
+    def remember(self, backend, affinity):
+        if affinity is not None:
+            self._affinity.set(affinity, backend)
+
+    @contextlib.contextmanager
+    def track(self, backend):
+        backend.outstanding += 1
+        try:
+            yield
+        finally:
+            backend.outstanding -= 1
+
+    def mark_ok(self, backend, model_name=None):
+        if not backend.healthy:
+            logger.info("Ollama host %s is back", backend.host)
+        backend.healthy = True
+        backend.failures = 0
+        backend.retry_at = 0.0
+        if model_name:
+            backend.loaded_models.add(model_name)
+        metrics.backend_healthy.set(1, backend.host)
+
+    def mark_failed(self, backend, error):
+        backend.failures += 1
+        delay = min(self.backoff * 2 ** (backend.failures - 1), self.max_backoff)
+        backend.retry_at = time.monotonic() + delay
+        if backend.healthy:
+            logger.warning("Ejecting Ollama host %s: %s", backend.host, error)
+        else:
+            logger.debug("Ollama host %s still down, next probe in %ss", backend.host, delay)
+        backend.healthy = False
+        backend.loaded_models.clear()
+        metrics.backend_healthy.set(0, backend.host)
+
+    async def chat(self, model_name, messages, affinity=None, **kwargs):
+        tried = set()
+        while True:
+            backend = self.pick(model_name, tried, affinity)
+            try:
+                with self.track(backend):
+                    response = await backend.client.chat(model=model_name, messages=messages, **kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                tried.add(backend)
+                self._failed_request(backend, e, tried)
+                continue
+            self.mark_ok(backend, model_name)
+            self.remember(backend, affinity)
+            metrics.backend_requests.inc(backend.host, 'ok')
+            return response
+
+    async def embed(self, model_name, texts, **kwargs):
+        # same failover as chat, returns one vector per text
+        tried = set()
+        while True:
+            backend = self.pick(model_name, tried)
+            try:
+                with self.track(backend):
+                    response = await backend.client.embed(model=model_name, input=texts, **kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                tried.add(backend)
+                self._failed_request(backend, e, tried)
+                continue
+            self.mark_ok(backend, model_name)
+            metrics.backend_requests.inc(backend.host, 'ok')
+            return response['embeddings']
+
+    async def chat_stream(self, model_name, messages, affinity=None, **kwargs):
+        # only retries until the first chunk arrives, after that the user has already seen part of the reply
+        tried = set()
+        while True:
+            backend = self.pick(model_name, tried, affinity)
+            with self.track(backend):
+                stream = None
+                try:
+                    stream = await backend.client.chat(model=model_name, messages=messages, stream=True, **kwargs)
+                    first = await stream.__anext__()
+                except StopAsyncIteration:
+                    return
+                except Exception as e:
+                    if stream is not None:
+                        await stream.aclose()
+                    if not is_retryable(e):
+                        raise
+                    tried.add(backend)
+                    self._failed_request(backend, e, tried)
+                    continue
+
+                self.mark_ok(backend, model_name)
+                self.remember(backend, affinity)
+                metrics.backend_requests.inc(backend.host, 'ok')
+                try:
+                    yield first
+                    async for chunk in stream:
+                        yield chunk
+                finally:
+                    await stream.aclose()
+                return
+
+    async def warm_up(self, model_name, keep_alive):
+        # a chat with no messages makes ollama load the model (or reset its unload timer) without generating
+        async def load(backend):
+            start = time.perf_counter()
+            try:
+                with self.track(backend):
+                    await backend.client.chat(model=model_name, messages=[], keep_alive=keep_alive)
+            except Exception as e:
+                logger.warning("Couldn't warm up %s on %s: %s", model_name, backend.host, e)
+                if is_retryable(e):
+                    self.mark_failed(backend, e)
+                return
+            self.mark_ok(backend, model_name)
+            logger.debug("Warmed up %s on %s in %.1fs", model_name, backend.host, time.perf_counter() - start)
+
+        await asyncio.gather(*(load(b) for b in self.backends if b.healthy))
+
+    def _failed_request(self, backend, error, tried):
+        metrics.backend_requests.inc(backend.host, 'failed')
+        self.mark_failed(backend, error)
+        if len(tried) >= len(self.backends):
+            raise error
+        logger.warning("Retrying generation on another Ollama host after %s failed", backend.host)
+
+    async def probe(self, backend):
+        try:
+            tags = await asyncio.wait_for(backend.client.list(), timeout=self.probe_interval)
+        except Exception as e:
+            self.mark_failed(backend, e)
+            return False
+        self.mark_ok(backend)
+        backend.models = {m.model for m in tags.models if m.model}
+        try:
+            running = await asyncio.wait_for(backend.client.ps(), timeout=self.probe_interval)
+            backend.loaded_models = {m.model for m in running.models if m.model}
+        except Exception as e:
+            # older ollama versions don't have /api/ps, routing just won't know what's loaded
+            logger.debug("Couldn't list loaded models on %s: %s", backend.host, e)
+        return True
+
+    async def run_health_checks(self):
+        while True:
+            now = time.monotonic()
+            due = [b for b in self.backends if b.healthy or b.retry_at <= now]
+            await asyncio.gather(*(self.probe(b) for b in due))
+            await asyncio.sleep(self.probe_interval)
+
+    async def close(self):
+        for backend in self.backends:
+            # ollama doesn't expose a close so shut down the underlying httpx client ourselves. It's
+            # private, if a new version moves it the connections just close with the process
+            http_client = getattr(backend.client, '_client', None)
+            if isinstance(http_client, httpx.AsyncClient):
+                await http_client.aclose()
+
+pool = BackendPool(
+    config.OLLAMA_HOSTS,
+    config.OLLAMA_HEALTH_INTERVAL,
+    config.OLLAMA_RETRY_BACKOFF,
+    config.OLLAMA_MAX_BACKOFF,
+    config.OLLAMA_AFFINITY_SLACK
+)
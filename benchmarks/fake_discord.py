@@ -0,0 +1,138 @@
+import asyncio
+import itertools
+import time
+from datetime import datetime, timezone
+import discord
+
+# Just enough of discord.py's models to push synthetic traffic through EvilBot.on_message
+# without a gateway connection. Everything the bot sends back is recorded with timestamps.
+
+_snowflakes = itertools.count(1 << 40)
+
+def next_id():
+    return next(_snowflakes)
+
+class FakeUser:
+    def __init__(self, id, name, bot=False):
+        self.id = id
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.guild_permissions = discord.Permissions.none()
+
+    @property
+    def mention(self):
+        return f"<@{self.id}>"
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+class FakeGuild:
+    def __init__(self, id):
+        self.id = id
+
+class _Typing:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+class _ChannelMixin:
+    def typing(self):
+        return _Typing()
+
+    def history(self, limit=100, before=None):
+        # a real history() would be a REST call, count them so the benchmark can report it
+        self.history_calls += 1
+
+        async def empty():
+            if False:
+                yield None
+        return empty()
+
+    async def send(self, content=None, **kwargs):
+        return await self.recorder.bot_message(self, content, None)
+
+class FakeTextChannel(_ChannelMixin):
+    def __init__(self, id, guild, recorder):
+        self.id = id
+        self.guild = guild
+        self.recorder = recorder
+        self.history_calls = 0
+
+class FakeDMChannel(_ChannelMixin, discord.DMChannel):
+    def __init__(self, id, recipient, recorder):
+        self.id = id
+        self.recipients = [recipient]
+        self.me = None
+        self._state = None
+        self.recorder = recorder
+        self.history_calls = 0
+
+class FakeMessage:
+    def __init__(self, channel, author, content, mentions=None, reference=None, recorder=None, origin=None):
+        self.id = next_id()
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.clean_content = content
+        self.mentions = mentions or []
+        self.reference = reference
+        self.created_at = datetime.now(timezone.utc)
+        self.recorder = recorder
+        # for bot messages, the user message this is a response to
+        self.origin = origin
+
+    async def reply(self, content=None, **kwargs):
+        return await self.recorder.bot_message(self.channel, content, self)
+
+    async def edit(self, content=None, **kwargs):
+        self.content = self.clean_content = content
+        self.recorder.touch(self.origin)
+        return self
+
+    async def add_reaction(self, emoji):
+        self.recorder.reactions += 1
+
+    async def delete(self):
+        pass
+
+class Recorder:
+    # Tracks when each triggering message first got something visible back and when it was last updated
+    def __init__(self, bot_user, send_delay=0.0):
+        self.bot_user = bot_user
+        self.send_delay = send_delay
+        self.first_visible = {}
+        self.last_update = {}
+        self.reactions = 0
+        self.sends = 0
+        self.edits = 0
+        self.dispatch = None
+
+    async def bot_message(self, channel, content, origin):
+        if self.send_delay:
+            await asyncio.sleep(self.send_delay)
+        self.sends += 1
+        message = FakeMessage(channel, self.bot_user, content, recorder=self, origin=origin)
+        if origin is not None:
+            self.first_visible.setdefault(origin.id, time.perf_counter())
+            self.last_update[origin.id] = time.perf_counter()
+        # the gateway echoes our own messages back to us
+        if self.dispatch is not None:
+            asyncio.get_running_loop().create_task(self.dispatch(message))
+        return message
+
+    def touch(self, origin):
+        self.edits += 1
+        if origin is not None:
+            self.last_update[origin.id] = time.perf_counter()
+
+class Reference:
+    def __init__(self, resolved):
+        self.resolved = resolved
+        self.message_id = resolved.id
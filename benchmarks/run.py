@@ -0,0 +1,216 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+from benchmarks.stub_ollama import StubOllamaServer
+
+# Load test for the bot without discord or a real ollama:
+#   python -m benchmarks.run --guilds 200 --messages 20000 --e2e-messages 300
+# Synthetic messages go straight into EvilBot.on_message and generations hit a local stub server.
+
+FILLER = "lol did anyone see the game last night i think we should go get food after this honestly".split()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the Evil Bot message pipeline")
+    parser.add_argument('--guilds', type=int, default=100)
+    parser.add_argument('--channels', type=int, default=3, help="channels per guild")
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=20000, help="messages for the should_respond benchmark")
+    parser.add_argument('--e2e-messages', type=int, default=200, help="messages for the end to end benchmark")
+    parser.add_argument('--rate', type=float, default=50, help="end to end messages per second")
+    parser.add_argument('--dm-ratio', type=float, default=0.05)
+    parser.add_argument('--trigger-ratio', type=float, default=0.2)
+    parser.add_argument('--mention-ratio', type=float, default=0.05)
+    parser.add_argument('--tokens', type=int, default=40, help="tokens per stub response")
+    parser.add_argument('--token-delay', type=float, default=0.02, help="seconds between stub tokens")
+    parser.add_argument('--first-token-delay', type=float, default=0.1)
+    parser.add_argument('--backends', type=int, default=1, help="stub Ollama hosts to balance across")
+    parser.add_argument('--send-delay', type=float, default=0.05, help="fake discord API latency")
+    parser.add_argument('--rate-limits', action='store_true', help="keep the bot's rate limits on")
+    parser.add_argument('--memory', action='store_true', help="turn long term memory on for the end to end run")
+    parser.add_argument('--memory-entries', type=int, default=0, help="time memory searches over an index this big (needs numpy)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING')
+    return parser.parse_args()
+
+def configure_environment(args, stubs):
+    # has to happen before anything imports config
+    db_dir = tempfile.mkdtemp(prefix='evil_bot_bench_')
+    os.environ.setdefault('BOT_TOKEN', 'benchmark')
+    os.environ['DATABASE_NAME'] = os.path.join(db_dir, 'bench.db')
+    os.environ['OLLAMA_HOSTS'] = ','.join(stub.url for stub in stubs)
+    os.environ.setdefault('STREAM_EDIT_INTERVAL', '0.5')
+    os.environ['SEMANTIC_MEMORY_DIR'] = os.path.join(db_dir, 'memory')
+    if args.memory:
+        os.environ['SEMANTIC_MEMORY'] = 'True'
+    if not args.rate_limits:
+        # the traffic is synthetic, measure the pipeline rather than how much of it gets throttled
+        for name in ('USER_RATE_LIMIT', 'CHANNEL_RATE_LIMIT', 'GUILD_RATE_LIMIT', 'MAX_PENDING_RESPONSES'):
+            os.environ.setdefault(name, '0')
+
+def percentiles(samples):
+    if not samples:
+        return "n/a"
+    ordered = sorted(samples)
+    def pick(p):
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+    return f"p50 {pick(50) * 1000:.1f}ms  p95 {pick(95) * 1000:.1f}ms  p99 {pick(99) * 1000:.1f}ms  max {ordered[-1] * 1000:.1f}ms"
+
+async def monitor_loop_lag(samples, interval=0.01):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - start - interval))
+
+class Traffic:
+    def __init__(self, args, bot_user, recorder):
+        from benchmarks import fake_discord
+        self.fake = fake_discord
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.bot_user = bot_user
+        self.recorder = recorder
+        self.users = [fake_discord.FakeUser(10_000 + i, f"user{i}") for i in range(args.users)]
+        self.channels = []
+        for g in range(args.guilds):
+            guild = fake_discord.FakeGuild(1_000_000 + g)
+            for c in range(args.channels):
+                self.channels.append(fake_discord.FakeTextChannel(fake_discord.next_id(), guild, recorder))
+        self.dm_channels = {}
+        self.last_bot_message = {}
+
+    def message(self):
+        rng = self.rng
+        author = rng.choice(self.users)
+        words = rng.sample(FILLER, rng.randint(3, 10))
+        if rng.random() < self.args.dm_ratio:
+            channel = self.dm_channels.get(author.id)
+            if channel is None:
+                channel = self.fake.FakeDMChannel(self.fake.next_id(), author, self.recorder)
+                self.dm_channels[author.id] = channel
+            return self.fake.FakeMessage(channel, author, ' '.join(words), recorder=self.recorder)
+
+        channel = rng.choice(self.channels)
+        mentions = []
+        if rng.random() < self.args.trigger_ratio:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(['evil bot', 'good bot', 'evil']))
+        if rng.random() < self.args.mention_ratio:
+            mentions.append(self.bot_user)
+            words.insert(0, self.bot_user.mention)
+        return self.fake.FakeMessage(channel, author, ' '.join(words), mentions=mentions, recorder=self.recorder)
+
+async def bench_decisions(traffic, count):
+    import decision
+    messages = [traffic.message() for _ in range(count)]
+    results = {}
+    for label in ('cold', 'warm'):
+        responded = 0
+        start = time.perf_counter()
+        for message in messages:
+            reason, _ = await decision.should_respond(message)
+            if reason in decision.RESPOND_REASONS:
+                responded += 1
+        elapsed = time.perf_counter() - start
+        results[label] = (count / elapsed, responded)
+    return results
+
+async def bench_end_to_end(bot, traffic, count, rate):
+    lag = []
+    monitor = asyncio.get_running_loop().create_task(monitor_loop_lag(lag))
+    started = {}
+    tasks = []
+    for _ in range(count):
+        message = traffic.message()
+        started[message.id] = time.perf_counter()
+        tasks.append(asyncio.get_running_loop().create_task(bot.on_message(message)))
+        await asyncio.sleep(1 / rate)
+    await asyncio.gather(*tasks, return_exceptions=True)
+    monitor.cancel()
+
+    recorder = traffic.recorder
+    first = [recorder.first_visible[i] - started[i] for i in started if i in recorder.first_visible]
+    total = [recorder.last_update[i] - started[i] for i in started if i in recorder.last_update]
+    return first, total, lag
+
+def bench_memory_search(entries, dimensions=768, searches=100):
+    # queries are stored vectors with noise on top, like asking about something that came up before
+    import numpy as np
+    from memory import GuildIndex
+    rng = np.random.default_rng(1)
+    index = GuildIndex(os.path.join(tempfile.mkdtemp(prefix='evil_bot_memory_'), 'guild'), entries)
+    for start in range(0, entries, 10_000):
+        size = min(10_000, entries - start)
+        index.add(np.arange(start, start + size), rng.standard_normal((size, dimensions), dtype=np.float32))
+
+    timings = []
+    found = 0
+    for turn_id in rng.integers(0, entries, searches):
+        query = index.vectors[turn_id] + rng.standard_normal(dimensions, dtype=np.float32) * 0.03
+        query /= np.linalg.norm(query)
+        start = time.perf_counter()
+        results = index.search(query, 3)
+        timings.append(time.perf_counter() - start)
+        found += any(result == turn_id for result, _ in results)
+    return timings, found / searches
+
+async def main(args):
+    stubs = [
+        StubOllamaServer(tokens=args.tokens, token_delay=args.token_delay, first_token_delay=args.first_token_delay).start()
+        for _ in range(max(1, args.backends))
+    ]
+    configure_environment(args, stubs)
+
+    import config
+    import backends
+    import database
+    from bot import EvilBot
+    from benchmarks import fake_discord
+
+    logger = logging.getLogger('evil_bot')
+    logger.setLevel(args.log_level)
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    bot = EvilBot()
+    bot_user = fake_discord.FakeUser(1, config.BOT_NAME, bot=True)
+    bot._connection.user = bot_user
+    recorder = fake_discord.Recorder(bot_user, send_delay=args.send_delay)
+    recorder.dispatch = bot.on_message
+    await database.init_db_async()
+
+    traffic = Traffic(args, bot_user, recorder)
+    print(f"Stub Ollama at {', '.join(stub.url for stub in stubs)}, {args.guilds} guilds x {args.channels} channels, {args.users} users")
+
+    decisions = await bench_decisions(traffic, args.messages)
+    for label, (per_second, responded) in decisions.items():
+        print(f"should_respond ({label}): {per_second:,.0f} msgs/sec, {responded} of {args.messages} would respond")
+
+    first, total, lag = await bench_end_to_end(bot, traffic, args.e2e_messages, args.rate)
+    history_calls = sum(c.history_calls for c in traffic.channels) + sum(c.history_calls for c in traffic.dm_channels.values())
+    print(f"end to end: {len(total)} responses to {args.e2e_messages} messages, {sum(stub.requests for stub in stubs)} generations")
+    print(f"  first visible reply: {percentiles(first)}")
+    print(f"  complete reply:      {percentiles(total)}")
+    print(f"  event loop lag:      {percentiles(lag)}  mean {statistics.fmean(lag) * 1000 if lag else 0:.2f}ms")
+    print(f"  discord sends {recorder.sends}, edits {recorder.edits}, reactions {recorder.reactions}, history() calls {history_calls}")
+
+    if args.memory:
+        from memory import semantic_memory
+        await semantic_memory.flush()
+        print(f"  memory: {sum(stub.embeddings for stub in stubs)} texts embedded")
+
+    if args.memory_entries:
+        timings, found = bench_memory_search(args.memory_entries)
+        print(f"memory search ({args.memory_entries:,} entries): {percentiles(timings)}, found the original in {found:.0%}")
+
+    await backends.pool.close()
+    await database.close_async()
+    for stub in stubs:
+        stub.shutdown()
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
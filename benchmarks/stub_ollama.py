@@ -0,0 +1,139 @@
+import hashlib
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# A tiny stand-in for ollama's HTTP API so the bot can be benchmarked without a GPU box.
+# It speaks just enough of /api/chat (streaming and not), /api/embed, /api/tags and /api/ps for the ollama client.
+
+WORDS = "mwahaha the darkness grows stronger with every message you send to me mortal".split()
+EMBEDDING_SIZE = 768
+
+def embed(text):
+    # hashed bag of words, texts sharing words end up pointing the same way like real embeddings would
+    vector = [0.0] * EMBEDDING_SIZE
+    for word in text.lower().split():
+        digest = hashlib.blake2b(word.encode(), digest_size=8).digest()
+        vector[int.from_bytes(digest[:4], 'little') % EMBEDDING_SIZE] += 1.0 if digest[4] & 1 else -1.0
+    return vector
+
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/api/tags':
+            self._send_json({'models': [{'name': model, 'model': model} for model in self.server.models]})
+        elif self.path == '/api/ps':
+            # pretend everything is loaded
+            self._send_json({'models': [{'name': model, 'model': model} for model in self.server.models]})
+        else:
+            self._send_json({'error': 'not found'}, status=404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path == '/api/chat':
+            self._chat(body)
+        elif self.path == '/api/embed':
+            texts = body.get('input', '')
+            texts = [texts] if isinstance(texts, str) else texts
+            self.server.embeddings += len(texts)
+            self._send_json({'model': body.get('model', ''), 'embeddings': [embed(text) for text in texts]})
+        else:
+            self._send_json({'error': 'not found'}, status=404)
+
+    def _chat(self, body):
+        server = self.server
+        server.requests += 1
+        model = body.get('model', '')
+        prompt_tokens = sum(len(m.get('content', '').split()) for m in body.get('messages', []))
+        time.sleep(server.first_token_delay)
+
+        if not body.get('stream', True):
+            time.sleep(server.token_delay * server.tokens)
+            content = ' '.join(WORDS[i % len(WORDS)] for i in range(server.tokens))
+            self._send_json(self._chunk(model, content, True, prompt_tokens))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for i in range(server.tokens):
+                self._write_chunk(self._chunk(model, WORDS[i % len(WORDS)] + ' ', False))
+                time.sleep(server.token_delay)
+            self._write_chunk(self._chunk(model, '', True, prompt_tokens))
+            self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client hung up on us, which is what cancelling a generation looks like
+            server.cancelled += 1
+
+    def _chunk(self, model, content, done, prompt_tokens=0):
+        chunk = {
+            'model': model,
+            'created_at': '2024-01-01T00:00:00Z',
+            'message': {'role': 'assistant', 'content': content},
+            'done': done
+        }
+        if done:
+            chunk.update({
+                'done_reason': 'stop',
+                'prompt_eval_count': prompt_tokens,
+                'prompt_eval_duration': prompt_tokens * 1000000,
+                'eval_count': self.server.tokens,
+                'eval_duration': int(self.server.tokens * self.server.token_delay * 1e9)
+            })
+        return chunk
+
+    def _write_chunk(self, data):
+        line = json.dumps(data).encode() + b'\n'
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+        self.wfile.flush()
+
+    def _send_json(self, data, status=200):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+class StubOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, tokens=40, token_delay=0.02, first_token_delay=0.1, models=('dolphin-mixtral:8x7b',)):
+        super().__init__((host, port), StubOllamaHandler)
+        self.tokens = tokens
+        self.token_delay = token_delay
+        self.first_token_delay = first_token_delay
+        self.models = list(models)
+        self.requests = 0
+        self.cancelled = 0
+        self.embeddings = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='stub_ollama', daemon=True)
+        thread.start()
+        return self
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run a stub Ollama server")
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--tokens', type=int, default=40)
+    parser.add_argument('--token-delay', type=float, default=0.02)
+    parser.add_argument('--first-token-delay', type=float, default=0.1)
+    args = parser.parse_args()
+    server = StubOllamaServer(port=args.port, tokens=args.tokens, token_delay=args.token_delay, first_token_delay=args.first_token_delay)
+    print(f"Stub Ollama listening on {server.url}")
+    server.serve_forever()
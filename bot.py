@@ -1,10 +1,21 @@
 import discord
 from discord.ext import commands
 import asyncio
+import time
 import config
 import database
 import utils
+import backends
+import prompt
+import ratelimit
+import decision
+import metrics
+import log
 import logging
+from history import channel_history
+from memory import semantic_memory
+from response_cache import response_cache
+from scheduler import scheduler, QueueFullError
 
 logger = logging.getLogger('evil_bot')
 
@@ -29,7 +40,7 @@ class CustomHelpCommand(commands.DefaultHelpCommand):
         await self.get_destination().send(embed=em)
 
     async def send_command_help(self, command):
-        logger.debug(f"Generating help for command: {command.name}")
+        logger.debug("Generating help for command: %s", command.name)
         em = discord.Embed(
             title=self.get_command_signature(command),
             description=command.help or "No detailed help available",
@@ -37,22 +48,136 @@ class CustomHelpCommand(commands.DefaultHelpCommand):
         )
         await self.get_destination().send(embed=em)
 
-class EvilBot(commands.Bot):
-    def __init__(self):
+# AutoShardedBot runs every shard it's given on this one event loop. With no shard settings it asks
+# discord how many it needs, so a small bot still just runs one
+class EvilBot(commands.AutoShardedBot):
+    def __init__(self, shard_count=None, shard_ids=None):
         logger.info("Initializing EvilBot")
         intents = discord.Intents.default()
         intents.message_content = True
         super().__init__(
             command_prefix=config.COMMAND_PREFIX, 
             intents=intents,
-            help_command=CustomHelpCommand()
+            help_command=CustomHelpCommand(),
+            shard_count=shard_count or config.SHARD_COUNT,
+            shard_ids=shard_ids or config.SHARD_IDS
         )
+        self.metrics_server = None
+        self.background_tasks = set()
+        self.warmed_up = False
         self.setup_commands()
         logger.info("EvilBot initialization complete")
 
+    async def setup_hook(self):
+        # runs once before any shard connects. With several shards on_message can come before on_ready,
+        # and on_ready fires again on every reconnect, so the schema has to be ready here
+        await database.init_db_async()
+        if config.METRICS_PORT:
+            self.metrics_server = metrics.MetricsServer(config.METRICS_HOST, config.METRICS_PORT)
+            await self.metrics_server.start()
+        self.spawn(backends.pool.run_health_checks())
+        if config.RESPONSE_CACHE_PERSIST:
+            self.spawn(response_cache.prune_periodically())
+        if semantic_memory.enabled:
+            self.spawn(semantic_memory.run())
+        elif config.SEMANTIC_MEMORY:
+            logger.warning("SEMANTIC_MEMORY needs numpy installed and CONVERSATION_MEMORY on, long term memory is off")
+
     async def on_ready(self):
-        logger.info(f"{config.BOT_NAME} has risen! Logged in as {self.user}")
-        database.init_db()
+        logger.info("%s has risen! Logged in as %s", config.BOT_NAME, self.user)
+        self.report_shards()
+        # on_ready fires again after every reconnect, only warm up the first time
+        if not self.warmed_up:
+            self.warmed_up = True
+            if config.SETTINGS_SYNC_INTERVAL > 0:
+                self.spawn(self.sync_settings())
+            if config.WARMUP_ON_START:
+                self.spawn(self.warm_up_models())
+            if config.KEEP_WARM_INTERVAL > 0:
+                self.spawn(self.keep_models_warm())
+            if config.CONVERSATION_MEMORY and config.CONVERSATION_RETENTION > 0:
+                self.spawn(self.prune_conversations())
+
+    async def on_shard_ready(self, shard_id):
+        logger.info("Shard %s ready, latency %.0fms", shard_id, self.get_shard(shard_id).latency * 1000)
+
+    async def on_shard_disconnect(self, shard_id):
+        logger.warning("Shard %s disconnected", shard_id)
+
+    def shard_stats(self):
+        guilds = {}
+        for guild in self.guilds:
+            guilds[guild.shard_id] = guilds.get(guild.shard_id, 0) + 1
+        return [
+            {
+                'id': shard_id,
+                'latency': shard.latency,
+                'closed': shard.is_closed(),
+                'guilds': guilds.get(shard_id, 0)
+            }
+            for shard_id, shard in sorted(self.shards.items())
+        ]
+
+    def report_shards(self):
+        for shard in self.shard_stats():
+            logger.info(
+                "Shard %s/%s: %s, %.0fms, %s guilds",
+                shard['id'], self.shard_count, "down" if shard['closed'] else "up", shard['latency'] * 1000, shard['guilds']
+            )
+
+    async def sync_settings(self):
+        # other shard processes can change settings under us, drop whatever they touched from our cache
+        last_prune = time.monotonic()
+        while True:
+            await asyncio.sleep(config.SETTINGS_SYNC_INTERVAL)
+            changed = await database.poll_settings_changes_async()
+            if changed:
+                logger.debug("Picked up %s settings changes from other processes", changed)
+            if time.monotonic() - last_prune > 3600:
+                last_prune = time.monotonic()
+                await database.prune_settings_changes_async(time.time() - 3600)
+
+    async def prune_conversations(self):
+        while True:
+            removed = await database.prune_conversation_turns_async(time.time() - config.CONVERSATION_RETENTION)
+            if removed:
+                logger.info("Pruned %s old conversation turns", removed)
+            await asyncio.sleep(3600)
+
+    async def models_to_warm(self):
+        models = {config.MODEL_NAME}
+        models.update(await database.get_guild_models_async())
+        return models
+
+    async def warm_up_models(self):
+        for model_name in await self.models_to_warm():
+            logger.info("Warming up model %s", model_name)
+            await backends.pool.warm_up(model_name, config.OLLAMA_KEEP_ALIVE)
+
+    async def keep_models_warm(self):
+        while True:
+            await asyncio.sleep(config.KEEP_WARM_INTERVAL)
+            if utils.in_active_hours(config.KEEP_WARM_HOURS):
+                logger.debug("Pinging models to keep them loaded")
+                await self.warm_up_models()
+
+    def spawn(self, coro):
+        # keep a reference so the task isn't garbage collected, and so close() can cancel it
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
+
+    async def close(self):
+        logger.info("%s is shutting down", config.BOT_NAME)
+        for task in list(self.background_tasks):
+            task.cancel()
+        await super().close()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        await semantic_memory.close()
+        await backends.pool.close()
+        await database.close_async()
 
     def setup_commands(self):
         logger.info("Setting up bot commands")
@@ -63,7 +188,7 @@ class EvilBot(commands.Bot):
             help="Set a new system prompt to change my personality\n\nExample:\n!set You are Evil Bot, an AI assistant with evil tendencies"
         )
         async def set_prompt(ctx, *, prompt=None):
-            logger.debug(f"Set command called by {ctx.author.id}")
+            logger.debug("Set command called by %s", ctx.author.id)
             # Handle no prompt case
             if not prompt:
                 logger.debug("No prompt provided, sending help message")
@@ -76,15 +201,15 @@ class EvilBot(commands.Bot):
 
             success = False
             if isinstance(ctx.channel, discord.DMChannel):
-                logger.debug(f"Setting DM prompt for user {ctx.author.id}")
-                success = database.set_dm_prompt(ctx.author.id, prompt)
+                logger.debug("Setting DM prompt for user %s", ctx.author.id)
+                success = await database.set_dm_prompt_async(ctx.author.id, prompt)
             else:
-                logger.debug(f"Attempting to set server prompt for {ctx.guild.id}")
+                logger.debug("Attempting to set server prompt for %s", ctx.guild.id)
                 if not ctx.author.guild_permissions.administrator:
-                    logger.warning(f"Permission denied for user {ctx.author.id}")
+                    logger.warning("Permission denied for user %s", ctx.author.id)
                     await ctx.send(embed=utils.no_permission_embed())
                     return
-                success = database.set_server_prompt(ctx.guild.id, prompt)
+                success = await database.set_server_prompt_async(ctx.guild.id, prompt)
 
             if success:
                 logger.info("Prompt updated successfully")
@@ -106,15 +231,15 @@ class EvilBot(commands.Bot):
             help="Display my current personality settings\n\nExample:\n!get"
         )
         async def get_prompt(ctx):
-            logger.debug(f"Get command called by {ctx.author.id}")
+            logger.debug("Get command called by %s", ctx.author.id)
             try:
                 prompt = None
                 if isinstance(ctx.channel, discord.DMChannel):
-                    logger.debug(f"Getting DM prompt for user {ctx.author.id}")
-                    prompt = database.get_dm_prompt(ctx.author.id)
+                    logger.debug("Getting DM prompt for user %s", ctx.author.id)
+                    prompt = await database.get_dm_prompt_async(ctx.author.id)
                 else:
-                    logger.debug(f"Getting server prompt for {ctx.guild.id}")
-                    prompt = database.get_server_prompt(ctx.guild.id)
+                    logger.debug("Getting server prompt for %s", ctx.guild.id)
+                    prompt = await database.get_server_prompt_async(ctx.guild.id)
                     
                 await ctx.send(embed=utils.create_embed(
                     "Current Prompt",
@@ -122,7 +247,7 @@ class EvilBot(commands.Bot):
                     [{'name': 'Prompt', 'value': f"```{prompt}```"}]
                 ))
             except Exception as e:
-                logger.error(f"Error getting prompt: {e}", exc_info=True)
+                logger.error("Error getting prompt: %s", e, exc_info=True)
                 await ctx.send(embed=utils.error_embed(
                     "Error",
                     "Failed to retrieve the system prompt!"
@@ -134,10 +259,10 @@ class EvilBot(commands.Bot):
             help="Reset all bot settings to their default values\n\nExample:\n!default"
         )
         async def default(ctx):
-            logger.debug(f"Default command called by {ctx.author.id}")
+            logger.debug("Default command called by %s", ctx.author.id)
             if isinstance(ctx.channel, discord.DMChannel):
-                logger.debug(f"Resetting DM settings for user {ctx.author.id}")
-                if database.set_dm_prompt(ctx.author.id, config.DEFAULT_PERSONA):
+                logger.debug("Resetting DM settings for user %s", ctx.author.id)
+                if await database.set_dm_prompt_async(ctx.author.id, config.DEFAULT_PERSONA):
                     await ctx.send(embed=utils.create_embed(
                         "Settings Reset",
                         "Your DM settings have been reset to default! 😈"
@@ -149,13 +274,13 @@ class EvilBot(commands.Bot):
                         "Failed to reset settings!"
                     ))
             else:
-                logger.debug(f"Attempting to reset server settings for {ctx.guild.id}")
+                logger.debug("Attempting to reset server settings for %s", ctx.guild.id)
                 if not ctx.author.guild_permissions.administrator:
-                    logger.warning(f"Permission denied for user {ctx.author.id}")
+                    logger.warning("Permission denied for user %s", ctx.author.id)
                     await ctx.send(embed=utils.no_permission_embed())
                     return
 
-                if database.reset_server_settings(ctx.guild.id):
+                if await database.reset_server_settings_async(ctx.guild.id):
                     logger.info("Server settings reset successfully")
                     await ctx.send(embed=utils.create_embed(
                         "Settings Reset",
@@ -174,7 +299,7 @@ class EvilBot(commands.Bot):
             help="Manage the words that make me respond\n\nExamples:\n!trigger list - Show all trigger words\n!trigger add evil overlord - Add a new trigger\n!trigger remove evil overlord - Remove a trigger"
         )
         async def trigger(ctx, action=None, *, word=None):
-            logger.debug(f"Trigger command called by {ctx.author.id} with action: {action}")
+            logger.debug("Trigger command called by %s with action: %s", ctx.author.id, action)
             if isinstance(ctx.channel, discord.DMChannel):
                 logger.debug("Trigger command used in DM, sending error")
                 await ctx.send(embed=utils.error_embed(
@@ -193,13 +318,13 @@ class EvilBot(commands.Bot):
                 return
 
             if not ctx.author.guild_permissions.administrator and action.lower() != 'list':
-                logger.warning(f"Permission denied for user {ctx.author.id}")
+                logger.warning("Permission denied for user %s", ctx.author.id)
                 await ctx.send(embed=utils.no_permission_embed())
                 return
 
-            settings = database.get_server_settings(ctx.guild.id)
+            settings = await database.get_server_settings_async(ctx.guild.id)
             if not settings:
-                logger.error(f"Failed to get settings for server {ctx.guild.id}")
+                logger.error("Failed to get settings for server %s", ctx.guild.id)
                 await ctx.send(embed=utils.error_embed("Error", "Failed to get server settings!"))
                 return
 
@@ -216,7 +341,7 @@ class EvilBot(commands.Bot):
                 ))
 
             elif action == 'add' and word:
-                logger.debug(f"Adding trigger word: {word}")
+                logger.debug("Adding trigger word: %s", word)
                 if word.lower() in [w.lower() for w in trigger_words]:
                     await ctx.send(embed=utils.error_embed(
                         "Duplicate Trigger",
@@ -224,9 +349,8 @@ class EvilBot(commands.Bot):
                     ))
                     return
 
-                trigger_words.append(word.lower())
-                if database.set_trigger_words(ctx.guild.id, trigger_words):
-                    logger.info(f"Added trigger word: {word}")
+                if await database.add_trigger_word_async(ctx.guild.id, word.lower()):
+                    logger.info("Added trigger word: %s", word)
                     await ctx.send(embed=utils.create_embed(
                         "Trigger Added",
                         f"Added new trigger word: `{word}`"
@@ -239,7 +363,7 @@ class EvilBot(commands.Bot):
                     ))
 
             elif action == 'remove' and word:
-                logger.debug(f"Removing trigger word: {word}")
+                logger.debug("Removing trigger word: %s", word)
                 word_lower = word.lower()
                 if word_lower not in [w.lower() for w in trigger_words]:
                     await ctx.send(embed=utils.error_embed(
@@ -248,9 +372,9 @@ class EvilBot(commands.Bot):
                     ))
                     return
 
-                trigger_words = [w for w in trigger_words if w.lower() != word_lower]
-                if database.set_trigger_words(ctx.guild.id, trigger_words):
-                    logger.info(f"Removed trigger word: {word}")
+                stored = next(w for w in trigger_words if w.lower() == word_lower)
+                if await database.remove_trigger_word_async(ctx.guild.id, stored):
+                    logger.info("Removed trigger word: %s", word)
                     await ctx.send(embed=utils.create_embed(
                         "Trigger Removed",
                         f"Removed trigger word: `{word}`"
@@ -276,7 +400,7 @@ class EvilBot(commands.Bot):
             help="Manage my random response settings\n\nExamples:\n!random status - Show current settings\n!random on - Enable random responses\n!random off - Disable random responses\n!random chance 20 - Set response chance to 20%"
         )
         async def random(ctx, action=None, chance: int = None):
-            logger.debug(f"Random command called by {ctx.author.id} with action: {action}")
+            logger.debug("Random command called by %s with action: %s", ctx.author.id, action)
             if isinstance(ctx.channel, discord.DMChannel):
                 logger.debug("Random command used in DM, sending error")
                 await ctx.send(embed=utils.error_embed(
@@ -286,13 +410,13 @@ class EvilBot(commands.Bot):
                 return
 
             if not ctx.author.guild_permissions.administrator and action != 'status':
-                logger.warning(f"Permission denied for user {ctx.author.id}")
+                logger.warning("Permission denied for user %s", ctx.author.id)
                 await ctx.send(embed=utils.no_permission_embed())
                 return
 
-            settings = database.get_server_settings(ctx.guild.id)
+            settings = await database.get_server_settings_async(ctx.guild.id)
             if not settings:
-                logger.error(f"Failed to get settings for server {ctx.guild.id}")
+                logger.error("Failed to get settings for server %s", ctx.guild.id)
                 await ctx.send(embed=utils.error_embed("Error", "Failed to get server settings!"))
                 return
 
@@ -311,7 +435,7 @@ class EvilBot(commands.Bot):
             action = action.lower()
             if action == 'on':
                 logger.debug("Enabling random responses")
-                if database.set_random_responses(ctx.guild.id, True):
+                if await database.set_random_responses_async(ctx.guild.id, True):
                     logger.info("Random responses enabled")
                     await ctx.send(embed=utils.create_embed("Random Responses Enabled"))
                 else:
@@ -320,7 +444,7 @@ class EvilBot(commands.Bot):
 
             elif action == 'off':
                 logger.debug("Disabling random responses")
-                if database.set_random_responses(ctx.guild.id, False):
+                if await database.set_random_responses_async(ctx.guild.id, False):
                     logger.info("Random responses disabled")
                     await ctx.send(embed=utils.create_embed("Random Responses Disabled"))
                 else:
@@ -328,7 +452,7 @@ class EvilBot(commands.Bot):
                     await ctx.send(embed=utils.error_embed("Error", "Failed to disable random responses!"))
 
             elif action == 'chance' and isinstance(chance, int):
-                logger.debug(f"Setting random chance to {chance}%")
+                logger.debug("Setting random chance to %s%%", chance)
                 if not 1 <= chance <= 100:
                     await ctx.send(embed=utils.create_help_embed(
                         "Invalid Chance",
@@ -337,8 +461,8 @@ class EvilBot(commands.Bot):
                     ))
                     return
 
-                if database.set_random_chance(ctx.guild.id, chance):
-                    logger.info(f"Random chance set to {chance}%")
+                if await database.set_random_chance_async(ctx.guild.id, chance):
+                    logger.info("Random chance set to %s%%", chance)
                     await ctx.send(embed=utils.create_embed(
                         "Random Chance Updated",
                         f"Random response chance set to {chance}%!"
@@ -355,82 +479,476 @@ class EvilBot(commands.Bot):
                     ["!random status", "!random on", "!random off", "!random chance 20"]
                 ))
 
+        @self.command(
+            name='cache',
+            brief="Control my memory for repeated questions",
+            help="Reuse my answers when the same message comes up again\n\nExamples:\n!cache status - Show current settings\n!cache on - Enable the response cache\n!cache off - Disable the response cache\n!cache interval 60 - Don't reuse an answer in this server more than once a minute"
+        )
+        async def cache(ctx, action=None, seconds: int = None):
+            logger.debug("Cache command called by %s with action: %s", ctx.author.id, action)
+            if isinstance(ctx.channel, discord.DMChannel):
+                logger.debug("Cache command used in DM, sending error")
+                await ctx.send(embed=utils.error_embed(
+                    "DM Not Supported",
+                    "The response cache can only be managed in servers!"
+                ))
+                return
+
+            if not ctx.author.guild_permissions.administrator and action != 'status':
+                logger.warning("Permission denied for user %s", ctx.author.id)
+                await ctx.send(embed=utils.no_permission_embed())
+                return
+
+            settings = await database.get_server_settings_async(ctx.guild.id)
+            if not settings:
+                logger.error("Failed to get settings for server %s", ctx.guild.id)
+                await ctx.send(embed=utils.error_embed("Error", "Failed to get server settings!"))
+                return
+
+            if not action or action.lower() == 'status':
+                logger.debug("Showing response cache status")
+                await ctx.send(embed=utils.create_embed(
+                    "Response Cache Settings",
+                    None,
+                    [
+                        {'name': 'Status', 'value': "Enabled 😈" if settings['response_cache_enabled'] else "Disabled 🌑", 'inline': True},
+                        {'name': 'Reuse Interval', 'value': f"{settings['response_cache_interval']}s", 'inline': True}
+                    ]
+                ))
+                return
+
+            action = action.lower()
+            if action == 'on':
+                logger.debug("Enabling response cache")
+                if await database.set_response_cache_async(ctx.guild.id, True):
+                    logger.info("Response cache enabled")
+                    await ctx.send(embed=utils.create_embed("Response Cache Enabled"))
+                else:
+                    logger.error("Failed to enable response cache")
+                    await ctx.send(embed=utils.error_embed("Error", "Failed to enable the response cache!"))
+
+            elif action == 'off':
+                logger.debug("Disabling response cache")
+                if await database.set_response_cache_async(ctx.guild.id, False):
+                    logger.info("Response cache disabled")
+                    await ctx.send(embed=utils.create_embed("Response Cache Disabled"))
+                else:
+                    logger.error("Failed to disable response cache")
+                    await ctx.send(embed=utils.error_embed("Error", "Failed to disable the response cache!"))
+
+            elif action == 'interval' and isinstance(seconds, int):
+                logger.debug("Setting response cache interval to %ss", seconds)
+                if seconds < 0:
+                    await ctx.send(embed=utils.create_help_embed(
+                        "Invalid Interval",
+                        "The interval can't be negative!",
+                        ["!cache interval 60"]
+                    ))
+                    return
+
+                if await database.set_response_cache_interval_async(ctx.guild.id, seconds):
+                    logger.info("Response cache interval set to %ss", seconds)
+                    await ctx.send(embed=utils.create_embed(
+                        "Response Cache Interval Updated",
+                        f"Cached answers will be reused at most every {seconds}s!"
+                    ))
+                else:
+                    logger.error("Failed to update response cache interval")
+                    await ctx.send(embed=utils.error_embed("Error", "Failed to update the response cache interval!"))
+
+            else:
+                logger.debug("Invalid cache command action")
+                await ctx.send(embed=utils.create_help_embed(
+                    "Response Cache",
+                    "Manage the response cache",
+                    ["!cache status", "!cache on", "!cache off", "!cache interval 60"]
+                ))
+
+        @self.command(
+            name='model',
+            brief="Pick the model and generation settings for this server",
+            help="Trade quality for speed in this server\n\nExamples:\n!model status - Show current settings\n!model name llama3:8b - Use a different model\n!model tokens 200 - Cap how long replies can get\n!model temperature 0.8 - How random replies are\n!model context 4096 - Context window size\n!model keepalive 10m - How long the model stays loaded\n!model reset - Go back to the defaults"
+        )
+        async def model(ctx, action=None, value=None):
+            logger.debug("Model command called by %s with action: %s", ctx.author.id, action)
+            if isinstance(ctx.channel, discord.DMChannel):
+                logger.debug("Model command used in DM, sending error")
+                await ctx.send(embed=utils.error_embed(
+                    "DM Not Supported",
+                    "Model settings can only be changed in servers!"
+                ))
+                return
+
+            if not ctx.author.guild_permissions.administrator and action not in (None, 'status'):
+                logger.warning("Permission denied for user %s", ctx.author.id)
+                await ctx.send(embed=utils.no_permission_embed())
+                return
+
+            settings = await database.get_server_settings_async(ctx.guild.id)
+            if not settings:
+                logger.error("Failed to get settings for server %s", ctx.guild.id)
+                await ctx.send(embed=utils.error_embed("Error", "Failed to get server settings!"))
+                return
+
+            if not action or action.lower() == 'status':
+                logger.debug("Showing model settings")
+                model_name, options, keep_alive = utils.generation_settings(settings)
+                await ctx.send(embed=utils.create_embed(
+                    "Model Settings",
+                    None,
+                    [
+                        {'name': 'Model', 'value': model_name, 'inline': True},
+                        {'name': 'Max Tokens', 'value': str(options.get('num_predict', 'default')), 'inline': True},
+                        {'name': 'Temperature', 'value': str(options.get('temperature', 'default')), 'inline': True},
+                        {'name': 'Context', 'value': str(options.get('num_ctx', 'default')), 'inline': True},
+                        {'name': 'Keep Alive', 'value': str(keep_alive), 'inline': True}
+                    ]
+                ))
+                return
+
+            action = action.lower()
+            if action == 'reset':
+                logger.debug("Resetting model settings")
+                if await database.reset_generation_settings_async(ctx.guild.id):
+                    logger.info("Model settings reset")
+                    await ctx.send(embed=utils.create_embed("Model Settings Reset", f"Back to {config.MODEL_NAME}!"))
+                else:
+                    logger.error("Failed to reset model settings")
+                    await ctx.send(embed=utils.error_embed("Error", "Failed to reset model settings!"))
+                return
+
+            # action -> (column, parse, valid, how it's described when it's wrong)
+            setters = {
+                'name': ('model_name', str, lambda v: bool(v), "a model name"),
+                'tokens': ('num_predict', int, lambda v: 1 <= v <= 8192, "a number of tokens from 1 to 8192"),
+                'temperature': ('temperature', float, lambda v: 0 <= v <= 2, "a number from 0 to 2"),
+                'context': ('num_ctx', int, lambda v: 512 <= v <= 131072, "a context size from 512 to 131072"),
+                'keepalive': ('keep_alive', str, lambda v: bool(database.KEEP_ALIVE_RE.match(v)), "a duration like 10m, 1h or -1")
+            }
+            if action not in setters or value is None:
+                logger.debug("Invalid model command action")
+                await ctx.send(embed=utils.create_help_embed(
+                    "Model Settings",
+                    "Pick the model and generation settings for this server",
+                    ["!model status", "!model name llama3:8b", "!model tokens 200", "!model temperature 0.8",
+                     "!model context 4096", "!model keepalive 10m", "!model reset"]
+                ))
+                return
+
+            column, parse, valid, expected = setters[action]
+            try:
+                parsed = parse(value)
+            except ValueError:
+                parsed = None
+            if parsed is None or not valid(parsed):
+                await ctx.send(embed=utils.create_help_embed(
+                    "Invalid Value",
+                    f"That needs to be {expected}!",
+                    [f"!model {action} ..."]
+                ))
+                return
+
+            if action == 'name':
+                known = backends.pool.known_models()
+                if known and parsed not in known:
+                    await ctx.send(embed=utils.error_embed(
+                        "Unknown Model",
+                        f"None of my Ollama hosts have {parsed} pulled!"
+                    ))
+                    return
+
+            logger.debug("Setting %s to %s", column, parsed)
+            if await database.set_generation_setting_async(ctx.guild.id, column, parsed):
+                logger.info("%s set to %s", column, parsed)
+                await ctx.send(embed=utils.create_embed("Model Settings Updated", f"{action.capitalize()} is now {parsed}!"))
+                if action == 'name':
+                    # load it now so the first message doesn't wait for it
+                    self.spawn(backends.pool.warm_up(parsed, config.OLLAMA_KEEP_ALIVE))
+            else:
+                logger.error("Failed to update %s", column)
+                await ctx.send(embed=utils.error_embed("Error", "Failed to update model settings!"))
+
+        @self.command(
+            name='shards',
+            brief="Show how my shards are doing",
+            help="Shows the latency and guild count of every shard this process runs"
+        )
+        async def shards(ctx):
+            logger.debug("Shards command called by %s", ctx.author.id)
+            stats = self.shard_stats()
+            fields = [
+                {
+                    'name': f"Shard {shard['id']}" + (" (this server)" if ctx.guild and ctx.guild.shard_id == shard['id'] else ""),
+                    'value': "Down 🌑" if shard['closed'] else f"{shard['latency'] * 1000:.0f}ms, {shard['guilds']} servers",
+                    'inline': True
+                }
+                for shard in stats[:25]
+            ]
+            await ctx.send(embed=utils.create_embed(
+                "Shard Status",
+                f"Running {len(stats)} of {self.shard_count} shards, {len(self.guilds)} servers",
+                fields
+            ))
+
+        @self.command(
+            name='loglevel',
+            hidden=True,
+            brief="Change how much I log",
+            help="Change the log level while running, only the bot owner can do this\n\nExample:\n!loglevel debug"
+        )
+        @commands.is_owner()
+        async def loglevel(ctx, level=None):
+            logger.debug("Loglevel command called by %s with level: %s", ctx.author.id, level)
+            if not level or level.upper() not in ('DEBUG', 'INFO', 'WARNING', 'ERROR'):
+                await ctx.send(embed=utils.create_help_embed(
+                    "Log Level",
+                    "Change how much I log",
+                    ["!loglevel debug", "!loglevel info"]
+                ))
+                return
+
+            log.set_log_level(level.upper())
+            await ctx.send(embed=utils.create_embed(
+                "Log Level Updated",
+                f"Now logging at `{level.upper()}`"
+            ))
+
         logger.info("Command setup complete")
 
     async def on_message(self, message):
-        logger.debug(f"Message received - Channel: {message.channel.id}, Author: {message.author.id}")
+        logger.debug("Message received - Channel: %s, Author: %s", message.channel.id, message.author.id)
+        # every message goes into the history cache, including ours and other bots
+        channel_history.add(message)
             
+        # cheapest checks first, nothing below here until the rate limit check even touches a dict
+        if message.author.bot:
+            logger.debug("Skipping bot message")
+            metrics.messages_seen.inc('bot')
+            return
+
         if message.content.startswith(self.command_prefix):
-            logger.info(f"Processing command: {message.content}")
+            logger.info("Processing command: %s", message.content)
+            metrics.messages_seen.inc('command')
+            metrics.commands_run.inc()
             await self.process_commands(message)
             return
-                
-        if message.author.bot:
-            logger.debug("Skipping bot message")
+
+        # limits get checked before anything touches the database, so someone over theirs costs us nothing
+        throttled = ratelimit.limiter.throttled(message)
+        if throttled:
+            metrics.messages_seen.inc('throttled')
+            if decision.addressed_reason(message):
+                metrics.rate_limited.inc(throttled)
+                await self.notify_throttled(message, throttled)
             return
                 
-        should_respond = False
-        if isinstance(message.channel, discord.DMChannel):
-            logger.debug("Message is in DM, should respond")
-            should_respond = True
-        else:
-            logger.debug("Checking if should respond to server message")
-            should_respond = utils.should_respond(message)
-                
-        if not should_respond:
-            logger.debug("Decided not to respond to message")
+        reason, settings = await decision.should_respond(message)
+        if reason not in decision.RESPOND_REASONS:
+            logger.debug("Decided not to respond to message (%s)", reason)
+            metrics.messages_seen.inc(reason)
             return
 
-        logger.info(f"Preparing response to message: {message.clean_content[:50]}...")
-        async with message.channel.typing():
+        throttled = ratelimit.limiter.consume(message)
+        if throttled:
+            metrics.messages_seen.inc('throttled')
+            # random rolls weren't asked for, no point telling anyone they got dropped
+            if reason != 'random':
+                await self.notify_throttled(message, throttled)
+            return
+        metrics.messages_seen.inc(reason)
+
+        if config.COALESCE_DEBOUNCE_SECONDS and reason in ('trigger', 'random'):
+            if not await utils.debounce(message, config.COALESCE_DEBOUNCE_SECONDS):
+                logger.debug("Skipping message %s, a newer trigger came in", message.id)
+                metrics.messages_debounced.inc()
+                return
+
+        logger.info("Preparing response to message: %s...", message.clean_content[:50])
+        async with ratelimit.limiter.hold(), utils.track_generation(message), message.channel.typing():
             try:
+                started = time.perf_counter()
                 content = message.clean_content.replace(f'@{self.user.name}', '').strip()
                 
                 if isinstance(message.channel, discord.DMChannel):
-                    logger.debug(f"Getting DM prompt for user {message.author.id}")
-                    system_prompt = database.get_dm_prompt(message.author.id)
+                    logger.debug("Getting DM prompt for user %s", message.author.id)
+                    system_prompt = await database.get_dm_prompt_async(message.author.id)
+                    settings = None
+                    cache_enabled = config.DEFAULT_RESPONSE_CACHE_ENABLED
+                    cache_interval = config.DEFAULT_RESPONSE_CACHE_INTERVAL
                 else:
-                    logger.debug(f"Getting server prompt for guild {message.guild.id}")
-                    system_prompt = database.get_server_prompt(message.guild.id)
+                    if settings is None:
+                        logger.debug("Getting server settings for guild %s", message.guild.id)
+                        settings = await database.get_server_settings_async(message.guild.id) or {}
+                    system_prompt = settings.get('system_prompt', config.DEFAULT_PERSONA)
+                    cache_enabled = settings.get('response_cache_enabled', config.DEFAULT_RESPONSE_CACHE_ENABLED)
+                    cache_interval = settings.get('response_cache_interval', config.DEFAULT_RESPONSE_CACHE_INTERVAL)
+                model_name, options, keep_alive = utils.generation_settings(settings)
                 
-                context = [{'role': 'system', 'content': system_prompt}]
-                
-                if message.reference and message.reference.resolved:
+                replied = None
+                if message.reference and isinstance(message.reference.resolved, discord.Message):
                     logger.debug("Adding replied message to context")
                     replied_msg = message.reference.resolved
-                    context.append({
+                    replied = {
+                        'id': replied_msg.id,
                         'role': 'user' if replied_msg.author != self.user else 'assistant',
                         'content': replied_msg.clean_content
-                    })
+                    }
                 
-                logger.debug(f"Getting message history (max {config.MAX_CONTEXT_MESSAGES} messages)")
-                async for hist_msg in message.channel.history(
-                    limit=config.MAX_CONTEXT_MESSAGES,
-                    before=message
-                ):
-                    if hist_msg.author.bot and hist_msg.author != self.user:
+                logger.debug("Getting message history (max %s messages)", config.MAX_CONTEXT_MESSAGES)
+                history = []
+                turns = []
+                with metrics.history_fetch_seconds.time():
+                    if config.CONVERSATION_MEMORY:
+                        turns = await database.load_conversation_turns_async(
+                            message.channel.id,
+                            message.created_at.timestamp(),
+                            config.CONVERSATION_TURNS
+                        )
+                    # stored turns only have what the bot was part of, the channel history is still
+                    # fetched once when it's cold so everything said in between is there too
+                    recent = await channel_history.recent(
+                        message.channel,
+                        message.id,
+                        config.MAX_CONTEXT_MESSAGES
+                    )
+                for hist_msg in recent:
+                    if hist_msg.is_bot and hist_msg.author_id != self.user.id:
                         continue
-                    context.append({
-                        'role': 'user' if hist_msg.author != self.user else 'assistant',
-                        'content': hist_msg.clean_content
+                    history.append({
+                        'id': hist_msg.id,
+                        'role': 'user' if hist_msg.author_id != self.user.id else 'assistant',
+                        'content': hist_msg.content
                     })
-                
-                context.append({'role': 'user', 'content': content})
+                history = prompt.add_turns(history, turns)
+
+                memories = None
+                if semantic_memory.enabled:
+                    try:
+                        memories = await semantic_memory.recall(
+                            message,
+                            content,
+                            config.SEMANTIC_MEMORY_RESULTS,
+                            {entry['id'] for entry in history} | {message.id}
+                        )
+                    except Exception as e:
+                        # a reply without long term memory beats no reply
+                        logger.warning("Couldn't search long term memory: %s", e)
+
+                budget = config.CONTEXT_TOKEN_BUDGET
+                if options.get('num_ctx'):
+                    # leave a quarter of the guild's context window for the reply
+                    budget = min(budget, options['num_ctx'] * 3 // 4)
+                context = prompt.build_context(system_prompt, history, content, replied, budget, message.channel.id, memories)
+                logger.debug("Built context of %s messages", len(context))
 
                 try:
-                    logger.debug(f"Getting response from Ollama using model {config.MODEL_NAME}")
-                    response = await utils.get_ollama_response(context, config.MODEL_NAME)
-                    response_content = response['message']['content']
-                    logger.info("Successfully got response from Ollama")
-                    logger.debug(f"Response content: {response_content[:100]}...")
-                    await utils.split_and_send_message(message, response_content)
+                    cache_key = None
+                    if cache_enabled:
+                        cache_key = response_cache.make_key(
+                            model_name,
+                            system_prompt,
+                            scheduler.queue_key(message),
+                            content,
+                            replied and replied['content'],
+                            options
+                        )
+                        cached = await response_cache.lookup(cache_key, scheduler.queue_key(message), cache_interval)
+                        if cached is not None:
+                            logger.info("Serving response from the response cache")
+                            await utils.split_and_send_message(message, cached)
+                            self.remember_turn(message, content, cached, model_name, context, started)
+                            return
+
+                    coalesce_key = utils.coalesce_key(model_name, system_prompt, message.channel.id, content)
+                    response_content, generated = await utils.generate_once(
+                        coalesce_key,
+                        lambda: self.generate_reply(message, context, reason, model_name, options, keep_alive)
+                    )
+                    if not generated:
+                        logger.info("Reusing in flight response for message %s", message.id)
+                        await utils.split_and_send_message(message, response_content)
+                        self.remember_turn(message, content, response_content, model_name, context, started)
+                        return
+                    if cache_key is not None:
+                        await response_cache.store(cache_key, response_content)
+                    self.remember_turn(message, content, response_content, model_name, context, started)
                 except asyncio.TimeoutError:
                     logger.error("Ollama response timed out")
                     await message.reply("*Evil laugh fades* My dark powers are taking too long! Try again later. 😈")
+                except QueueFullError:
+                    # random rolls just get dropped quietly, everyone else gets told to wait their turn
+                    logger.warning("Dropped %s response, generation queue is full", reason)
+                    if reason != 'random':
+                        try:
+                            await message.add_reaction('⏳')
+                        except discord.HTTPException as e:
+                            logger.debug("Couldn't react to dropped message: %s", e)
                 except Exception as e:
-                    logger.error(f"Error getting response from Ollama: {e}", exc_info=True)
+                    logger.error("Error getting response from Ollama: %s", e, exc_info=True)
                     await message.reply("*Evil laugh turns into evil cough* Something went wrong with my dark powers! 😈")
 
             except Exception as e:
-                logger.error(f"Error in message processing: {e}", exc_info=True)
+                logger.error("Error in message processing: %s", e, exc_info=True)
+                metrics.errors.inc('on_message')
                 await message.reply("*Evil laugh turns into evil cough* Something went wrong with my dark powers! 😈")
+
+    def remember_turn(self, message, content, response_content, model_name, context, started):
+        # saved in the background, the reply is already out so nobody's waiting on this
+        if not config.CONVERSATION_MEMORY or not response_content:
+            return
+        self.spawn(self.save_turn(message, {
+            'channel_id': message.channel.id,
+            'guild_id': message.guild.id if message.guild is not None else None,
+            'user_id': message.author.id,
+            'message_id': message.id,
+            'prompt': content,
+            'completion': response_content,
+            'model_name': model_name,
+            'prompt_tokens': sum(prompt.message_tokens(m) for m in context),
+            'completion_tokens': prompt.estimate_tokens(response_content),
+            'latency': time.perf_counter() - started,
+            # the time of the message, not the reply, so turns load in the order they were asked
+            'created_at': message.created_at.timestamp()
+        }))
+
+    async def save_turn(self, message, turn):
+        turn_id = await database.save_conversation_turn_async(turn)
+        if turn_id and semantic_memory.enabled:
+            semantic_memory.add(semantic_memory.scope(message), turn_id, f"{turn['prompt']}\n{turn['completion']}")
+
+    async def forget_turn(self, message):
+        turn_ids = await database.forget_conversation_turn_async(message.channel.id, message.id)
+        if turn_ids and semantic_memory.enabled:
+            await semantic_memory.forget(semantic_memory.scope(message), turn_ids)
+
+    async def notify_throttled(self, message, scope):
+        logger.info("Rate limited %s in %s (%s limit)", message.author.id, message.channel.id, scope)
+        if not ratelimit.limiter.should_notify(message):
+            return
+        try:
+            await message.add_reaction('🛑')
+        except discord.HTTPException as e:
+            logger.debug("Couldn't react to throttled message: %s", e)
+
+    async def generate_reply(self, message, context, reason, model_name, options=None, keep_alive=None):
+        logger.debug("Getting response from Ollama using model %s", model_name)
+        if config.STREAM_RESPONSES:
+            response_content = await utils.stream_ollama_response(message, context, model_name, reason, options, keep_alive)
+            logger.info("Successfully streamed response from Ollama")
+            logger.debug("Response content: %s...", response_content[:100])
+        else:
+            response = await utils.get_ollama_response(message, context, model_name, reason, options, keep_alive)
+            response_content = response['message']['content']
+            logger.info("Successfully got response from Ollama")
+            logger.debug("Response content: %s...", response_content[:100])
+            await utils.split_and_send_message(message, response_content)
+        return response_content
+
+    async def on_message_edit(self, before, after):
+        channel_history.edit(after)
+
+    async def on_message_delete(self, message):
+        channel_history.delete(message.channel.id, message.id)
+        utils.cancel_generation(message.id, 'deleted')
+        if config.CONVERSATION_MEMORY:
+            self.spawn(self.forget_turn(message))
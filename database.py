@@ -1,32 +1,179 @@
 import sqlite3
 from sqlite3 import Error
+import asyncio
+import functools
 import json
+import os
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import config
 import logging
+from cache import LRUCache
 
 logger = logging.getLogger('evil_bot')
 
+# settings live in memory so the message hot path doesn't have to touch the disk,
+# every write below updates these as well as the db (see _write_settings)
+_server_cache = LRUCache(config.SETTINGS_CACHE_SIZE)
+_dm_cache = LRUCache(config.SETTINGS_CACHE_SIZE)
+
+def _default_settings():
+    return {
+        'system_prompt': config.DEFAULT_PERSONA,
+        'trigger_words': list(config.DEFAULT_TRIGGER_WORDS),
+        'random_responses_enabled': config.DEFAULT_RANDOM_ENABLED,
+        'random_response_chance': config.DEFAULT_RANDOM_CHANCE,
+        'response_cache_enabled': config.DEFAULT_RESPONSE_CACHE_ENABLED,
+        'response_cache_interval': config.DEFAULT_RESPONSE_CACHE_INTERVAL,
+        # generation overrides, None means use the global default
+        'model_name': None,
+        'num_predict': None,
+        'temperature': None,
+        'num_ctx': None,
+        'keep_alive': None
+    }
+
+GENERATION_SETTINGS = ('model_name', 'num_predict', 'temperature', 'num_ctx', 'keep_alive')
+
+# the server_settings columns, in the order they're selected. Trigger words have their own table
+SETTINGS_COLUMNS = (
+    'system_prompt', 'random_responses_enabled', 'random_response_chance',
+    'response_cache_enabled', 'response_cache_interval'
+) + GENERATION_SETTINGS
+_BOOL_COLUMNS = ('random_responses_enabled', 'response_cache_enabled')
+
+# server_settings only has a row for guilds that changed something, and only the columns they changed
+# are set. NULL (or no row at all) means the default from config, so a guild that never touched its
+# settings costs nothing to store and reading its settings never has to write anything.
+# custom_triggers is set when the guild's trigger words are in trigger_words instead of the defaults.
+_EMPTY_ROW = ' AND '.join(f'{column} IS NULL' for column in SETTINGS_COLUMNS + ('custom_triggers',))
+
+KEEP_ALIVE_RE = re.compile(r'^-?\d+(\.\d+)?(ms|s|m|h)?$')
+
+# what import_settings accepts for each column: (type, valid, how it's described when it's wrong).
+# None is always fine, it means the default
+_SETTING_CHECKS = {
+    'system_prompt': (str, bool, "some text"),
+    'random_responses_enabled': (bool, None, "true or false"),
+    'random_response_chance': (int, lambda v: 1 <= v <= 100, "a number from 1 to 100"),
+    'response_cache_enabled': (bool, None, "true or false"),
+    'response_cache_interval': (int, lambda v: v >= 0, "a number of seconds, 0 or more"),
+    'model_name': (str, bool, "a model name"),
+    'num_predict': (int, lambda v: 1 <= v <= 8192, "a number of tokens from 1 to 8192"),
+    'temperature': ((int, float), lambda v: 0 <= v <= 2, "a number from 0 to 2"),
+    'num_ctx': (int, lambda v: 512 <= v <= 131072, "a context size from 512 to 131072"),
+    'keep_alive': (str, lambda v: bool(KEEP_ALIVE_RE.match(v)), "a duration like 10m, 1h or -1")
+}
+
+def _check_setting(server_id, column, value):
+    if value is None:
+        return
+    if column == 'trigger_words':
+        if isinstance(value, list) and all(isinstance(word, str) and word for word in value):
+            return
+        raise ValueError(f"Bad trigger_words for server {server_id}: needs to be a list of words")
+    kind, valid, expected = _SETTING_CHECKS[column]
+    # bool is an int to python, but true isn't a number of tokens
+    wrong_type = not isinstance(value, kind) or (isinstance(value, bool) and kind is not bool)
+    if wrong_type or (valid is not None and not valid(value)):
+        raise ValueError(f"Bad {column} for server {server_id}: {value!r}, needs to be {expected}")
+
+def _column_value(column, value):
+    return bool(value) if column in _BOOL_COLUMNS else value
+
+def _settings_from_row(row):
+    settings = _default_settings()
+    if row is not None:
+        for column, value in zip(SETTINGS_COLUMNS, row):
+            if value is not None:
+                settings[column] = _column_value(column, value)
+    return settings
+
+def _overrides_from_row(row):
+    return {
+        column: _column_value(column, value)
+        for column, value in zip(SETTINGS_COLUMNS, row) if value is not None
+    }
+
+# columns that were added to server_settings after the first release, init_db adds any that are
+# missing from older databases. Each one maps to (column definition, default value)
+_ADDED_COLUMNS = {
+    'response_cache_enabled': ('BOOLEAN NOT NULL DEFAULT 0', config.DEFAULT_RESPONSE_CACHE_ENABLED),
+    'response_cache_interval': ('INTEGER NOT NULL DEFAULT 0', config.DEFAULT_RESPONSE_CACHE_INTERVAL),
+    'model_name': ('TEXT', None),
+    'num_predict': ('INTEGER', None),
+    'temperature': ('REAL', None),
+    'num_ctx': ('INTEGER', None),
+    'keep_alive': ('TEXT', None)
+}
+
+def _copy_settings(settings):
+    # callers like to mutate the trigger list, so never hand out the cached one
+    return dict(settings, trigger_words=list(settings['trigger_words']))
+
+# things like compiled trigger words hang off a guild's settings, they register here to hear about changes
+_settings_listeners = []
+
+def add_settings_listener(listener):
+    _settings_listeners.append(listener)
+
+def _notify_settings_changed(server_id):
+    for listener in _settings_listeners:
+        try:
+            listener(server_id)
+        except Exception as e:
+            logger.error("Settings listener failed for server_id %s: %s", server_id, e, exc_info=True)
+
+# all the async functions run on this one thread so the event loop never blocks on sqlite
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='evil_bot_db')
+_local = threading.local()
+
 def create_connection():
+    # each thread keeps one connection open for its whole life instead of reconnecting per query,
+    # sqlite caches the compiled statements per connection so this also gets us prepared statements
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        return conn
     try:
-        logger.debug(f"Connecting to database: {config.DATABASE_NAME}")
-        conn = sqlite3.connect(config.DATABASE_NAME)
+        logger.debug("Connecting to database: %s", config.DATABASE_NAME)
+        # with several shard processes on one database, wait for the other writers instead of failing
+        conn = sqlite3.connect(
+            config.DATABASE_NAME,
+            timeout=config.DATABASE_BUSY_TIMEOUT,
+            cached_statements=config.DATABASE_STATEMENT_CACHE
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _local.conn = conn
         return conn
     except Error as e:
-        logger.error(f"Error connecting to database: {e}", exc_info=True)
+        logger.error("Error connecting to database: %s", e, exc_info=True)
         return None
 
+def close_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        logger.debug("Closing database connection")
+        conn.close()
+        _local.conn = None
+
 def get_server_prompt(server_id):
-    logger.debug(f"Getting server prompt for server_id: {server_id}")
+    logger.debug("Getting server prompt for server_id: %s", server_id)
     if server_id is None:
         logger.debug("No server_id provided, returning default persona")
         return config.DEFAULT_PERSONA
     settings = get_server_settings(server_id)
     result = settings['system_prompt'] if settings else config.DEFAULT_PERSONA
-    logger.debug(f"Retrieved prompt: {result[:50]}...")
+    logger.debug("Retrieved prompt: %s...", result[:50])
     return result
 
 def get_dm_prompt(user_id):
-    logger.debug(f"Getting DM prompt for user_id: {user_id}")
+    logger.debug("Getting DM prompt for user_id: %s", user_id)
+    cached = _dm_cache.get(user_id)
+    if cached is not None:
+        return cached
     conn = create_connection()
     if conn is not None:
         try:
@@ -34,18 +181,17 @@ def get_dm_prompt(user_id):
             c.execute('SELECT system_prompt FROM dm_settings WHERE user_id = ?', (user_id,))
             result = c.fetchone()
             prompt = result[0] if result else config.DEFAULT_PERSONA
-            logger.debug(f"Retrieved DM prompt: {prompt[:50]}...")
+            _dm_cache.set(user_id, prompt)
+            logger.debug("Retrieved DM prompt: %s...", prompt[:50])
             return prompt
         except Error as e:
-            logger.error(f"Error getting DM prompt: {e}", exc_info=True)
+            logger.error("Error getting DM prompt: %s", e, exc_info=True)
             return config.DEFAULT_PERSONA
-        finally:
-            conn.close()
     logger.warning("No database connection, returning default persona")
     return config.DEFAULT_PERSONA
 
 def set_dm_prompt(user_id, prompt):
-    logger.info(f"Setting DM prompt for user_id: {user_id}")
+    logger.info("Setting DM prompt for user_id: %s", user_id)
     conn = create_connection()
     if conn is not None:
         try:
@@ -55,134 +201,472 @@ def set_dm_prompt(user_id, prompt):
                 VALUES (?, ?)
             ''', (user_id, prompt))
             conn.commit()
+            _dm_cache.set(user_id, prompt)
             logger.info("DM prompt set successfully")
             return True
         except Error as e:
-            logger.error(f"Error setting DM prompt: {e}", exc_info=True)
+            logger.error("Error setting DM prompt: %s", e, exc_info=True)
             return False
-        finally:
-            conn.close()
     return False
 
-def set_server_prompt(server_id, prompt):
-    logger.info(f"Setting server prompt for server_id: {server_id}")
+# Every server settings change goes through _write_settings. changes maps server_settings columns to
+# their new values (None goes back to the default), trigger_ops is a list of ('set', words),
+# ('add', word) or ('remove', word). ('set', None) goes back to the default trigger words.
+def _apply_settings(c, server_id, changes, trigger_ops):
+    # column names can't be parameters, they only ever come from SETTINGS_COLUMNS
+    columns = ''.join(f', {column}' for column in changes)
+    placeholders = ', '.join('?' * (len(changes) + 1))
+    update = 'UPDATE SET ' + ', '.join(f'{column} = excluded.{column}' for column in changes) if changes else 'NOTHING'
+    c.execute(f'''
+        INSERT INTO server_settings (server_id{columns}) VALUES ({placeholders})
+        ON CONFLICT (server_id) DO {update}
+    ''', (server_id, *changes.values()))
+
+    for op, value in trigger_ops:
+        if op == 'set':
+            c.execute('DELETE FROM trigger_words WHERE server_id = ?', (server_id,))
+            if value is not None:
+                c.executemany(
+                    'INSERT OR IGNORE INTO trigger_words (server_id, word) VALUES (?, ?)',
+                    [(server_id, word) for word in value]
+                )
+            c.execute(
+                'UPDATE server_settings SET custom_triggers = ? WHERE server_id = ?',
+                (None if value is None else True, server_id)
+            )
+            continue
+        _customize_triggers(c, server_id)
+        if op == 'add':
+            c.execute('INSERT OR IGNORE INTO trigger_words (server_id, word) VALUES (?, ?)', (server_id, value))
+        elif op == 'remove':
+            c.execute('DELETE FROM trigger_words WHERE server_id = ? AND word = ?', (server_id, value))
+
+    # a guild that's back on all the defaults doesn't need a row at all
+    if None in changes.values() or ('set', None) in trigger_ops:
+        c.execute(f'DELETE FROM server_settings WHERE server_id = ? AND {_EMPTY_ROW}', (server_id,))
+    # recorded even when this process doesn't poll, settings_cli never does but the shards it's changing might
+    _record_settings_change(c, server_id)
+
+def _customize_triggers(c, server_id):
+    # a guild on the default trigger words has none stored, copy them over before changing them
+    c.execute('SELECT custom_triggers FROM server_settings WHERE server_id = ?', (server_id,))
+    if not c.fetchone()[0]:
+        c.executemany(
+            'INSERT OR IGNORE INTO trigger_words (server_id, word) VALUES (?, ?)',
+            [(server_id, word) for word in config.DEFAULT_TRIGGER_WORDS]
+        )
+        c.execute('UPDATE server_settings SET custom_triggers = 1 WHERE server_id = ?', (server_id,))
+
+def _cache_settings_change(server_id, changes, trigger_ops):
+    settings = _server_cache.get(server_id)
+    if settings is not None:
+        defaults = _default_settings()
+        settings = dict(settings)
+        for column, value in changes.items():
+            settings[column] = defaults[column] if value is None else value
+        words = list(settings['trigger_words'])
+        for op, value in trigger_ops:
+            if op == 'set':
+                words = defaults['trigger_words'] if value is None else list(value)
+            elif op == 'add' and value not in words:
+                words.append(value)
+            elif op == 'remove' and value in words:
+                words.remove(value)
+        settings['trigger_words'] = words
+        _server_cache.set(server_id, settings)
+    _notify_settings_changed(server_id)
+
+# Write-behind queue. A deferred write updates the cache straight away and waits here, so a burst of
+# admin commands (or a script poking at lots of guilds) ends up as one transaction on the db thread
+# every SETTINGS_FLUSH_INTERVAL instead of a commit each.
+_pending = {}
+_pending_lock = threading.Lock()
+_flush_handle = None
+
+def _queue_settings(server_id, changes, trigger_ops):
+    global _flush_handle
+    with _pending_lock:
+        queued_changes, queued_ops = _pending.setdefault(server_id, ({}, []))
+        queued_changes.update(changes)
+        for op in trigger_ops:
+            if op[0] == 'set':
+                # replacing the whole list makes anything queued before it pointless
+                queued_ops.clear()
+            queued_ops.append(op)
+    if _flush_handle is None:
+        loop = asyncio.get_running_loop()
+        _flush_handle = loop.call_later(config.SETTINGS_FLUSH_INTERVAL, _start_flush, loop)
+
+def _start_flush(loop):
+    global _flush_handle
+    _flush_handle = None
+    loop.run_in_executor(_db_executor, flush_settings)
+
+def flush_settings():
+    with _pending_lock:
+        batch = dict(_pending)
+        _pending.clear()
+    if not batch:
+        return True
+    flushed = False
     conn = create_connection()
     if conn is not None:
         try:
             c = conn.cursor()
-            c.execute('''
-                UPDATE server_settings 
-                SET system_prompt = ?
-                WHERE server_id = ?
-            ''', (prompt, server_id))
+            for server_id, (changes, trigger_ops) in batch.items():
+                _apply_settings(c, server_id, changes, trigger_ops)
             conn.commit()
-            logger.info("Server prompt updated successfully")
-            return True
+            logger.debug("Flushed settings changes for %s servers", len(batch))
+            flushed = True
         except Error as e:
-            logger.error(f"Error setting server prompt: {e}", exc_info=True)
-            return False
-        finally:
-            conn.close()
-    return False
+            conn.rollback()
+            logger.error("Error flushing settings changes: %s", e, exc_info=True)
+    # either way the next read should come from the database. A read that missed the cache while these
+    # were still queued may have cached the row from before them, and if the flush failed the cache has
+    # changes the database never got
+    for server_id in batch:
+        _server_cache.pop(server_id)
+        _notify_settings_changed(server_id)
+    return flushed
 
-def reset_server_settings(server_id):
-    logger.info(f"Resetting server settings for server_id: {server_id}")
+def _write_settings(server_id, changes, trigger_ops=(), defer=False):
+    trigger_ops = list(trigger_ops)
+    if defer:
+        _cache_settings_change(server_id, changes, trigger_ops)
+        _queue_settings(server_id, changes, trigger_ops)
+        return True
+    # anything still queued is older than this write, it has to land first
+    flush_settings()
     conn = create_connection()
     if conn is not None:
         try:
             c = conn.cursor()
-            c.execute('''
-                UPDATE server_settings 
-                SET system_prompt = ?,
-                    trigger_words = ?,
-                    random_responses_enabled = ?,
-                    random_response_chance = ?
-                WHERE server_id = ?
-            ''', (
-                config.DEFAULT_PERSONA,
-                json.dumps(config.DEFAULT_TRIGGER_WORDS),
-                config.DEFAULT_RANDOM_ENABLED,
-                config.DEFAULT_RANDOM_CHANCE,
-                server_id
-            ))
+            _apply_settings(c, server_id, changes, trigger_ops)
             conn.commit()
-            logger.info("Server settings reset successfully")
+            _cache_settings_change(server_id, changes, trigger_ops)
             return True
         except Error as e:
-            logger.error(f"Error resetting server settings: {e}", exc_info=True)
+            conn.rollback()
+            logger.error("Error updating settings for server_id %s: %s", server_id, e, exc_info=True)
             return False
-        finally:
-            conn.close()
     return False
 
-def set_trigger_words(server_id, words):
-    logger.info(f"Setting trigger words for server_id: {server_id}")
-    logger.debug(f"New trigger words: {words}")
+def set_server_prompt(server_id, prompt, defer=False):
+    logger.info("Setting server prompt for server_id: %s", server_id)
+    return _write_settings(server_id, {'system_prompt': prompt}, defer=defer)
+
+def reset_server_settings(server_id, defer=False):
+    # everything back to None, which ends up deleting the guild's row
+    logger.info("Resetting server settings for server_id: %s", server_id)
+    return _write_settings(server_id, {column: None for column in SETTINGS_COLUMNS}, [('set', None)], defer)
+
+def set_trigger_words(server_id, words, defer=False):
+    logger.info("Setting trigger words for server_id: %s", server_id)
+    logger.debug("New trigger words: %s", words)
+    return _write_settings(server_id, {}, [('set', list(words))], defer)
+
+def add_trigger_word(server_id, word, defer=False):
+    logger.info("Adding trigger word for server_id: %s", server_id)
+    return _write_settings(server_id, {}, [('add', word)], defer)
+
+def remove_trigger_word(server_id, word, defer=False):
+    logger.info("Removing trigger word for server_id: %s", server_id)
+    return _write_settings(server_id, {}, [('remove', word)], defer)
+
+def set_random_responses(server_id, enabled, defer=False):
+    logger.info("Setting random responses for server_id: %s to %s", server_id, enabled)
+    return _write_settings(server_id, {'random_responses_enabled': bool(enabled)}, defer=defer)
+
+def set_random_chance(server_id, chance, defer=False):
+    logger.info("Setting random chance for server_id: %s to %s%%", server_id, chance)
+    if not 1 <= chance <= 100:
+        logger.error("Invalid chance value: %s", chance)
+        return False
+    return _write_settings(server_id, {'random_response_chance': chance}, defer=defer)
+
+def set_response_cache(server_id, enabled, defer=False):
+    logger.info("Setting response cache for server_id: %s to %s", server_id, enabled)
+    return _write_settings(server_id, {'response_cache_enabled': bool(enabled)}, defer=defer)
+
+def set_response_cache_interval(server_id, seconds, defer=False):
+    logger.info("Setting response cache interval for server_id: %s to %ss", server_id, seconds)
+    if seconds < 0:
+        logger.error("Invalid response cache interval: %s", seconds)
+        return False
+    return _write_settings(server_id, {'response_cache_interval': seconds}, defer=defer)
+
+def set_generation_setting(server_id, setting, value, defer=False):
+    # value None puts the guild back on the global default
+    logger.info("Setting %s for server_id: %s to %s", setting, server_id, value)
+    if setting not in GENERATION_SETTINGS:
+        logger.error("Unknown generation setting: %s", setting)
+        return False
+    return _write_settings(server_id, {setting: value}, defer=defer)
+
+def reset_generation_settings(server_id, defer=False):
+    logger.info("Resetting generation settings for server_id: %s", server_id)
+    return _write_settings(server_id, {setting: None for setting in GENERATION_SETTINGS}, defer=defer)
+
+def get_guild_models():
+    # every model some guild picked, so they can be loaded ahead of time
+    flush_settings()
+    conn = create_connection()
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            c.execute('SELECT DISTINCT model_name FROM server_settings WHERE model_name IS NOT NULL')
+            return [row[0] for row in c.fetchall()]
+        except Error as e:
+            logger.error("Error getting guild models: %s", e, exc_info=True)
+    return []
+
+# Bulk access for scripts and dashboards (see settings_cli.py). Rows are a server_id plus just the
+# settings that guild changed, importing writes every guild in one transaction.
+def export_settings(server_ids=None):
+    flush_settings()
+    conn = create_connection()
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            where = f' WHERE server_id IN ({", ".join("?" * len(server_ids))})' if server_ids else ''
+            params = tuple(server_ids or ())
+            c.execute(f'SELECT server_id, {", ".join(SETTINGS_COLUMNS)}, custom_triggers FROM server_settings{where}', params)
+            rows = {}
+            for row in c.fetchall():
+                rows[row[0]] = _overrides_from_row(row[1:-1])
+                if row[-1]:
+                    rows[row[0]]['trigger_words'] = []
+            c.execute(f'SELECT server_id, word FROM trigger_words{where} ORDER BY id', params)
+            for server_id, word in c.fetchall():
+                if 'trigger_words' in rows.get(server_id, {}):
+                    rows[server_id]['trigger_words'].append(word)
+            return [dict(server_id=server_id, **rows[server_id]) for server_id in sorted(rows)]
+        except Error as e:
+            logger.error("Error exporting settings: %s", e, exc_info=True)
+    return None
+
+def import_settings(rows):
+    # anything a row leaves out keeps its current value, None puts a setting back on the default
+    for row in rows:
+        unknown = set(row) - set(SETTINGS_COLUMNS) - {'server_id', 'trigger_words'}
+        if 'server_id' not in row or unknown:
+            raise ValueError(f"Bad settings row for server {row.get('server_id')}: unknown {sorted(unknown)}")
+        if not isinstance(row['server_id'], int) or isinstance(row['server_id'], bool):
+            raise ValueError(f"Bad server_id {row['server_id']!r}, needs to be a number")
+        for column, value in row.items():
+            if column != 'server_id':
+                _check_setting(row['server_id'], column, value)
+    flush_settings()
+    conn = create_connection()
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            for row in rows:
+                changes = {column: row[column] for column in SETTINGS_COLUMNS if column in row}
+                trigger_ops = []
+                if 'trigger_words' in row:
+                    words = row['trigger_words']
+                    trigger_ops.append(('set', None if words is None else list(words)))
+                _apply_settings(c, row['server_id'], changes, trigger_ops)
+            conn.commit()
+        except Error as e:
+            conn.rollback()
+            logger.error("Error importing settings: %s", e, exc_info=True)
+            return None
+        except Exception:
+            # the connection is shared, whatever got applied can't be left for the next write to commit
+            conn.rollback()
+            raise
+        for row in rows:
+            _server_cache.pop(row['server_id'])
+            _notify_settings_changed(row['server_id'])
+        logger.info("Imported settings for %s servers", len(rows))
+        return len(rows)
+    return None
+
+# Other shard processes have their own settings caches, so every change gets written to
+# settings_changes and each process polls it to drop whatever it has cached for those guilds
+_last_change_seen = None
+
+def _record_settings_change(c, server_id):
+    # goes in the same transaction as the change itself
+    c.execute(
+        'INSERT INTO settings_changes (server_id, origin, changed_at) VALUES (?, ?, ?)',
+        (server_id, os.getpid(), time.time())
+    )
+
+def poll_settings_changes():
+    global _last_change_seen
+    conn = create_connection()
+    if conn is None:
+        return 0
+    try:
+        c = conn.cursor()
+        if _last_change_seen is None:
+            # init_db normally sets this, only changes from after we started matter
+            c.execute('SELECT COALESCE(MAX(id), 0) FROM settings_changes')
+            _last_change_seen = c.fetchone()[0]
+            return 0
+        c.execute('''
+            SELECT id, server_id FROM settings_changes
+            WHERE id > ? AND origin != ?
+            ORDER BY id
+        ''', (_last_change_seen, os.getpid()))
+        rows = c.fetchall()
+        c.execute('SELECT COALESCE(MAX(id), ?) FROM settings_changes', (_last_change_seen,))
+        _last_change_seen = c.fetchone()[0]
+    except Error as e:
+        logger.error("Error polling settings changes: %s", e, exc_info=True)
+        return 0
+
+    for server_id in {row[1] for row in rows}:
+        logger.debug("Settings for server_id %s changed in another process", server_id)
+        _server_cache.pop(server_id)
+        _notify_settings_changed(server_id)
+    return len(rows)
+
+def prune_settings_changes(older_than):
+    conn = create_connection()
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            c.execute('DELETE FROM settings_changes WHERE changed_at < ?', (older_than,))
+            conn.commit()
+            return c.rowcount
+        except Error as e:
+            logger.error("Error pruning settings changes: %s", e, exc_info=True)
+    return 0
+
+def load_cached_responses(cache_key, newer_than):
     conn = create_connection()
     if conn is not None:
         try:
             c = conn.cursor()
             c.execute('''
-                UPDATE server_settings 
-                SET trigger_words = ?
-                WHERE server_id = ?
-            ''', (json.dumps(words), server_id))
+                SELECT completion, created_at FROM response_cache
+                WHERE cache_key = ? AND created_at > ?
+                ORDER BY created_at
+            ''', (cache_key, newer_than))
+            return c.fetchall()
+        except Error as e:
+            logger.error("Error loading cached responses: %s", e, exc_info=True)
+    return []
+
+def save_cached_response(cache_key, completion, created_at):
+    conn = create_connection()
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            c.execute('''
+                INSERT INTO response_cache (cache_key, completion, created_at)
+                VALUES (?, ?, ?)
+            ''', (cache_key, completion, created_at))
             conn.commit()
-            logger.info("Trigger words updated successfully")
             return True
         except Error as e:
-            logger.error(f"Error setting trigger words: {e}", exc_info=True)
-            return False
-        finally:
-            conn.close()
+            logger.error("Error saving cached response: %s", e, exc_info=True)
     return False
 
-def set_random_responses(server_id, enabled):
-    logger.info(f"Setting random responses for server_id: {server_id} to {enabled}")
+def prune_cached_responses(older_than):
+    conn = create_connection()
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            c.execute('DELETE FROM response_cache WHERE created_at <= ?', (older_than,))
+            conn.commit()
+            logger.debug("Pruned %s expired cached responses", c.rowcount)
+            return c.rowcount
+        except Error as e:
+            logger.error("Error pruning cached responses: %s", e, exc_info=True)
+    return 0
+
+# Every exchange the bot has, so a channel's conversation can be picked back up without asking discord
+# for its history. Looked up by channel, newest first, which is what the (channel_id, created_at) index is for
+def save_conversation_turn(turn):
     conn = create_connection()
     if conn is not None:
         try:
             c = conn.cursor()
             c.execute('''
-                UPDATE server_settings 
-                SET random_responses_enabled = ?
-                WHERE server_id = ?
-            ''', (enabled, server_id))
+                INSERT INTO conversation_turns (
+                    channel_id, guild_id, user_id, message_id, prompt, completion,
+                    model_name, prompt_tokens, completion_tokens, latency, created_at
+                ) VALUES (
+                    :channel_id, :guild_id, :user_id, :message_id, :prompt, :completion,
+                    :model_name, :prompt_tokens, :completion_tokens, :latency, :created_at
+                )
+            ''', turn)
             conn.commit()
-            logger.info("Random responses setting updated successfully")
-            return True
+            return c.lastrowid
         except Error as e:
-            logger.error(f"Error setting random responses: {e}", exc_info=True)
-            return False
-        finally:
-            conn.close()
-    return False
+            logger.error("Error saving conversation turn: %s", e, exc_info=True)
+    return None
 
-def set_random_chance(server_id, chance):
-    logger.info(f"Setting random chance for server_id: {server_id} to {chance}%")
-    if not 1 <= chance <= 100:
-        logger.error(f"Invalid chance value: {chance}")
-        return False
+def load_conversation_turns(channel_id, before, limit):
+    # newest first, as (message_id, prompt, completion)
     conn = create_connection()
     if conn is not None:
         try:
             c = conn.cursor()
             c.execute('''
-                UPDATE server_settings 
-                SET random_response_chance = ?
-                WHERE server_id = ?
-            ''', (chance, server_id))
+                SELECT message_id, prompt, completion FROM conversation_turns
+                WHERE channel_id = ? AND created_at < ?
+                ORDER BY created_at DESC LIMIT ?
+            ''', (channel_id, before, limit))
+            return c.fetchall()
+        except Error as e:
+            logger.error("Error loading conversation turns: %s", e, exc_info=True)
+    return []
+
+def get_conversation_turns(turn_ids):
+    # by row id, for long term memory. Returns {id: (channel_id, message_id, prompt, completion)},
+    # turns that have been pruned or deleted are just missing
+    if not turn_ids:
+        return {}
+    conn = create_connection()
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            c.execute(
+                f'SELECT id, channel_id, message_id, prompt, completion FROM conversation_turns WHERE id IN ({", ".join("?" * len(turn_ids))})',
+                tuple(turn_ids)
+            )
+            return {row[0]: row[1:] for row in c.fetchall()}
+        except Error as e:
+            logger.error("Error getting conversation turns: %s", e, exc_info=True)
+    return {}
+
+def forget_conversation_turn(channel_id, message_id):
+    # returns the ids that were deleted, so long term memory can drop them too
+    conn = create_connection()
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            c.execute('SELECT id FROM conversation_turns WHERE channel_id = ? AND message_id = ?', (channel_id, message_id))
+            turn_ids = [row[0] for row in c.fetchall()]
+            if turn_ids:
+                c.execute('DELETE FROM conversation_turns WHERE channel_id = ? AND message_id = ?', (channel_id, message_id))
+                conn.commit()
+            return turn_ids
+        except Error as e:
+            logger.error("Error forgetting conversation turn: %s", e, exc_info=True)
+    return []
+
+def prune_conversation_turns(older_than):
+    conn = create_connection()
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            c.execute('DELETE FROM conversation_turns WHERE created_at < ?', (older_than,))
             conn.commit()
-            logger.info("Random chance updated successfully")
-            return True
+            logger.debug("Pruned %s old conversation turns", c.rowcount)
+            return c.rowcount
         except Error as e:
-            logger.error(f"Error setting random chance: {e}", exc_info=True)
-            return False
-        finally:
-            conn.close()
-    return False
+            logger.error("Error pruning conversation turns: %s", e, exc_info=True)
+    return 0
 
 def init_db():
+    global _last_change_seen
     logger.info("Initializing database...")
     conn = create_connection()
     if conn is not None:
@@ -190,15 +674,37 @@ def init_db():
             c = conn.cursor()
             
             logger.debug("Creating server_settings table...")
+            _create_settings_table(c)
+
+            c.execute('PRAGMA table_info(server_settings)')
+            existing = {row[1] for row in c.fetchall()}
+            for column, (definition, default) in _ADDED_COLUMNS.items():
+                if column not in existing:
+                    logger.info("Adding %s column to server_settings", column)
+                    c.execute(f'ALTER TABLE server_settings ADD COLUMN {column} {definition}')
+                    c.execute(f'UPDATE server_settings SET {column} = ?', (default,))
+
+            logger.debug("Creating trigger_words table...")
             c.execute('''
-                CREATE TABLE IF NOT EXISTS server_settings (
-                    server_id INTEGER PRIMARY KEY,
-                    system_prompt TEXT NOT NULL,
-                    trigger_words TEXT NOT NULL,
-                    random_responses_enabled BOOLEAN NOT NULL,
-                    random_response_chance INTEGER NOT NULL
+                CREATE TABLE IF NOT EXISTS trigger_words (
+                    id INTEGER PRIMARY KEY,
+                    server_id INTEGER NOT NULL,
+                    word TEXT NOT NULL,
+                    UNIQUE (server_id, word)
                 )
             ''')
+
+            # trigger words used to be a JSON list in server_settings, move them over
+            if 'trigger_words' in existing:
+                logger.info("Moving trigger words out of server_settings")
+                c.execute('SELECT server_id, trigger_words FROM server_settings')
+                c.executemany(
+                    'INSERT OR IGNORE INTO trigger_words (server_id, word) VALUES (?, ?)',
+                    [(server_id, word) for server_id, words in c.fetchall() for word in json.loads(words)]
+                )
+
+            if 'custom_triggers' not in existing:
+                _make_settings_sparse(c)
             
             logger.debug("Creating dm_settings table...")
             c.execute('''
@@ -207,56 +713,274 @@ def init_db():
                     system_prompt TEXT NOT NULL
                 )
             ''')
+
+            logger.debug("Creating response_cache table...")
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    cache_key TEXT NOT NULL,
+                    completion TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            ''')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_response_cache_key ON response_cache (cache_key, created_at)')
+
+            logger.debug("Creating conversation_turns table...")
+            c.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'conversation_turns'")
+            result = c.fetchone()
+            if result and 'AUTOINCREMENT' not in result[0]:
+                # long term memory points at these ids, a plain rowid gets handed out again once the
+                # newest row is deleted and a memory would come back as someone else's exchange
+                logger.info("Rebuilding conversation_turns so ids are never reused")
+                c.execute('ALTER TABLE conversation_turns RENAME TO conversation_turns_old')
+                _create_conversation_turns_table(c)
+                c.execute('INSERT INTO conversation_turns SELECT * FROM conversation_turns_old')
+                c.execute('DROP TABLE conversation_turns_old')
+            else:
+                _create_conversation_turns_table(c)
+            c.execute('CREATE INDEX IF NOT EXISTS idx_conversation_turns_channel ON conversation_turns (channel_id, created_at)')
+
+            logger.debug("Creating settings_changes table...")
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS settings_changes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    server_id INTEGER NOT NULL,
+                    origin INTEGER NOT NULL,
+                    changed_at REAL NOT NULL
+                )
+            ''')
+            # every change is recorded even with nothing polling, so don't let them pile up forever
+            c.execute('DELETE FROM settings_changes WHERE changed_at < ?', (time.time() - 3600,))
+            # changes from here on have to be polled, nothing is cached yet so everything before is already
+            # what we'd load. Waiting for the first poll would miss whatever changed in between
+            c.execute('SELECT COALESCE(MAX(id), 0) FROM settings_changes')
+            _last_change_seen = c.fetchone()[0]
             
             conn.commit()
             logger.info("Database tables created successfully")
 
             c.execute("SELECT name FROM sqlite_master WHERE type='table'")
             tables = c.fetchall()
-            logger.info(f"Existing tables: {[table[0] for table in tables]}")
+            logger.info("Existing tables: %s", [table[0] for table in tables])
             
         except Error as e:
-            logger.error(f"Error initializing database: {e}", exc_info=True)
-        finally:
-            conn.close()
+            logger.error("Error initializing database: %s", e, exc_info=True)
     else:
         logger.error("Failed to create database connection")
 
+def _create_settings_table(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS server_settings (
+            server_id INTEGER PRIMARY KEY,
+            system_prompt TEXT,
+            random_responses_enabled BOOLEAN,
+            random_response_chance INTEGER,
+            response_cache_enabled BOOLEAN,
+            response_cache_interval INTEGER,
+            model_name TEXT,
+            num_predict INTEGER,
+            temperature REAL,
+            num_ctx INTEGER,
+            keep_alive TEXT,
+            custom_triggers BOOLEAN
+        )
+    ''')
+
+def _create_conversation_turns_table(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_turns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel_id INTEGER NOT NULL,
+            guild_id INTEGER,
+            user_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            prompt TEXT NOT NULL,
+            completion TEXT NOT NULL,
+            model_name TEXT NOT NULL,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            latency REAL,
+            created_at REAL NOT NULL
+        )
+    ''')
+
+def _make_settings_sparse(c):
+    # older databases have a full row of defaults for every guild the bot ever saw. Rebuild the table
+    # keeping only what's different from the defaults
+    logger.info("Rewriting server_settings to only keep changed settings")
+    c.connection.commit()
+    c.execute('BEGIN')
+    defaults = _default_settings()
+    c.execute(f'SELECT server_id, {", ".join(SETTINGS_COLUMNS)} FROM server_settings')
+    rows = c.fetchall()
+    c.execute('SELECT server_id, word FROM trigger_words ORDER BY id')
+    words = {}
+    for server_id, word in c.fetchall():
+        words.setdefault(server_id, []).append(word)
+
+    kept = []
+    for server_id, *values in rows:
+        values = [None if value == defaults[column] else value for column, value in zip(SETTINGS_COLUMNS, values)]
+        custom = words.get(server_id, []) != list(config.DEFAULT_TRIGGER_WORDS)
+        if not custom:
+            c.execute('DELETE FROM trigger_words WHERE server_id = ?', (server_id,))
+        if custom or any(value is not None for value in values):
+            kept.append((server_id, *values, True if custom else None))
+
+    c.execute('DROP TABLE server_settings')
+    _create_settings_table(c)
+    c.executemany(
+        f'INSERT INTO server_settings (server_id, {", ".join(SETTINGS_COLUMNS)}, custom_triggers) '
+        f'VALUES ({", ".join("?" * (len(SETTINGS_COLUMNS) + 2))})',
+        kept
+    )
+    logger.info("Kept settings for %s of %s servers", len(kept), len(rows))
+
 def get_server_settings(server_id):
-    logger.debug(f"Getting server settings for server_id: {server_id}")
+    # only ever reads, a guild without a row just gets the defaults
+    logger.debug("Getting server settings for server_id: %s", server_id)
+    cached = _server_cache.get(server_id)
+    if cached is not None:
+        return _copy_settings(cached)
+    flush_settings()
     conn = create_connection()
     if conn is not None:
         try:
             c = conn.cursor()
-            logger.debug("Inserting default values if not exist...")
-            c.execute('''
-                INSERT OR IGNORE INTO server_settings (
-                    server_id, system_prompt, trigger_words,
-                    random_responses_enabled, random_response_chance
-                ) VALUES (?, ?, ?, ?, ?)
-            ''', (
-                server_id,
-                config.DEFAULT_PERSONA,
-                json.dumps(config.DEFAULT_TRIGGER_WORDS),
-                config.DEFAULT_RANDOM_ENABLED,
-                config.DEFAULT_RANDOM_CHANCE
-            ))
-            conn.commit()
-
-            c.execute('SELECT * FROM server_settings WHERE server_id = ?', (server_id,))
+            c.execute(
+                f'SELECT {", ".join(SETTINGS_COLUMNS)}, custom_triggers FROM server_settings WHERE server_id = ?',
+                (server_id,)
+            )
             result = c.fetchone()
-            if result:
-                settings = {
-                    'system_prompt': result[1],
-                    'trigger_words': json.loads(result[2]),
-                    'random_responses_enabled': bool(result[3]),
-                    'random_response_chance': result[4]
-                }
-                logger.debug(f"Retrieved settings: {settings}")
-                return settings
+            settings = _settings_from_row(result[:-1] if result else None)
+            if result and result[-1]:
+                c.execute('SELECT word FROM trigger_words WHERE server_id = ? ORDER BY id', (server_id,))
+                settings['trigger_words'] = [row[0] for row in c.fetchall()]
+            _server_cache.set(server_id, settings)
+            logger.debug("Retrieved settings: %s", settings)
+            return _copy_settings(settings)
         except Error as e:
-            logger.error(f"Error getting server settings: {e}", exc_info=True)
-        finally:
-            conn.close()
+            logger.error("Error getting server settings: %s", e, exc_info=True)
     logger.error("Failed to get server settings")
     return None
+
+async def _run(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(func, *args))
+
+# Async versions of everything above, these are what the bot should use from coroutines.
+# Reads that are already cached skip the trip to the database thread entirely.
+async def init_db_async():
+    return await _run(init_db)
+
+async def get_server_settings_async(server_id):
+    cached = _server_cache.get(server_id)
+    if cached is not None:
+        return _copy_settings(cached)
+    return await _run(get_server_settings, server_id)
+
+async def get_server_prompt_async(server_id):
+    if server_id is None:
+        return config.DEFAULT_PERSONA
+    settings = await get_server_settings_async(server_id)
+    return settings['system_prompt'] if settings else config.DEFAULT_PERSONA
+
+async def get_dm_prompt_async(user_id):
+    cached = _dm_cache.get(user_id)
+    if cached is not None:
+        return cached
+    return await _run(get_dm_prompt, user_id)
+
+async def set_dm_prompt_async(user_id, prompt):
+    return await _run(set_dm_prompt, user_id, prompt)
+
+# with SETTINGS_FLUSH_INTERVAL set, settings writes go through the write-behind queue and return
+# straight away, the cache already has the change so nothing reading it can tell
+async def _write(setter, *args):
+    if config.SETTINGS_FLUSH_INTERVAL > 0:
+        return setter(*args, defer=True)
+    return await _run(setter, *args)
+
+async def set_server_prompt_async(server_id, prompt):
+    return await _write(set_server_prompt, server_id, prompt)
+
+async def reset_server_settings_async(server_id):
+    return await _write(reset_server_settings, server_id)
+
+async def set_trigger_words_async(server_id, words):
+    return await _write(set_trigger_words, server_id, words)
+
+async def add_trigger_word_async(server_id, word):
+    return await _write(add_trigger_word, server_id, word)
+
+async def remove_trigger_word_async(server_id, word):
+    return await _write(remove_trigger_word, server_id, word)
+
+async def set_random_responses_async(server_id, enabled):
+    return await _write(set_random_responses, server_id, enabled)
+
+async def set_random_chance_async(server_id, chance):
+    return await _write(set_random_chance, server_id, chance)
+
+async def set_response_cache_async(server_id, enabled):
+    return await _write(set_response_cache, server_id, enabled)
+
+async def set_response_cache_interval_async(server_id, seconds):
+    return await _write(set_response_cache_interval, server_id, seconds)
+
+async def set_generation_setting_async(server_id, setting, value):
+    return await _write(set_generation_setting, server_id, setting, value)
+
+async def reset_generation_settings_async(server_id):
+    return await _write(reset_generation_settings, server_id)
+
+async def flush_settings_async():
+    return await _run(flush_settings)
+
+async def export_settings_async(server_ids=None):
+    return await _run(export_settings, server_ids)
+
+async def import_settings_async(rows):
+    return await _run(import_settings, rows)
+
+async def get_guild_models_async():
+    return await _run(get_guild_models)
+
+async def poll_settings_changes_async():
+    return await _run(poll_settings_changes)
+
+async def prune_settings_changes_async(older_than):
+    return await _run(prune_settings_changes, older_than)
+
+async def load_cached_responses_async(cache_key, newer_than):
+    return await _run(load_cached_responses, cache_key, newer_than)
+
+async def save_cached_response_async(cache_key, completion, created_at):
+    return await _run(save_cached_response, cache_key, completion, created_at)
+
+async def prune_cached_responses_async(older_than):
+    return await _run(prune_cached_responses, older_than)
+
+async def save_conversation_turn_async(turn):
+    return await _run(save_conversation_turn, turn)
+
+async def load_conversation_turns_async(channel_id, before, limit):
+    return await _run(load_conversation_turns, channel_id, before, limit)
+
+async def get_conversation_turns_async(turn_ids):
+    return await _run(get_conversation_turns, turn_ids)
+
+async def forget_conversation_turn_async(channel_id, message_id):
+    return await _run(forget_conversation_turn, channel_id, message_id)
+
+async def prune_conversation_turns_async(older_than):
+    return await _run(prune_conversation_turns, older_than)
+
+async def close_async():
+    global _flush_handle
+    logger.info("Shutting down database thread")
+    if _flush_handle is not None:
+        _flush_handle.cancel()
+        _flush_handle = None
+    await _run(flush_settings)
+    await _run(close_connection)
+    _db_executor.shutdown(wait=True)
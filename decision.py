@@ -0,0 +1,80 @@
+import logging
+import random
+import discord
+import config
+import database
+import metrics
+import triggers
+from cache import LRUCache
+
+logger = logging.getLogger('evil_bot')
+
+# Decides whether a message gets a response, cheapest checks first. Everything a guild's settings say
+# about responding (compiled trigger words, random chance) is kept in a small profile per guild so
+# the common case, a message that triggers nothing, never has to copy or even look at the settings.
+
+# reasons that mean we respond, anything else should_respond returns is why we didn't
+RESPOND_REASONS = ('dm', 'mention', 'reply', 'trigger', 'random')
+
+class _GuildProfile:
+    __slots__ = ('matcher', 'random_chance')
+
+    def __init__(self, settings):
+        self.matcher = triggers.compile_triggers(settings['trigger_words'], config.TRIGGER_WORD_BOUNDARY)
+        self.random_chance = settings['random_response_chance'] if settings['random_responses_enabled'] else 0
+
+    @property
+    def could_respond(self):
+        # false when only mentions and replies can get a response out of this guild
+        return self.matcher is not None or self.random_chance > 0
+
+_profiles = LRUCache(config.SETTINGS_CACHE_SIZE)
+
+def invalidate(server_id):
+    _profiles.pop(server_id)
+
+database.add_settings_listener(invalidate)
+
+def addressed_reason(message):
+    # DMs, mentions and replies to the bot always get a response, and we can tell without any settings
+    if isinstance(message.channel, discord.DMChannel):
+        return 'dm'
+    if message.mentions and any(user.bot for user in message.mentions):
+        return 'mention'
+    # resolved can be a DeletedReferencedMessage, which has no author
+    reference = message.reference
+    if reference and isinstance(reference.resolved, discord.Message) and reference.resolved.author.bot:
+        return 'reply'
+    return None
+
+# This function decides if the bot should respond or fuck off.
+async def should_respond(message):
+    # Returns (reason, settings). settings is only there if we had to load them to decide, so the caller
+    # can reuse them instead of fetching again. Bots and commands are filtered out before this.
+    reason = addressed_reason(message)
+    if reason is not None:
+        return reason, None
+
+    settings = None
+    profile = _profiles.get(message.guild.id)
+    if profile is None:
+        with metrics.db_lookup_seconds.time():
+            settings = await database.get_server_settings_async(message.guild.id)
+        if not settings:
+            logger.warning("No settings found for server %s", message.guild.id)
+            return 'no_settings', None
+        profile = _GuildProfile(settings)
+        _profiles.set(message.guild.id, profile)
+
+    if not profile.could_respond:
+        return 'nothing_enabled', settings
+
+    # triggers go before the random roll even though the roll is cheaper, a trigger word gets a
+    # higher priority in the scheduler than a random response so it has to be recognised as one
+    if profile.matcher is not None and profile.matcher.search(message.content.lower()):
+        return 'trigger', settings
+
+    if profile.random_chance and random.randint(1, 100) <= profile.random_chance:
+        return 'random', settings
+
+    return 'no_trigger', settings
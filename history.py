@@ -0,0 +1,118 @@
+import time
+import logging
+from collections import OrderedDict, deque
+import discord
+import config
+
+logger = logging.getLogger('evil_bot')
+
+class HistoryEntry:
+    __slots__ = ('id', 'author_id', 'is_bot', 'content', 'created_at')
+
+    def __init__(self, message):
+        self.id = message.id
+        self.author_id = message.author.id
+        self.is_bot = message.author.bot
+        self.content = message.clean_content
+        self.created_at = message.created_at
+
+class _ChannelBuffer:
+    __slots__ = ('entries', 'warm', 'last_active')
+
+    def __init__(self, max_messages):
+        self.entries = deque(maxlen=max_messages)
+        # warm means we've seen everything recent in this channel, either live or by backfilling once
+        self.warm = False
+        self.last_active = time.monotonic()
+
+# Keeps the last few messages of every active channel in memory, fed straight from gateway events,
+# so building context doesn't need a channel.history() call. Channels are kept in least recently
+# active order so idle ones can be thrown out cheaply from the front.
+class ChannelHistoryCache:
+    def __init__(self, max_messages, max_channels, idle_seconds):
+        self.max_messages = max_messages
+        self.max_channels = max_channels
+        self.idle_seconds = idle_seconds
+        self._channels = OrderedDict()
+
+    def add(self, message):
+        buffer = self._channels.get(message.channel.id)
+        if buffer is None:
+            buffer = _ChannelBuffer(self.max_messages)
+            self._channels[message.channel.id] = buffer
+        else:
+            self._channels.move_to_end(message.channel.id)
+        buffer.entries.append(HistoryEntry(message))
+        buffer.last_active = time.monotonic()
+        self._evict()
+
+    def edit(self, message):
+        buffer = self._channels.get(message.channel.id)
+        if buffer is None:
+            return
+        for entry in reversed(buffer.entries):
+            if entry.id == message.id:
+                entry.content = message.clean_content
+                return
+
+    def delete(self, channel_id, message_id):
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            return
+        for entry in buffer.entries:
+            if entry.id == message_id:
+                buffer.entries.remove(entry)
+                return
+
+    async def recent(self, channel, before_id, limit):
+        # newest first, same as channel.history()
+        buffer = self._channels.get(channel.id)
+        if buffer is None or not buffer.warm:
+            buffer = await self._backfill(channel, before_id)
+
+        entries = []
+        for entry in reversed(buffer.entries):
+            if entry.id >= before_id:
+                continue
+            entries.append(entry)
+            if len(entries) >= limit:
+                break
+        return entries
+
+    def __len__(self):
+        return len(self._channels)
+
+    async def _backfill(self, channel, before_id):
+        logger.debug("History cache cold for channel %s, fetching from discord", channel.id)
+        fetched = [HistoryEntry(m) async for m in channel.history(limit=min(self.max_messages, 100), before=discord.Object(id=before_id))]
+
+        # stuff might have come in while we were waiting, so merge by id instead of replacing
+        buffer = self._channels.get(channel.id)
+        if buffer is None:
+            buffer = _ChannelBuffer(self.max_messages)
+            self._channels[channel.id] = buffer
+        merged = {entry.id: entry for entry in fetched}
+        merged.update((entry.id, entry) for entry in buffer.entries)
+        buffer.entries.clear()
+        buffer.entries.extend(merged[key] for key in sorted(merged))
+        buffer.warm = True
+        buffer.last_active = time.monotonic()
+        self._evict()
+        return buffer
+
+    def _evict(self):
+        while len(self._channels) > self.max_channels:
+            self._channels.popitem(last=False)
+        cutoff = time.monotonic() - self.idle_seconds
+        while self._channels:
+            channel_id, buffer = next(iter(self._channels.items()))
+            if buffer.last_active >= cutoff:
+                break
+            logger.debug("Evicting idle channel %s from history cache", channel_id)
+            del self._channels[channel_id]
+
+channel_history = ChannelHistoryCache(
+    config.HISTORY_CACHE_MESSAGES,
+    config.HISTORY_CACHE_CHANNELS,
+    config.HISTORY_CACHE_IDLE_SECONDS
+)
@@ -0,0 +1,110 @@
+import argparse
+import multiprocessing
+import os
+import signal
+import time
+
+# Runs the bot as several processes, each one an AutoShardedBot with its own slice of the shards:
+#   python launcher.py --processes 4 --shards 16
+# Every process gets its own event loop (and core), they all share the sqlite database and pick up
+# each other's settings changes through the settings_changes table.
+
+def shard_ranges(shard_count, processes):
+    # spread the shards as evenly as we can, earlier processes get the extras
+    per_process, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for index in range(processes):
+        size = per_process + (1 if index < extra else 0)
+        if size:
+            ranges.append(list(range(start, start + size)))
+        start += size
+    return ranges
+
+def run_shards(index, shard_ids, shard_count, env):
+    # config is read at import, so the environment has to be right before anything imports it
+    os.environ.update(env)
+    os.environ['SHARD_COUNT'] = str(shard_count)
+    os.environ['SHARD_IDS'] = ','.join(str(shard_id) for shard_id in shard_ids)
+    # separate log files, RotatingFileHandler can't share one between processes
+    name, ext = os.path.splitext(os.environ.get('LOG_FILE_NAME', 'bot.log'))
+    os.environ['LOG_FILE_NAME'] = f"{name}.{index}{ext}"
+    if int(os.environ.get('METRICS_PORT', "0")):
+        os.environ['METRICS_PORT'] = str(int(os.environ['METRICS_PORT']) + index)
+    os.environ.setdefault('SETTINGS_SYNC_INTERVAL', "2")
+
+    import main
+    main.main()
+
+def recommended_shards():
+    import discord
+    from config import BOT_TOKEN
+    import asyncio
+
+    async def fetch():
+        client = discord.Client(intents=discord.Intents.none())
+        await client.login(BOT_TOKEN)
+        try:
+            _, shards = await client.http.get_bot_gateway()
+        finally:
+            await client.close()
+        return shards
+    return asyncio.run(fetch())
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run Evil Bot across several processes")
+    parser.add_argument('--processes', type=int, default=int(os.getenv('SHARD_PROCESSES', "2")))
+    parser.add_argument('--shards', type=int, default=int(os.getenv('SHARD_COUNT') or 0),
+                        help="total shards, defaults to what discord recommends")
+    parser.add_argument('--restart-delay', type=float, default=5.0, help="seconds before restarting a crashed process")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    from config import BOT_TOKEN
+    if not BOT_TOKEN:
+        raise SystemExit("Error: BOT_TOKEN environment variable is required")
+    shard_count = args.shards or recommended_shards()
+    processes = max(1, min(args.processes, shard_count))
+    ranges = shard_ranges(shard_count, processes)
+    print(f"Launching {shard_count} shards over {len(ranges)} processes")
+
+    # spawn so every process starts fresh instead of inheriting imported modules
+    ctx = multiprocessing.get_context('spawn')
+    env = dict(os.environ)
+    children = {}
+
+    def start(index):
+        process = ctx.Process(target=run_shards, args=(index, ranges[index], shard_count, env), name=f"evil_bot_{index}")
+        process.start()
+        children[index] = process
+        print(f"Process {index} (pid {process.pid}) running shards {ranges[index][0]}-{ranges[index][-1]}")
+
+    for index in range(len(ranges)):
+        start(index)
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while not stopping:
+        time.sleep(1)
+        for index, process in list(children.items()):
+            if not process.is_alive() and not stopping:
+                print(f"Process {index} exited with {process.exitcode}, restarting in {args.restart_delay}s")
+                time.sleep(args.restart_delay)
+                start(index)
+
+    for process in children.values():
+        if process.is_alive():
+            process.terminate()
+    for process in children.values():
+        process.join(timeout=30)
+
+if __name__ == "__main__":
+    main()
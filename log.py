@@ -1,9 +1,14 @@
 import logging
 import os
-from logging.handlers import RotatingFileHandler
+import queue
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 import config
 
+# the real handlers run on this listener's thread, the bot only ever puts records on a queue
+_listener = None
+
 def setup_logging():
+    global _listener
     # get the path to the logs directory from the scripts working dir
     script_dir = os.path.dirname(os.path.abspath(__file__))
     log_dir = os.path.join(script_dir, 'logs')
@@ -19,10 +24,12 @@ def setup_logging():
     max_single_file = config.LOG_MAX_SIZE // (config.LOG_BACKUP_COUNT + 1)
 
     logger = logging.getLogger('evil_bot')
-    logger.setLevel(logging.DEBUG)
+    # anything below this level gets thrown out before its message is even formatted
+    logger.setLevel(config.LOG_LEVEL)
 
     if logger.handlers:
         logger.handlers.clear()
+    stop_logging()
 
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.INFO)
@@ -41,17 +48,36 @@ def setup_logging():
         file_handler.setFormatter(file_format)
         
 
-        logger.addHandler(console_handler)
-        logger.addHandler(file_handler)
+        _start_listener(logger, console_handler, file_handler)
         
 
         logger.info('Logging system initialized')
-        logger.info(f'Log directory: {log_dir}')
-        logger.info(f'Log file: {log_file}')
-        logger.info(f'Each log file size: {max_single_file / (1024*1024):.1f}MB')
-        logger.info(f'Total log capacity: {config.LOG_MAX_SIZE / (1024*1024*1024):.1f}GB')
+        logger.info('Log directory: %s', log_dir)
+        logger.info('Log file: %s', log_file)
+        logger.info('Each log file size: %.1fMB', max_single_file / (1024*1024))
+        logger.info('Total log capacity: %.1fGB', config.LOG_MAX_SIZE / (1024*1024*1024))
     
     except Exception as e:
-        logger.addHandler(console_handler)
-        logger.error(f"Could not set up file logging: {e}")
-    return logger
\ No newline at end of file
+        _start_listener(logger, console_handler)
+        logger.error("Could not set up file logging: %s", e)
+    return logger
+
+def _start_listener(logger, *handlers):
+    global _listener
+    # writing to the console and disk happens on a background thread so it can't block the event loop
+    log_queue = queue.SimpleQueue()
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    logger.addHandler(QueueHandler(log_queue))
+
+def set_log_level(level):
+    logger = logging.getLogger('evil_bot')
+    logger.setLevel(level)
+    logger.info('Log level set to %s', logging.getLevelName(logger.level))
+
+def stop_logging():
+    global _listener
+    # flushes whatever is still on the queue
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
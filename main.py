@@ -1,15 +1,19 @@
+import sys
 from bot import EvilBot
 from config import BOT_TOKEN
-from utils import thread_pool
-from log import setup_logging  
+from log import setup_logging, stop_logging
 
 def main():
+    if not BOT_TOKEN:
+        print("Error: BOT_TOKEN environment variable is required")
+        sys.exit(1)
     logger = setup_logging()
     bot = EvilBot()
+    # the ollama client and database thread get closed in EvilBot.close
     try:
         bot.run(BOT_TOKEN)
     finally:
-        thread_pool.shutdown(wait=True)
+        stop_logging()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
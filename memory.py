@@ -0,0 +1,328 @@
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+import backends
+import config
+import database
+import metrics
+from cache import LRUCache
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger('evil_bot')
+
+# Long term memory. Every exchange the bot has gets embedded by ollama and appended to its guild's
+# index (DMs get one per channel). Before a reply the new message is embedded too and the closest
+# past exchanges go into the context. The text stays in conversation_turns, the index only has
+# vectors and the conversation_turns ids they came from.
+#
+# An index is a directory of memory-mapped files, so only the pages a search reads are in memory:
+#   vectors.f32  unit length float32 vectors, one row per exchange
+#   signs.u64    the sign of every dimension packed into bits, a first pass over these reads 32x less.
+#                Stored one row per 64 dimensions and one column per exchange, so the first pass
+#                reads each row straight through instead of 12 words at a time
+#   turns.i64    which conversation_turns row each vector is, -1 once that exchange was deleted
+#   meta.json    dimensions, rows filled and where the next one goes
+# Once an index has max_entries rows the oldest ones get overwritten.
+
+# below this many floats a plain exact search is already fast enough
+_EXACT_SEARCH_FLOATS = 4_000_000
+# how many rows the bit search hands on to be scored properly
+_SHORTLIST = 200
+_FLUSH_INTERVAL = 5
+_BATCH_SIZE = 32
+_RECALL_TIMEOUT = 5
+
+_FILES = ('vectors.f32', 'signs.u64', 'turns.i64')
+# the row major sign bits older versions kept, rebuilt as signs.u64 when an index is opened
+_OLD_BITS = 'bits.u8'
+
+def _readable(message, channel_id):
+    # a guild's index covers every channel, only remember what the author could have read themselves
+    if message.guild is None:
+        return channel_id == message.channel.id
+    channel = message.guild.get_channel_or_thread(channel_id)
+    return channel is not None and channel.permissions_for(message.author).read_messages
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def _signs(vectors, words):
+    # (words, len(vectors)) uint64, the layout signs.u64 keeps
+    bits = np.packbits(vectors > 0, axis=1)
+    bits = np.pad(bits, ((0, 0), (0, words * 8 - bits.shape[1])))
+    return np.ascontiguousarray(bits.view(np.uint64).T)
+
+def _closest(distances, k):
+    # the k smallest distances, give or take ties. Distances are small integers so counting them
+    # finds the cutoff without sorting anything
+    counts = np.cumsum(np.bincount(distances))
+    cut = int(np.searchsorted(counts, k))
+    rows = np.flatnonzero(distances < cut)
+    ties = np.flatnonzero(distances == cut)[:k - len(rows)]
+    return np.concatenate((rows, ties))
+
+class GuildIndex:
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.dimensions = None
+        self.count = 0
+        self.next = 0
+        self.capacity = 0
+        self.vectors = self.signs = self.turns = None
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            self.dimensions = meta['dimensions']
+            self.count = meta['count']
+            self.next = meta['next']
+            # an index made with a bigger cap keeps it, lowering the setting only affects new ones
+            self.max_entries = max(max_entries, meta['capacity'])
+            self._map(meta['capacity'])
+            old_bits = os.path.join(path, _OLD_BITS)
+            if os.path.exists(old_bits):
+                os.remove(old_bits)
+
+    @property
+    def words(self):
+        # the search compares 64 dimensions at a time
+        return (self.dimensions + 63) // 64
+
+    def _map(self, capacity):
+        os.makedirs(self.path, exist_ok=True)
+        self.vectors = self._open('vectors.f32', np.float32, (capacity, self.dimensions))
+        self.turns = self._open('turns.i64', np.int64, (capacity,))
+        self.signs = self._map_signs(capacity)
+        self.capacity = capacity
+
+    def _open(self, name, dtype, shape):
+        file_path = os.path.join(self.path, name)
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if not os.path.exists(file_path) or os.path.getsize(file_path) < size:
+            # rows are fixed size, so growing the file keeps every existing row where it was
+            with open(file_path, 'ab') as f:
+                f.truncate(size)
+        return np.memmap(file_path, dtype=dtype, mode='r+', shape=shape)
+
+    def _map_signs(self, capacity):
+        # a column per exchange means every row moves when the index grows, so growing copies
+        # everything into a new file. That's only a few times per index, it grows in big steps
+        file_path = os.path.join(self.path, 'signs.u64')
+        shape = (self.words, capacity)
+        size = self.words * capacity * 8
+        if self.signs is None and os.path.exists(file_path) and os.path.getsize(file_path) == size:
+            return np.memmap(file_path, dtype=np.uint64, mode='r+', shape=shape)
+
+        with open(file_path + '.tmp', 'wb') as f:
+            f.truncate(size)
+        signs = np.memmap(file_path + '.tmp', dtype=np.uint64, mode='r+', shape=shape)
+        if self.signs is not None:
+            signs[:, :self.signs.shape[1]] = self.signs
+        else:
+            # an index from before signs.u64 existed, or one that was interrupted while growing
+            for start in range(0, self.count, 10_000):
+                end = min(start + 10_000, self.count)
+                signs[:, start:end] = _signs(self.vectors[start:end], self.words)
+        signs.flush()
+        os.replace(file_path + '.tmp', file_path)
+        return signs
+
+    def _save_meta(self):
+        meta_path = os.path.join(self.path, 'meta.json')
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump({'dimensions': self.dimensions, 'count': self.count, 'next': self.next, 'capacity': self.capacity}, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def reset(self, dimensions):
+        self.vectors = self.signs = self.turns = None
+        for name in _FILES:
+            file_path = os.path.join(self.path, name)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        self.dimensions = dimensions
+        self.count = self.next = self.capacity = 0
+
+    def add(self, turn_ids, vectors):
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        if vectors.shape[1] != self.dimensions:
+            if self.dimensions is not None:
+                # a different embedding model, the old vectors can't be compared with the new ones
+                logger.warning("Embedding size changed from %s to %s, starting %s over", self.dimensions, vectors.shape[1], self.path)
+            self.reset(vectors.shape[1])
+
+        needed = min(self.count + len(vectors), self.max_entries)
+        if needed > self.capacity:
+            # grow in big steps, every step means remapping the files
+            self._map(min(max(needed, self.capacity * 2, 1024), self.max_entries))
+
+        slots = (self.next + np.arange(len(vectors))) % self.max_entries
+        self.vectors[slots] = vectors
+        self.signs[:, slots] = _signs(vectors, self.words)
+        self.turns[slots] = turn_ids
+        for array in (self.vectors, self.signs, self.turns):
+            array.flush()
+        self.next = int((self.next + len(vectors)) % self.max_entries)
+        self.count = min(self.count + len(vectors), self.max_entries)
+        self._save_meta()
+
+    def forget(self, turn_ids):
+        # blank the rows instead of moving anything, the ring buffer overwrites them in time
+        if not self.count:
+            return 0
+        rows = np.flatnonzero(np.isin(self.turns[:self.count], turn_ids))
+        if len(rows):
+            self.vectors[rows] = 0
+            self.signs[:, rows] = 0
+            self.turns[rows] = -1
+            for array in (self.vectors, self.signs, self.turns):
+                array.flush()
+        return len(rows)
+
+    def search(self, query, k):
+        # query has to be unit length. Returns [(turn_id, cosine similarity)], best first
+        if not self.count or query.shape[0] != self.dimensions:
+            return []
+        n = self.count
+        vectors = self.vectors[:n]
+        if n * self.dimensions <= _EXACT_SEARCH_FLOATS or not hasattr(np, 'bitwise_count'):
+            turns = self.turns[:n]
+            scores = vectors @ query
+        else:
+            # hamming distance on the sign bits finds roughly the right rows, then only those get scored
+            distances = np.zeros(n, dtype=np.uint16)
+            for word, signs in zip(_signs(query[None, :], self.words)[:, 0], self.signs[:, :n]):
+                distances += np.bitwise_count(signs ^ word)
+            rows = _closest(distances, _SHORTLIST)
+            turns = self.turns[rows]
+            scores = vectors[rows] @ query
+        k = min(k, len(scores))
+        best = np.argpartition(scores, -k)[-k:]
+        best = best[np.argsort(scores[best])[::-1]]
+        return [(int(turns[i]), float(scores[i])) for i in best if turns[i] >= 0]
+
+class SemanticMemory:
+    def __init__(self, enabled, directory, model_name, max_entries, min_score, max_open=256):
+        self.enabled = enabled and np is not None and config.CONVERSATION_MEMORY
+        self.directory = directory
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.min_score = min_score
+        self._indexes = LRUCache(max_open)
+        self._pending = []
+        # numpy and the index files are only touched on this thread, the event loop just waits for it
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='evil_bot_memory')
+
+    @staticmethod
+    def scope(message):
+        if message.guild is not None:
+            return f"guild-{message.guild.id}"
+        return f"dm-{message.channel.id}"
+
+    def _index(self, scope):
+        index = self._indexes.get(scope)
+        if index is None:
+            index = GuildIndex(os.path.join(self.directory, scope), self.max_entries)
+            self._indexes.set(scope, index)
+        return index
+
+    def add(self, scope, turn_id, text):
+        # embedded in batches by run(), so saving a turn never waits on ollama
+        self._pending.append((scope, turn_id, text))
+
+    async def forget(self, scope, turn_ids):
+        # a deleted message shouldn't be remembered either
+        turn_ids = set(turn_ids)
+        self._pending = [entry for entry in self._pending if entry[1] not in turn_ids]
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._forget, scope, list(turn_ids))
+
+    def _forget(self, scope, turn_ids):
+        try:
+            self._index(scope).forget(turn_ids)
+        except (OSError, ValueError) as e:
+            logger.error("Error forgetting long term memory for %s: %s", scope, e, exc_info=True)
+
+    async def flush(self):
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            batch, self._pending = self._pending[:_BATCH_SIZE], self._pending[_BATCH_SIZE:]
+            try:
+                vectors = await backends.pool.embed(
+                    self.model_name, [text for _, _, text in batch], keep_alive=config.OLLAMA_KEEP_ALIVE
+                )
+            except Exception as e:
+                logger.warning("Couldn't embed %s exchanges for long term memory: %s", len(batch), e)
+                continue
+            by_scope = {}
+            for (scope, turn_id, _), vector in zip(batch, vectors):
+                turn_ids, scope_vectors = by_scope.setdefault(scope, ([], []))
+                turn_ids.append(turn_id)
+                scope_vectors.append(vector)
+            await loop.run_in_executor(self._executor, self._add, by_scope)
+            metrics.memory_indexed.inc(amount=len(batch))
+
+    def _add(self, by_scope):
+        for scope, (turn_ids, vectors) in by_scope.items():
+            try:
+                self._index(scope).add(turn_ids, vectors)
+            except (OSError, ValueError) as e:
+                logger.error("Error adding to long term memory for %s: %s", scope, e, exc_info=True)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(_FLUSH_INTERVAL)
+            await self.flush()
+
+    async def recall(self, message, text, k, exclude_ids=()):
+        # past exchanges most like text as (prompt, completion), best first. Anything from a message
+        # in exclude_ids is left out, it's already in the context, and so is anything from a channel
+        # the author can't see
+        if not text or k <= 0:
+            return []
+        loop = asyncio.get_running_loop()
+        with metrics.memory_search_seconds.time():
+            vectors = await asyncio.wait_for(
+                backends.pool.embed(self.model_name, [text], keep_alive=config.OLLAMA_KEEP_ALIVE),
+                timeout=_RECALL_TIMEOUT
+            )
+            # ask for extra, some of what comes back will be in the context already or off limits
+            matches = await loop.run_in_executor(self._executor, self._search, self.scope(message), vectors[0], k * 4)
+        if not matches:
+            return []
+        turns = await database.get_conversation_turns_async([turn_id for turn_id, _ in matches])
+        remembered = []
+        for turn_id, score in matches:
+            turn = turns.get(turn_id)
+            if turn is None or turn[1] in exclude_ids or not _readable(message, turn[0]):
+                continue
+            logger.debug("Remembered turn %s (score %.2f)", turn_id, score)
+            remembered.append(turn[2:])
+            if len(remembered) >= k:
+                break
+        return remembered
+
+    def _search(self, scope, vector, k):
+        index = self._index(scope)
+        query = _normalize(np.asarray([vector], dtype=np.float32))[0]
+        return [(turn_id, score) for turn_id, score in index.search(query, k) if score >= self.min_score]
+
+    async def close(self):
+        if self.enabled:
+            await self.flush()
+        self._executor.shutdown(wait=True)
+
+semantic_memory = SemanticMemory(
+    config.SEMANTIC_MEMORY,
+    config.SEMANTIC_MEMORY_DIR,
+    config.SEMANTIC_MEMORY_MODEL,
+    config.SEMANTIC_MEMORY_MAX_ENTRIES,
+    config.SEMANTIC_MEMORY_MIN_SCORE
+)
@@ -0,0 +1,185 @@
+import asyncio
+import bisect
+import contextlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger('evil_bot')
+
+# Bare bones Prometheus style metrics, served as plain text on METRICS_PORT.
+# Nothing fancy, just counters, gauges and histograms with optional labels.
+
+_registry = []
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _label_text(self, values, extra=None):
+        pairs = list(zip(self.labels, values))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            return [f"{self.name}{self._label_text(key)} {value}" for key, value in self._values.items()]
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), func=None):
+        super().__init__(name, help, labels)
+        self._values = {}
+        # gauges can also just read a value from somewhere else when scraped
+        self._func = func
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def _samples(self):
+        if self._func is not None:
+            return [f"{self.name} {self._func()}"]
+        with self._lock:
+            return [f"{self.name}{self._label_text(key)} {value}" for key, value in self._values.items()]
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # one slot per bucket plus +Inf, then the running sum
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def _samples(self):
+        lines = []
+        with self._lock:
+            for key, counts in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{self._label_text(key, ('le', bound))} {cumulative}")
+                lines.append(f"{self.name}_sum{self._label_text(key)} {counts[-1]}")
+                lines.append(f"{self.name}_count{self._label_text(key)} {cumulative}")
+        return lines
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+# Everything the response pipeline reports
+messages_seen = Counter('evil_bot_messages_total', "Messages seen by on_message, by why we did or didn't respond", ['outcome'])
+commands_run = Counter('evil_bot_commands_total', "Commands processed")
+errors = Counter('evil_bot_errors_total', "Errors while responding, by stage", ['stage'])
+db_lookup_seconds = Histogram('evil_bot_db_lookup_seconds', "Time to load guild settings in should_respond")
+history_fetch_seconds = Histogram('evil_bot_history_fetch_seconds', "Time to gather message history for context")
+queue_wait_seconds = Histogram('evil_bot_queue_wait_seconds', "Time a generation waited for a slot", ['priority'])
+first_token_seconds = Histogram('evil_bot_first_token_seconds', "Time from starting a generation to the first token", ['model'])
+generation_seconds = Histogram('evil_bot_generation_seconds', "Total generation time", ['model'])
+rate_limited = Counter('evil_bot_rate_limited_total', "Responses refused by a rate limit, by which limit", ['scope'])
+generations_coalesced = Counter('evil_bot_generations_coalesced_total', "Responses that reused a generation already in flight")
+messages_debounced = Counter('evil_bot_messages_debounced_total', "Triggers dropped because a newer one came in during the debounce window")
+generations_cancelled = Counter('evil_bot_generations_cancelled_total', "Generations cancelled before they finished, by why", ['why'])
+generations_shed = Counter('evil_bot_generations_shed_total', "Generations dropped because the queue was full")
+response_cache_lookups = Counter('evil_bot_response_cache_lookups_total', "Response cache lookups, by result", ['result'])
+prompt_tokens = Counter('evil_bot_prompt_tokens_total', "Estimated prompt tokens sent to ollama", ['model'])
+prompt_eval_tokens = Counter('evil_bot_prompt_eval_tokens_total', "Prompt tokens ollama actually evaluated, the rest came from its cache", ['model'])
+prompt_eval_seconds = Histogram('evil_bot_prompt_eval_seconds', "Time ollama spent evaluating the prompt", ['model'])
+backend_healthy = Gauge('evil_bot_backend_healthy', "Whether each Ollama host is taking requests", ['host'])
+backend_requests = Counter('evil_bot_backend_requests_total', "Generations started on each Ollama host, by result", ['host', 'result'])
+memory_search_seconds = Histogram('evil_bot_memory_search_seconds', "Time to embed a message and search its guild's long term memory")
+memory_indexed = Counter('evil_bot_memory_indexed_total', "Exchanges added to long term memory")
+discord_send_seconds = Histogram('evil_bot_discord_send_seconds', "Time for a single Discord send or edit", ['kind'])
+
+class MetricsServer:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info("Metrics available at http://%s:%s/metrics", self.host, self.port)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            # skip the headers, we don't care about any of them
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode(errors='replace').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] in ('/metrics', '/'):
+                body = render().encode()
+                status = '200 OK'
+            else:
+                body = b'not found\n'
+                status = '404 Not Found'
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.error("Error serving metrics: %s", e, exc_info=True)
+        finally:
+            writer.close()
@@ -0,0 +1,147 @@
+import functools
+import re
+import config
+from cache import LRUCache
+
+# Builds the message list we send to ollama. Instead of a fixed number of messages the history
+# gets as much of CONTEXT_TOKEN_BUDGET as is left after the system prompt and the new message.
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+# roughly what the chat template adds around every message
+MESSAGE_OVERHEAD = 4
+# share of the budget the new message always gets, a huge persona gets cut down before the message does
+MIN_MESSAGE_SHARE = 4
+
+# oldest message id in each channel's current window
+_anchors = LRUCache(config.HISTORY_CACHE_CHANNELS)
+
+# Not a real tokenizer, but close enough for budgeting: every word or symbol is a token and long
+# words get split like BPE would. Cached because the same messages get counted on every turn.
+@functools.lru_cache(maxsize=8192)
+def estimate_tokens(text):
+    return sum(1 + len(piece) // 7 for piece in _TOKEN_RE.findall(text))
+
+def message_tokens(message):
+    return estimate_tokens(message['content']) + MESSAGE_OVERHEAD
+
+def truncate_to_tokens(text, tokens, keep_start=False):
+    # keeps the end of the text by default since that's the part closest to the new message,
+    # keep_start is for system prompts where the start is what sets everything up
+    if estimate_tokens(text) <= tokens:
+        return text
+    pieces = list(_TOKEN_RE.finditer(text))
+    used = 0
+    for match in (pieces if keep_start else reversed(pieces)):
+        used += 1 + len(match.group()) // 7
+        if used > tokens:
+            return text[:match.start()].rstrip() if keep_start else text[match.end():].lstrip()
+    return text
+
+def _pick_window(history, limit, budget):
+    # newest entries that fit, oldest dropped first. Returns them newest first
+    picked = []
+    used = 0
+    for entry in history:
+        cost = message_tokens(entry)
+        if len(picked) >= limit or used + cost > budget:
+            break
+        used += cost
+        picked.append(entry)
+    return picked
+
+def add_turns(history, turns):
+    # history is newest first, turns are stored exchanges (message_id, prompt, completion) newest first.
+    # Whatever is older than the oldest thing in history gets added on, so the conversation reaches
+    # further back than the history cache without asking discord for more
+    oldest = history[-1]['id'] if history else None
+    # the window can start on one of our replies with the message it answered cut off
+    replies = {entry['content'] for entry in history if entry['role'] == 'assistant'}
+    merged = list(history)
+    for message_id, user_prompt, completion in turns:
+        if oldest is not None and message_id >= oldest:
+            continue
+        if completion not in replies:
+            # we don't keep the reply's own id, anything between the two messages sorts it in the right place
+            merged.append({'id': message_id + 1, 'role': 'assistant', 'content': completion})
+        merged.append({'id': message_id, 'role': 'user', 'content': user_prompt})
+    return merged
+
+def _memory_note(memories, budget):
+    # as many remembered exchanges as fit, best first
+    lines = ["Earlier conversations you remember, use them if they matter here:"]
+    added = 0
+    for user_prompt, completion in memories:
+        candidate = lines + [f"Someone said: {user_prompt}", f"You said: {completion}"]
+        if estimate_tokens('\n'.join(candidate)) + MESSAGE_OVERHEAD > budget:
+            break
+        lines = candidate
+        added += 1
+    if not added:
+        return None
+    return {'role': 'system', 'content': '\n'.join(lines)}
+
+def build_context(system_prompt, history, content, replied=None, budget=None, channel_id=None, memories=None):
+    # history is newest first like channel.history(), each entry is {'id', 'role', 'content'}.
+    # replied is the message being replied to in the same shape, or None. memories are past
+    # exchanges from long term memory as (prompt, completion), they get whatever budget is left
+    if budget is None:
+        budget = config.CONTEXT_TOKEN_BUDGET
+
+    system = {'role': 'system', 'content': system_prompt}
+    current = {'role': 'user', 'content': content}
+    used = message_tokens(system) + message_tokens(current)
+
+    # the new message always goes in, even if we have to cut the start of it off. It gets at least
+    # 1/MIN_MESSAGE_SHARE of the budget, if the system prompt doesn't leave that much it's cut instead
+    if used > budget:
+        message_room = max(budget - message_tokens(system), budget // MIN_MESSAGE_SHARE)
+        current['content'] = truncate_to_tokens(content, max(message_room - MESSAGE_OVERHEAD, 0))
+        system_room = budget - message_tokens(current)
+        if message_tokens(system) > system_room:
+            system['content'] = truncate_to_tokens(system_prompt, max(system_room - MESSAGE_OVERHEAD, 0), keep_start=True)
+        used = message_tokens(system) + message_tokens(current)
+
+    # the replied to message is pinned, it goes in even if it's older than the history we'd keep
+    pinned = []
+    if replied is not None:
+        cost = message_tokens(replied)
+        if used + cost <= budget:
+            used += cost
+            pinned.append(replied)
+
+    history = [entry for entry in history if replied is None or entry['id'] != replied['id']]
+    room = budget - used
+    limit = config.MAX_CONTEXT_MESSAGES
+
+    # ollama can reuse its cache for whatever prefix matches the last request, so instead of sliding
+    # the window one message every turn it stays anchored at the same oldest message. Once it's full
+    # it jumps forward to half size, which only costs one full prompt eval every few turns
+    anchor = _anchors.get(channel_id) if channel_id is not None else None
+    picked = None
+    if anchor is not None:
+        window = [entry for entry in history if entry['id'] >= anchor]
+        # if the anchor itself isn't in what we were given, messages after it may have fallen off already
+        covered = len(window) < len(history) or any(entry['id'] == anchor for entry in window)
+        if window and covered and len(window) < limit and sum(map(message_tokens, window)) <= room:
+            picked = window
+    if picked is None:
+        picked = _pick_window(history, limit if channel_id is None else max(1, limit // 2), room if channel_id is None else room // 2)
+        if channel_id is not None and picked:
+            _anchors.set(channel_id, picked[-1]['id'])
+
+    # discord ids go up over time so sorting by them puts everything back in chronological order.
+    # a replied to message older than the window goes right before the new message so the prefix stays the same
+    ordered = sorted(picked, key=lambda entry: entry['id'])
+    if pinned and ordered and pinned[0]['id'] > ordered[0]['id']:
+        ordered = sorted(ordered + pinned, key=lambda entry: entry['id'])
+    else:
+        ordered.extend(pinned)
+    context = [system]
+    context.extend({'role': entry['role'], 'content': entry['content']} for entry in ordered)
+    # memories change with every message, right before it is the only place they don't break the cached prefix
+    if memories:
+        note = _memory_note(memories, room - sum(map(message_tokens, picked)))
+        if note is not None:
+            context.append(note)
+    context.append(current)
+    return context
@@ -0,0 +1,107 @@
+import contextlib
+import logging
+import time
+import config
+import metrics
+from cache import LRUCache
+
+logger = logging.getLogger('evil_bot')
+
+# Token buckets per user, channel and guild so one person (or one raid) can't keep the GPU busy.
+# Buckets live in bounded LRU caches, an idle key falling out is the same as it having a full bucket.
+
+class TokenBucket:
+    def __init__(self, per_minute, burst, max_keys):
+        self.rate = per_minute / 60.0
+        self.burst = max(1, burst)
+        self._buckets = LRUCache(max_keys)
+
+    def _level(self, key, now):
+        state = self._buckets.get(key)
+        if state is None:
+            return self.burst
+        tokens, updated = state
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def available(self, key, now=None):
+        if not self.rate:
+            return True
+        return self._level(key, now or time.monotonic()) >= 1
+
+    def take(self, key, now=None):
+        if not self.rate:
+            return True
+        now = now or time.monotonic()
+        tokens = self._level(key, now)
+        if tokens < 1:
+            return False
+        self._buckets.set(key, (tokens - 1, now))
+        return True
+
+class RateLimiter:
+    def __init__(self, user, channel, guild, max_pending, max_keys):
+        self.scopes = [
+            ('user', TokenBucket(user[0], user[1], max_keys)),
+            ('channel', TokenBucket(channel[0], channel[1], max_keys)),
+            ('guild', TokenBucket(guild[0], guild[1], max_keys))
+        ]
+        self.max_pending = max_pending
+        self.pending = 0
+        # when we last told each user they were throttled, so we don't react to every single message
+        self._notified = LRUCache(max_keys)
+
+    @staticmethod
+    def _keys(message):
+        guild_id = message.guild.id if message.guild is not None else None
+        return {'user': message.author.id, 'channel': message.channel.id, 'guild': guild_id}
+
+    def throttled(self, message):
+        # returns which limit a message is over, or None. Doesn't use anything up, so it's safe to call
+        # before we even know whether we'd respond
+        if self.max_pending and self.pending >= self.max_pending:
+            return 'global'
+        keys = self._keys(message)
+        now = time.monotonic()
+        for scope, bucket in self.scopes:
+            if keys[scope] is not None and not bucket.available(keys[scope], now):
+                return scope
+        return None
+
+    def consume(self, message):
+        scope = self.throttled(message)
+        if scope is not None:
+            metrics.rate_limited.inc(scope)
+            return scope
+        keys = self._keys(message)
+        now = time.monotonic()
+        for scope, bucket in self.scopes:
+            if keys[scope] is not None:
+                bucket.take(keys[scope], now)
+        return None
+
+    def should_notify(self, message):
+        # one reaction per user per window is plenty
+        now = time.monotonic()
+        last = self._notified.get(message.author.id)
+        if last is not None and now - last < config.RATE_LIMIT_NOTIFY_INTERVAL:
+            return False
+        self._notified.set(message.author.id, now)
+        return True
+
+    @contextlib.asynccontextmanager
+    async def hold(self):
+        self.pending += 1
+        try:
+            yield
+        finally:
+            self.pending -= 1
+
+limiter = RateLimiter(
+    (config.USER_RATE_LIMIT, config.USER_RATE_BURST),
+    (config.CHANNEL_RATE_LIMIT, config.CHANNEL_RATE_BURST),
+    (config.GUILD_RATE_LIMIT, config.GUILD_RATE_BURST),
+    config.MAX_PENDING_RESPONSES,
+    config.RATE_LIMIT_KEYS
+)
+
+metrics.Gauge('evil_bot_pending_responses', "Responses being prepared or generated right now", func=lambda: limiter.pending)
@@ -0,0 +1,108 @@
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import re
+import time
+import config
+import database
+import metrics
+from cache import LRUCache
+
+logger = logging.getLogger('evil_bot')
+
+_WHITESPACE = re.compile(r'\s+')
+
+class _Entry:
+    __slots__ = ('completions', 'served_at')
+
+    def __init__(self, completions):
+        # list of (completion, created_at), oldest first
+        self.completions = list(completions)
+        # when each guild (or DM) last got served from this entry
+        self.served_at = {}
+
+# Caches finished completions so people spamming the same thing don't cost us GPU time on every message.
+# The key is the model and its options, persona, guild (or DM) and the message itself plus whatever it
+# replied to, not the rest of the history, which changes with every message and would mean spam never hits. Keeps up to
+# RESPONSE_CACHE_VARIANTS different completions per key and picks one at random so it doesn't look canned,
+# while there are fewer than that it only serves some of the time and generates the rest to fill up.
+class ResponseCache:
+    def __init__(self, max_size, ttl, variants, persist):
+        self.ttl = ttl
+        self.variants = max(1, variants)
+        self.persist = persist
+        self._entries = LRUCache(max_size)
+
+    @staticmethod
+    def make_key(model_name, system_prompt, scope, content, replied=None, options=None):
+        # case and whitespace don't change what we'd answer, so they don't change the key either. The
+        # generation options do, an answer from before !model tokens 50 could be far too long
+        digest = hashlib.sha256(model_name.encode())
+        digest.update(b'\x00' + json.dumps(options or {}, sort_keys=True).encode())
+        for part in (str(scope), system_prompt, content, replied or ''):
+            digest.update(b'\x00' + _WHITESPACE.sub(' ', part).strip().lower().encode())
+        return digest.hexdigest()
+
+    async def lookup(self, key, scope, min_interval=0):
+        entry = await self._load(key)
+        if entry is None or random.random() * self.variants >= len(entry.completions):
+            metrics.response_cache_lookups.inc('miss')
+            return None
+
+        now = time.time()
+        last_served = entry.served_at.get(scope)
+        if min_interval and last_served is not None and now - last_served < min_interval:
+            logger.debug("Cached response for %s served too recently, generating a new one", scope)
+            metrics.response_cache_lookups.inc('too_soon')
+            return None
+
+        entry.served_at[scope] = now
+        metrics.response_cache_lookups.inc('hit')
+        return random.choice(entry.completions)[0]
+
+    async def store(self, key, completion):
+        if not completion.strip():
+            return
+        now = time.time()
+        entry = await self._load(key)
+        if entry is None:
+            entry = _Entry([])
+            self._entries.set(key, entry)
+        entry.completions.append((completion, now))
+        # only keep the newest variants
+        del entry.completions[:-self.variants]
+        if self.persist:
+            await database.save_cached_response_async(key, completion, now)
+
+    async def prune_periodically(self, interval=3600):
+        while True:
+            await asyncio.sleep(interval)
+            removed = await database.prune_cached_responses_async(time.time() - self.ttl)
+            if removed:
+                logger.info("Pruned %s expired responses from the response cache", removed)
+
+    async def _load(self, key):
+        entry = self._entries.get(key)
+        if entry is None and self.persist:
+            rows = await database.load_cached_responses_async(key, time.time() - self.ttl)
+            if rows:
+                entry = _Entry(rows[-self.variants:])
+                self._entries.set(key, entry)
+        if entry is None:
+            return None
+
+        cutoff = time.time() - self.ttl
+        entry.completions = [c for c in entry.completions if c[1] > cutoff]
+        if not entry.completions:
+            self._entries.pop(key)
+            return None
+        return entry
+
+response_cache = ResponseCache(
+    config.RESPONSE_CACHE_SIZE,
+    config.RESPONSE_CACHE_TTL,
+    config.RESPONSE_CACHE_VARIANTS,
+    config.RESPONSE_CACHE_PERSIST
+)
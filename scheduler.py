@@ -0,0 +1,206 @@
+import asyncio
+import contextlib
+import itertools
+import logging
+import time
+import metrics
+import config
+
+logger = logging.getLogger('evil_bot')
+
+# lower number gets served first within a guild
+PRIORITY_DIRECT = 0   # mentions, replies to the bot and DMs
+PRIORITY_TRIGGER = 1  # trigger words
+PRIORITY_RANDOM = 2   # random rolls, these are the first to get dropped when we're busy
+
+REASON_PRIORITIES = {
+    'dm': PRIORITY_DIRECT,
+    'mention': PRIORITY_DIRECT,
+    'reply': PRIORITY_DIRECT,
+    'trigger': PRIORITY_TRIGGER,
+    'random': PRIORITY_RANDOM
+}
+
+class QueueFullError(Exception):
+    pass
+
+class _Ticket:
+    __slots__ = ('key', 'user_id', 'priority', 'user_rank', 'seq', 'future', 'enqueued_at', 'granted_at')
+
+    def __init__(self, key, user_id, priority, user_rank, seq, future):
+        self.key = key
+        self.user_id = user_id
+        self.priority = priority
+        self.user_rank = user_rank
+        self.seq = seq
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.granted_at = None
+
+    def sort_key(self):
+        # a users second request goes behind everyone elses first one in the same guild
+        return (self.priority, self.user_rank, self.seq)
+
+class _Bucket:
+    def __init__(self, key, weight, pass_value):
+        self.key = key
+        self.weight = weight
+        self.pass_value = pass_value
+        self.tickets = []
+        self.user_counts = {}
+
+    def best(self):
+        return min(self.tickets, key=_Ticket.sort_key)
+
+    def worst(self):
+        return max(self.tickets, key=_Ticket.sort_key)
+
+# Sits in front of ollama and hands out generation slots. Every guild (and every DM user) gets its own
+# queue and queues take turns using stride scheduling, so one spammy guild can't starve everyone else.
+# Inside a guild, direct mentions/replies beat trigger words which beat random rolls.
+class GenerationScheduler:
+    def __init__(self, capacity, max_queue, max_guild_queue, dm_weight=1.0):
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.max_guild_queue = max_guild_queue
+        self.dm_weight = dm_weight
+        self.in_flight = 0
+        self.queued = 0
+        self.shed = 0
+        self.last_wait = 0.0
+        self._buckets = {}
+        self._virtual_time = 0.0
+        self._seq = itertools.count()
+
+    @staticmethod
+    def queue_key(message):
+        if message.guild is None:
+            return ('dm', message.author.id)
+        return ('guild', message.guild.id)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, key, user_id, priority=PRIORITY_DIRECT):
+        wait = await self.acquire(key, user_id, priority)
+        try:
+            yield wait
+        finally:
+            self.release()
+
+    async def acquire(self, key, user_id, priority=PRIORITY_DIRECT):
+        if self.in_flight < self.capacity and not self.queued:
+            self.in_flight += 1
+            self.last_wait = 0.0
+            metrics.queue_wait_seconds.observe(0.0, str(priority))
+            return 0.0
+
+        ticket = self._enqueue(key, user_id, priority)
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.granted_at is not None:
+                # we got the slot right as we were cancelled, give it back
+                self.release()
+            else:
+                self._remove(ticket)
+            raise
+
+        wait = ticket.granted_at - ticket.enqueued_at
+        self.last_wait = wait
+        metrics.queue_wait_seconds.observe(wait, str(priority))
+        if wait > 1:
+            logger.info("Generation for %s waited %.2fs in queue", key, wait)
+        return wait
+
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'active_queues': len(self._buckets),
+            'shed': self.shed,
+            'last_wait': self.last_wait
+        }
+
+    def _enqueue(self, key, user_id, priority):
+        bucket = self._buckets.get(key)
+        if bucket is not None and len(bucket.tickets) >= self.max_guild_queue:
+            self._shed_from(bucket, priority)
+        elif self.queued >= self.max_queue:
+            worst_bucket = max(self._buckets.values(), key=lambda b: b.worst().sort_key())
+            self._shed_from(worst_bucket, priority)
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            weight = self.dm_weight if key[0] == 'dm' else 1.0
+            # new queues start at the current virtual time so they can't cash in on being idle
+            bucket = _Bucket(key, weight, self._virtual_time)
+            self._buckets[key] = bucket
+
+        user_rank = bucket.user_counts.get(user_id, 0)
+        bucket.user_counts[user_id] = user_rank + 1
+        ticket = _Ticket(key, user_id, priority, user_rank, next(self._seq), asyncio.get_running_loop().create_future())
+        bucket.tickets.append(ticket)
+        self.queued += 1
+        logger.debug("Queued generation for %s (priority %s, %s waiting)", key, priority, self.queued)
+        return ticket
+
+    def _shed_from(self, bucket, priority):
+        # make room by dropping the least important request, unless the new one is even less important
+        worst = bucket.worst()
+        if worst.priority <= priority:
+            self.shed += 1
+            metrics.generations_shed.inc()
+            logger.warning("Generation queue full, rejecting request for %s", bucket.key)
+            raise QueueFullError(f"Generation queue is full for {bucket.key}")
+        logger.warning("Generation queue full, shedding queued request for %s", worst.key)
+        self.shed += 1
+        metrics.generations_shed.inc()
+        self._remove(worst)
+        worst.future.set_exception(QueueFullError(f"Shed from the generation queue for {worst.key}"))
+
+    def _remove(self, ticket):
+        bucket = self._buckets.get(ticket.key)
+        if bucket is None or ticket not in bucket.tickets:
+            return
+        bucket.tickets.remove(ticket)
+        self.queued -= 1
+        self._forget_user(bucket, ticket.user_id)
+        if not bucket.tickets:
+            del self._buckets[ticket.key]
+
+    def _forget_user(self, bucket, user_id):
+        count = bucket.user_counts.get(user_id, 0) - 1
+        if count > 0:
+            bucket.user_counts[user_id] = count
+        else:
+            bucket.user_counts.pop(user_id, None)
+
+    def _dispatch(self):
+        while self.in_flight < self.capacity and self.queued:
+            # whichever queue has had the least service goes next, priorities only order requests inside
+            # a queue so a guild spamming mentions can't push everyone else's trigger words back
+            bucket = min(self._buckets.values(), key=lambda b: b.pass_value)
+            ticket = bucket.best()
+            self._remove(ticket)
+            self._virtual_time = bucket.pass_value
+            bucket.pass_value += 1.0 / bucket.weight
+
+            if ticket.future.done():
+                continue
+            ticket.granted_at = time.monotonic()
+            self.in_flight += 1
+            ticket.future.set_result(None)
+
+# every ollama host gets its own OLLAMA_MAX_CONCURRENCY slots
+scheduler = GenerationScheduler(
+    config.OLLAMA_MAX_CONCURRENCY * max(1, len(config.OLLAMA_HOSTS)),
+    config.SCHEDULER_MAX_QUEUE,
+    config.SCHEDULER_MAX_GUILD_QUEUE,
+    config.SCHEDULER_DM_WEIGHT
+)
+
+metrics.Gauge('evil_bot_generations_in_flight', "Generations currently running", func=lambda: scheduler.in_flight)
+metrics.Gauge('evil_bot_generation_queue_depth', "Generations waiting for a slot", func=lambda: scheduler.queued)
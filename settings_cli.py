@@ -0,0 +1,106 @@
+import argparse
+import json
+import sys
+import database
+from log import setup_logging, stop_logging
+
+# Reads and writes server settings straight from the database, for scripts and dashboards:
+#   python settings_cli.py export > settings.json
+#   python settings_cli.py import settings.json
+#   python settings_cli.py set 1234 random_response_chance 25
+# A running bot picks changes up once its cached copy is gone, or right away with SETTINGS_SYNC_INTERVAL set.
+
+def parse_value(value):
+    # JSON where it parses (numbers, true/false, null, lists), plain text otherwise
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+def export_command(args):
+    rows = database.export_settings(args.server_ids or None)
+    if rows is None:
+        return 1
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        json.dump(rows, out, indent=2)
+        out.write('\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+def import_command(args):
+    if args.file == '-':
+        rows = json.load(sys.stdin)
+    else:
+        with open(args.file) as f:
+            rows = json.load(f)
+    if isinstance(rows, dict):
+        rows = [rows]
+    try:
+        count = database.import_settings(rows)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    if count is None:
+        return 1
+    print(f"Imported settings for {count} servers")
+    return 0
+
+def get_command(args):
+    settings = database.get_server_settings(args.server_id)
+    if settings is None:
+        return 1
+    json.dump(settings, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0
+
+def set_command(args):
+    if args.setting not in database.SETTINGS_COLUMNS and args.setting != 'trigger_words':
+        print(f"Error: unknown setting {args.setting}, pick one of "
+              f"{', '.join(database.SETTINGS_COLUMNS + ('trigger_words',))}", file=sys.stderr)
+        return 1
+    try:
+        count = database.import_settings([{'server_id': args.server_id, args.setting: parse_value(args.value)}])
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    return 0 if count else 1
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Bulk read and write Evil Bot server settings")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help="write settings as JSON")
+    export_parser.add_argument('server_ids', type=int, nargs='*', help="only these servers, default is all")
+    export_parser.add_argument('-o', '--output', help="file to write, default is stdout")
+    export_parser.set_defaults(func=export_command)
+
+    import_parser = subparsers.add_parser('import', help="apply settings from a JSON file in one transaction")
+    import_parser.add_argument('file', help="JSON list of settings like export writes, - for stdin")
+    import_parser.set_defaults(func=import_command)
+
+    get_parser = subparsers.add_parser('get', help="show one server's settings")
+    get_parser.add_argument('server_id', type=int)
+    get_parser.set_defaults(func=get_command)
+
+    set_parser = subparsers.add_parser('set', help="change one setting for one server")
+    set_parser.add_argument('server_id', type=int)
+    set_parser.add_argument('setting')
+    set_parser.add_argument('value', help="JSON value, text that isn't JSON is used as is (quote numbers meant as text)")
+    set_parser.set_defaults(func=set_command)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    setup_logging()
+    try:
+        database.init_db()
+        return args.func(args)
+    finally:
+        database.close_connection()
+        stop_logging()
+
+if __name__ == "__main__":
+    sys.exit(main())
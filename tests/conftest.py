@@ -0,0 +1,27 @@
+import pytest
+import config
+import database
+import prompt
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    # a fresh database file for every test. Both the test's thread and the db thread keep a connection
+    # open, close them so they reconnect to the new file
+    monkeypatch.setattr(config, 'DATABASE_NAME', str(tmp_path / 'bot_settings.db'))
+    database.close_connection()
+    database._db_executor.submit(database.close_connection).result()
+    database._server_cache.clear()
+    yield tmp_path / 'bot_settings.db'
+    # a flush scheduled on a test's event loop would never run once that loop is gone
+    if database._flush_handle is not None:
+        database._flush_handle.cancel()
+        database._flush_handle = None
+    database._pending.clear()
+    database.close_connection()
+    database._db_executor.submit(database.close_connection).result()
+    database._server_cache.clear()
+
+@pytest.fixture(autouse=True)
+def fresh_anchors():
+    # context windows are anchored per channel across calls, don't let that leak between tests
+    prompt._anchors.clear()
@@ -0,0 +1,171 @@
+import asyncio
+import json
+import sqlite3
+import pytest
+import config
+import database
+
+def make_baseline_db(path, rows):
+    # the schema the first release created, trigger words as a JSON list and every column filled in
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE server_settings (
+            server_id INTEGER PRIMARY KEY,
+            system_prompt TEXT NOT NULL,
+            trigger_words TEXT NOT NULL,
+            random_responses_enabled BOOLEAN NOT NULL,
+            random_response_chance INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('CREATE TABLE dm_settings (user_id INTEGER PRIMARY KEY, system_prompt TEXT NOT NULL)')
+    conn.executemany(
+        'INSERT INTO server_settings VALUES (?, ?, ?, ?, ?)',
+        [(server_id, prompt, json.dumps(words), enabled, chance) for server_id, prompt, words, enabled, chance in rows]
+    )
+    conn.execute("INSERT INTO dm_settings VALUES (42, 'be nice in DMs')")
+    conn.commit()
+    conn.close()
+
+def default_row(server_id):
+    return (server_id, config.DEFAULT_PERSONA, list(config.DEFAULT_TRIGGER_WORDS), config.DEFAULT_RANDOM_ENABLED, config.DEFAULT_RANDOM_CHANCE)
+
+def test_baseline_database_migrates_to_sparse_rows(db):
+    make_baseline_db(db, [
+        default_row(1),
+        (2, "be nice", list(config.DEFAULT_TRIGGER_WORDS), config.DEFAULT_RANDOM_ENABLED, 50),
+        (3, config.DEFAULT_PERSONA, ["foo", "bar"], config.DEFAULT_RANDOM_ENABLED, config.DEFAULT_RANDOM_CHANCE)
+    ])
+    database.init_db()
+
+    assert database.export_settings() == [
+        {'server_id': 2, 'system_prompt': "be nice", 'random_response_chance': 50},
+        {'server_id': 3, 'trigger_words': ["foo", "bar"]}
+    ]
+    assert database.get_server_settings(1) == database._default_settings()
+    settings = database.get_server_settings(3)
+    assert settings['trigger_words'] == ["foo", "bar"]
+    assert settings['system_prompt'] == config.DEFAULT_PERSONA
+    assert database.get_dm_prompt(42) == "be nice in DMs"
+
+    conn = sqlite3.connect(db)
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(server_settings)')}
+    assert 'trigger_words' not in columns and 'custom_triggers' in columns
+    assert conn.execute('SELECT server_id FROM server_settings ORDER BY server_id').fetchall() == [(2,), (3,)]
+    assert conn.execute('SELECT DISTINCT server_id FROM trigger_words').fetchall() == [(3,)]
+    conn.close()
+
+    # running it again changes nothing
+    database.init_db()
+    assert len(database.export_settings()) == 2
+
+def test_reads_never_write(db):
+    database.init_db()
+    conn = database.create_connection()
+    before = conn.total_changes
+    assert database.get_server_settings(123) == database._default_settings()
+    assert conn.total_changes == before
+    assert database.export_settings() == []
+
+def test_back_on_defaults_drops_the_row(db):
+    database.init_db()
+    assert database.set_random_chance(5, 30)
+    assert database.add_trigger_word(5, "spooky")
+    assert "spooky" in database.get_server_settings(5)['trigger_words']
+    assert database.reset_server_settings(5)
+    assert database.export_settings() == []
+    assert database.get_server_settings(5) == database._default_settings()
+
+def test_import_checks_values(db):
+    database.init_db()
+    for row in (
+        {'server_id': 1, 'system_prompt': 42},
+        {'server_id': 1, 'random_response_chance': 0},
+        {'server_id': 1, 'num_predict': 9000},
+        {'server_id': 1, 'num_predict': True},
+        {'server_id': 1, 'trigger_words': "evil"},
+        {'server_id': 1, 'no_such_setting': 1}
+    ):
+        with pytest.raises(ValueError):
+            database.import_settings([row])
+    assert database.export_settings() == []
+    assert database.import_settings([{'server_id': 1, 'num_predict': 200, 'temperature': 1}]) == 1
+    assert database.export_settings() == [{'server_id': 1, 'num_predict': 200, 'temperature': 1}]
+
+def test_bad_import_leaves_nothing_behind(db):
+    database.init_db()
+    for bad in ({'server_id': "abc"}, {'server_id': True}, {'server_id': 2, 'random_response_chance': 500}):
+        with pytest.raises(ValueError):
+            database.import_settings([{'server_id': 1, 'system_prompt': "hi"}, bad])
+    # an unrelated write mustn't commit half of a failed import
+    assert database.set_random_chance(5, 50)
+    assert database.export_settings() == [{'server_id': 5, 'random_response_chance': 50}]
+
+def test_import_rolls_back_on_any_error(db, monkeypatch):
+    database.init_db()
+    apply_settings = database._apply_settings
+
+    def fail_on_second(c, server_id, changes, trigger_ops):
+        if server_id == 2:
+            raise RuntimeError("boom")
+        apply_settings(c, server_id, changes, trigger_ops)
+
+    monkeypatch.setattr(database, '_apply_settings', fail_on_second)
+    with pytest.raises(RuntimeError):
+        database.import_settings([{'server_id': 1, 'system_prompt': "hi"}, {'server_id': 2, 'system_prompt': "hey"}])
+    monkeypatch.setattr(database, '_apply_settings', apply_settings)
+    assert database.set_random_chance(5, 50)
+    assert database.export_settings() == [{'server_id': 5, 'random_response_chance': 50}]
+
+def test_deferred_writes_land_together(db, monkeypatch):
+    monkeypatch.setattr(config, 'SETTINGS_FLUSH_INTERVAL', 0.01)
+    database.init_db()
+
+    async def scenario():
+        await database.set_random_chance_async(7, 30)
+        await database.add_trigger_word_async(7, "spooky")
+        # reads see it straight away, the database once the batch is flushed
+        assert (await database.get_server_settings_async(7))['random_response_chance'] == 30
+        await asyncio.sleep(0.1)
+        return await database.export_settings_async()
+
+    rows = asyncio.run(scenario())
+    assert rows == [{'server_id': 7, 'random_response_chance': 30, 'trigger_words': list(config.DEFAULT_TRIGGER_WORDS) + ["spooky"]}]
+
+def test_flush_drops_settings_cached_before_it(db):
+    database.init_db()
+    database.set_random_chance(8, 40, defer=False)
+
+    async def scenario():
+        database.set_random_chance(8, 60, defer=True)
+    asyncio.run(scenario())
+    # a read that raced the queued write cached what was stored before it
+    stale = database._default_settings()
+    stale['random_response_chance'] = 40
+    database._server_cache.set(8, stale)
+
+    database.flush_settings()
+    assert database.get_server_settings(8)['random_response_chance'] == 60
+
+def test_changes_right_after_startup_are_polled(db):
+    database.init_db()
+    assert database.get_server_settings(9)['random_response_chance'] == config.DEFAULT_RANDOM_CHANCE
+    # another process changes the guild before our first poll
+    conn = sqlite3.connect(db)
+    conn.execute('INSERT INTO server_settings (server_id, random_response_chance) VALUES (9, 77)')
+    conn.execute('INSERT INTO settings_changes (server_id, origin, changed_at) VALUES (9, -1, 0)')
+    conn.commit()
+    conn.close()
+    assert database.poll_settings_changes() == 1
+    assert database.get_server_settings(9)['random_response_chance'] == 77
+
+def test_conversation_turn_ids_are_never_reused(db):
+    database.init_db()
+    turn = {
+        'channel_id': 1, 'guild_id': 2, 'user_id': 3, 'message_id': 10, 'prompt': "hi", 'completion': "go away",
+        'model_name': "llama3", 'prompt_tokens': 5, 'completion_tokens': 2, 'latency': 0.5, 'created_at': 1.0
+    }
+    first = database.save_conversation_turn(turn)
+    assert database.forget_conversation_turn(1, 10) == [first]
+    second = database.save_conversation_turn(dict(turn, message_id=11))
+    assert second > first
+    assert database.get_conversation_turns([first, second]) == {second: (1, 11, "hi", "go away")}
@@ -0,0 +1,65 @@
+import os
+import pytest
+
+np = pytest.importorskip('numpy')
+import memory
+from memory import GuildIndex
+
+DIMENSIONS = 96
+
+@pytest.fixture(autouse=True)
+def bit_search(monkeypatch):
+    # the sign bit pass normally only starts at millions of floats, use it for everything here
+    monkeypatch.setattr(memory, '_EXACT_SEARCH_FLOATS', 0)
+
+def random_vectors(count, seed=1):
+    return np.random.default_rng(seed).standard_normal((count, DIMENSIONS), dtype=np.float32)
+
+def best_match(index, vector):
+    query = vector / np.linalg.norm(vector)
+    return index.search(query, 1)[0][0]
+
+def test_search_finds_what_was_added_while_growing(tmp_path):
+    index = GuildIndex(str(tmp_path / 'guild'), 5000)
+    vectors = random_vectors(3000)
+    for start in range(0, 3000, 700):
+        index.add(np.arange(start, min(start + 700, 3000)), vectors[start:start + 700])
+    assert index.count == 3000 and index.capacity >= 3000
+    for turn_id in (0, 1, 1500, 2999):
+        assert best_match(index, vectors[turn_id]) == turn_id
+
+def test_oldest_entries_get_overwritten(tmp_path):
+    index = GuildIndex(str(tmp_path / 'guild'), 100)
+    vectors = random_vectors(150)
+    index.add(np.arange(150), vectors)
+    assert index.count == 100
+    assert best_match(index, vectors[149]) == 149
+    assert best_match(index, vectors[0]) != 0
+
+def test_index_reloads_from_disk(tmp_path):
+    path = str(tmp_path / 'guild')
+    vectors = random_vectors(2000)
+    GuildIndex(path, 5000).add(np.arange(2000), vectors)
+    index = GuildIndex(path, 5000)
+    assert index.count == 2000
+    assert best_match(index, vectors[1234]) == 1234
+
+def test_old_row_major_bits_are_rebuilt(tmp_path):
+    path = str(tmp_path / 'guild')
+    vectors = random_vectors(500)
+    GuildIndex(path, 5000).add(np.arange(500), vectors)
+    # what an index from before signs.u64 looks like on disk
+    os.remove(os.path.join(path, 'signs.u64'))
+    with open(os.path.join(path, 'bits.u8'), 'wb') as f:
+        f.truncate(1024 * 16)
+    index = GuildIndex(path, 5000)
+    assert not os.path.exists(os.path.join(path, 'bits.u8'))
+    assert best_match(index, vectors[321]) == 321
+
+def test_forgotten_entries_are_never_found(tmp_path):
+    index = GuildIndex(str(tmp_path / 'guild'), 1000)
+    vectors = random_vectors(50)
+    index.add(np.arange(50), vectors)
+    assert index.forget([7]) == 1
+    query = vectors[7] / np.linalg.norm(vectors[7])
+    assert all(turn_id != 7 for turn_id, _ in index.search(query, 50))
@@ -0,0 +1,89 @@
+import config
+import prompt
+
+def history_of(count, words=5, start=100):
+    # newest first, like channel.history()
+    return [
+        {'id': start + i, 'role': 'user' if i % 2 else 'assistant', 'content': ' '.join([f'word{i}'] * words)}
+        for i in reversed(range(count))
+    ]
+
+def total_tokens(context):
+    return sum(map(prompt.message_tokens, context))
+
+def test_everything_fits_in_chronological_order():
+    history = history_of(3)
+    context = prompt.build_context("be evil", history, "hello there", budget=1000)
+    assert context[0] == {'role': 'system', 'content': "be evil"}
+    assert [m['content'] for m in context[1:-1]] == [entry['content'] for entry in reversed(history)]
+    assert context[-1] == {'role': 'user', 'content': "hello there"}
+
+def test_huge_system_prompt_keeps_the_message():
+    persona = "You are evil bot. " + "Be very evil. " * 3000
+    context = prompt.build_context(persona, history_of(10), "what is the capital of france?", budget=512)
+    assert context[-1]['content'] == "what is the capital of france?"
+    assert context[0]['content'].startswith("You are evil bot.")
+    assert total_tokens(context) <= 512
+
+def test_huge_message_keeps_its_end_and_the_system_prompt():
+    content = "blah " * 5000 + "so what do you think?"
+    context = prompt.build_context("be evil", history_of(10), content, budget=512)
+    assert context[0]['content'] == "be evil"
+    assert context[-1]['content'].endswith("so what do you think?")
+    assert total_tokens(context) <= 512
+
+def test_huge_system_prompt_and_message_share_the_budget():
+    persona = "Be very evil. " * 3000
+    content = "blah " * 5000 + "the end"
+    budget = 400
+    context = prompt.build_context(persona, [], content, budget=budget)
+    assert len(context) == 2
+    assert prompt.message_tokens(context[-1]) >= budget // prompt.MIN_MESSAGE_SHARE
+    assert context[-1]['content'].endswith("the end")
+    assert context[0]['content'].startswith("Be very evil.")
+    assert total_tokens(context) <= budget
+
+def test_tiny_budget_never_goes_negative():
+    context = prompt.build_context("be evil " * 100, history_of(5), "hi " * 100, budget=10)
+    assert len(context) == 2
+    assert all(isinstance(m['content'], str) for m in context)
+
+def test_history_is_cut_to_the_budget_newest_first():
+    history = history_of(50, words=20)
+    context = prompt.build_context("be evil", history, "hello", budget=300)
+    kept = context[1:-1]
+    assert 0 < len(kept) < 50
+    # whatever made it in is the newest part of the history
+    assert kept[-1]['content'] == history[0]['content']
+    assert total_tokens(context) <= 300
+
+def test_window_limit_of_one_still_keeps_a_message(monkeypatch):
+    monkeypatch.setattr(config, 'MAX_CONTEXT_MESSAGES', 1)
+    context = prompt.build_context("be evil", history_of(5), "hello", budget=1000, channel_id=1)
+    assert len(context) == 3
+
+def test_anchored_window_keeps_the_same_prefix():
+    history = history_of(6)
+    first = prompt.build_context("be evil", history, "hello", budget=1000, channel_id=1)
+    history = [{'id': 200, 'role': 'user', 'content': "hello"}] + history
+    second = prompt.build_context("be evil", history, "again", budget=1000, channel_id=1)
+    assert second[:len(first) - 1] == first[:-1]
+
+def test_replied_message_is_pinned_before_the_new_one():
+    history = history_of(30)
+    replied = {'id': 1, 'role': 'user', 'content': "an old message"}
+    context = prompt.build_context("be evil", history, "about that", replied, budget=1000, channel_id=1)
+    assert context[-2]['content'] == "an old message"
+    assert context[-1]['content'] == "about that"
+
+def test_memories_go_right_before_the_message():
+    context = prompt.build_context("be evil", history_of(3), "hello", budget=1000, memories=[("hi", "go away")])
+    assert context[-2]['role'] == 'system'
+    assert "Someone said: hi" in context[-2]['content']
+    assert context[-1]['content'] == "hello"
+
+def test_add_turns_reaches_past_the_history():
+    history = [{'id': 50, 'role': 'user', 'content': "newest"}]
+    turns = [(40, "older question", "older answer"), (60, "already there", "skipped")]
+    merged = prompt.add_turns(history, turns)
+    assert [entry['content'] for entry in merged] == ["newest", "older answer", "older question"]
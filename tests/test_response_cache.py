@@ -0,0 +1,29 @@
+import asyncio
+from response_cache import ResponseCache
+
+def test_key_ignores_case_and_whitespace_only():
+    key = ResponseCache.make_key('llama3', "be evil", ('guild', 1), "Hello   THERE")
+    assert key == ResponseCache.make_key('llama3', "be evil", ('guild', 1), "hello there")
+    assert key != ResponseCache.make_key('llama3', "be evil", ('guild', 2), "hello there")
+    assert key != ResponseCache.make_key('llama3', "be evil", ('guild', 1), "hello there", "what?")
+    assert key != ResponseCache.make_key('llama3', "be nice", ('guild', 1), "hello there")
+
+def test_generation_options_change_the_key():
+    key = ResponseCache.make_key('llama3', "be evil", ('guild', 1), "hi", options={'num_predict': 500})
+    assert key != ResponseCache.make_key('llama3', "be evil", ('guild', 1), "hi", options={'num_predict': 50})
+    assert key == ResponseCache.make_key('llama3', "be evil", ('guild', 1), "hi", options={'num_predict': 500})
+    assert ResponseCache.make_key('llama3', "be evil", ('guild', 1), "hi") == \
+        ResponseCache.make_key('llama3', "be evil", ('guild', 1), "hi", options={})
+
+def test_serves_more_often_as_variants_fill_up():
+    async def scenario():
+        cache = ResponseCache(100, 3600, 3, False)
+        key = ResponseCache.make_key('llama3', "be evil", ('guild', 1), "hi")
+        assert await cache.lookup(key, 'guild') is None
+        await cache.store(key, "go away")
+        hits = [await cache.lookup(key, 'guild') for _ in range(300)]
+        assert 0 < sum(hit is not None for hit in hits) < 300
+        await cache.store(key, "leave")
+        await cache.store(key, "shoo")
+        assert all([await cache.lookup(key, 'guild') for _ in range(50)])
+    asyncio.run(scenario())
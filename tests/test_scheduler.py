@@ -0,0 +1,131 @@
+import asyncio
+import pytest
+from scheduler import GenerationScheduler, QueueFullError, PRIORITY_DIRECT, PRIORITY_TRIGGER, PRIORITY_RANDOM
+
+GUILD_A = ('guild', 1)
+GUILD_B = ('guild', 2)
+GUILD_C = ('guild', 3)
+
+def served_order(requests, capacity=1, max_queue=100, max_guild_queue=100):
+    # requests are (key, user_id, priority, label). One slot is held while they all queue up, then
+    # released, and each request gives its slot back straight away. Returns labels in the order served
+    async def scenario():
+        scheduler = GenerationScheduler(capacity, max_queue, max_guild_queue)
+        for _ in range(capacity):
+            await scheduler.acquire(('guild', 0), 0)
+        order = []
+
+        async def request(key, user_id, priority, label):
+            async with scheduler.slot(key, user_id, priority):
+                order.append(label)
+
+        tasks = [asyncio.create_task(request(*args)) for args in requests]
+        await asyncio.sleep(0)
+        for _ in range(capacity):
+            scheduler.release()
+        await asyncio.gather(*tasks)
+        assert scheduler.in_flight == 0 and scheduler.queued == 0
+        return order
+    return asyncio.run(scenario())
+
+def test_free_slot_is_granted_without_queueing():
+    async def scenario():
+        scheduler = GenerationScheduler(2, 10, 10)
+        assert await scheduler.acquire(GUILD_A, 1) == 0.0
+        assert await scheduler.acquire(GUILD_A, 2) == 0.0
+        assert scheduler.in_flight == 2 and scheduler.queued == 0
+    asyncio.run(scenario())
+
+def test_busy_guild_cant_starve_another():
+    spam = [(GUILD_A, user, PRIORITY_DIRECT, f'a{user}') for user in range(5)]
+    order = served_order(spam + [(GUILD_B, 10, PRIORITY_DIRECT, 'b0'), (GUILD_B, 11, PRIORITY_DIRECT, 'b1')])
+    assert order == ['a0', 'b0', 'a1', 'b1', 'a2', 'a3', 'a4']
+
+    # priorities don't reach across guilds, a trigger word waits for one mention, not all of them
+    spam = [(GUILD_A, user, PRIORITY_DIRECT, f'a{user}') for user in range(10)]
+    order = served_order(spam + [(GUILD_B, 10, PRIORITY_TRIGGER, 'b trigger'), (GUILD_C, 11, PRIORITY_RANDOM, 'c random')])
+    assert order[:3] == ['a0', 'b trigger', 'c random']
+
+def test_direct_beats_trigger_beats_random():
+    order = served_order([
+        (GUILD_A, 1, PRIORITY_RANDOM, 'random'),
+        (GUILD_A, 2, PRIORITY_TRIGGER, 'trigger'),
+        (GUILD_A, 3, PRIORITY_DIRECT, 'direct')
+    ])
+    assert order == ['direct', 'trigger', 'random']
+
+def test_users_second_request_goes_behind_others():
+    order = served_order([
+        (GUILD_A, 1, PRIORITY_DIRECT, 'first 1'),
+        (GUILD_A, 1, PRIORITY_DIRECT, 'second 1'),
+        (GUILD_A, 2, PRIORITY_DIRECT, 'first 2')
+    ])
+    assert order == ['first 1', 'first 2', 'second 1']
+
+def test_full_guild_queue_sheds_less_important_request():
+    async def scenario():
+        scheduler = GenerationScheduler(1, 100, 2)
+        await scheduler.acquire(GUILD_A, 0)
+        random_roll = asyncio.create_task(scheduler.acquire(GUILD_A, 1, PRIORITY_RANDOM))
+        trigger = asyncio.create_task(scheduler.acquire(GUILD_A, 2, PRIORITY_TRIGGER))
+        direct = asyncio.create_task(scheduler.acquire(GUILD_A, 3, PRIORITY_DIRECT))
+        await asyncio.sleep(0)
+
+        with pytest.raises(QueueFullError):
+            await random_roll
+        assert scheduler.queued == 2 and scheduler.shed == 1
+
+        # nothing queued is less important than another trigger, so the new one is the one turned away
+        with pytest.raises(QueueFullError):
+            await scheduler.acquire(GUILD_A, 4, PRIORITY_TRIGGER)
+        assert scheduler.queued == 2 and scheduler.shed == 2
+
+        # other guilds still get in
+        other = asyncio.create_task(scheduler.acquire(GUILD_B, 5, PRIORITY_RANDOM))
+        await asyncio.sleep(0)
+        assert scheduler.queued == 3
+
+        # guild A has had a turn once direct is served, so B's random roll goes before A's trigger
+        for task in (direct, other, trigger):
+            scheduler.release()
+            await task
+    asyncio.run(scenario())
+
+def test_full_queue_sheds_least_important_request_anywhere():
+    async def scenario():
+        scheduler = GenerationScheduler(1, 2, 100)
+        await scheduler.acquire(GUILD_A, 0)
+        random_roll = asyncio.create_task(scheduler.acquire(GUILD_A, 1, PRIORITY_RANDOM))
+        trigger = asyncio.create_task(scheduler.acquire(GUILD_B, 2, PRIORITY_TRIGGER))
+        await asyncio.sleep(0)
+        direct = asyncio.create_task(scheduler.acquire(GUILD_C, 3, PRIORITY_DIRECT))
+        await asyncio.sleep(0)
+
+        with pytest.raises(QueueFullError):
+            await random_roll
+        assert scheduler.queued == 2
+        assert scheduler.stats()['active_queues'] == 2
+
+        # queues take turns in the order they showed up, priority doesn't jump between guilds
+        scheduler.release()
+        await trigger
+        scheduler.release()
+        await direct
+    asyncio.run(scenario())
+
+def test_cancelled_request_leaves_the_queue():
+    async def scenario():
+        scheduler = GenerationScheduler(1, 100, 100)
+        await scheduler.acquire(GUILD_A, 0)
+        waiting = asyncio.create_task(scheduler.acquire(GUILD_A, 1))
+        await asyncio.sleep(0)
+        assert scheduler.queued == 1
+
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert scheduler.queued == 0 and scheduler.stats()['active_queues'] == 0
+
+        scheduler.release()
+        assert scheduler.in_flight == 0
+    asyncio.run(scenario())
@@ -0,0 +1,9 @@
+import utils
+
+def test_keep_alive_numbers_go_to_ollama_as_numbers():
+    assert utils.parse_keep_alive("300") == 300
+    assert utils.parse_keep_alive("-1") == -1
+    assert utils.parse_keep_alive("1.5") == 1.5
+    assert utils.parse_keep_alive("-1.5") == -1.5
+    assert utils.parse_keep_alive("1.5m") == "1.5m"
+    assert utils.parse_keep_alive("10m") == "10m"
@@ -0,0 +1,67 @@
+import logging
+import threading
+import config
+
+logger = logging.getLogger('evil_bot')
+
+# Works out how long a generation should be allowed to run instead of always waiting RESPONSE_TIMEOUT.
+# Keeps a moving average of time to first token and tokens per second for each model, and gives
+# generations less slack when the queue is backed up so a runaway reply can't hold a slot forever.
+
+class _ModelStats:
+    __slots__ = ('first_token', 'tokens_per_second', 'samples')
+
+    def __init__(self):
+        self.first_token = None
+        self.tokens_per_second = None
+        self.samples = 0
+
+def _ema(old, new, alpha):
+    return new if old is None else old + alpha * (new - old)
+
+class AdaptiveTimeout:
+    def __init__(self, minimum, maximum, expected_tokens, slack, min_samples=5, alpha=0.2):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.expected_tokens = expected_tokens
+        self.slack = slack
+        self.min_samples = min_samples
+        self.alpha = alpha
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def observe(self, model_name, first_token=None, tokens=None, seconds=None):
+        with self._lock:
+            stats = self._models.setdefault(model_name, _ModelStats())
+            if first_token is not None:
+                stats.first_token = _ema(stats.first_token, first_token, self.alpha)
+            if tokens and seconds:
+                stats.tokens_per_second = _ema(stats.tokens_per_second, tokens / seconds, self.alpha)
+                stats.samples += 1
+
+    def timeout(self, model_name, num_predict=None, queued=0, capacity=1):
+        with self._lock:
+            stats = self._models.get(model_name)
+            if stats is None or stats.samples < self.min_samples or not stats.tokens_per_second:
+                # don't know this model yet (or it's still loading), give it the full time
+                return self.maximum
+            expected = (stats.first_token or 0) + (num_predict or self.expected_tokens) / stats.tokens_per_second
+
+        # with a full queue the extra slack shrinks towards none at all
+        pressure = queued / max(capacity, 1)
+        slack = 1 + (self.slack - 1) / (1 + pressure)
+        return min(max(expected * slack, self.minimum), self.maximum)
+
+    def stats(self):
+        with self._lock:
+            return {
+                model: {'first_token': s.first_token, 'tokens_per_second': s.tokens_per_second, 'samples': s.samples}
+                for model, s in self._models.items()
+            }
+
+adaptive_timeout = AdaptiveTimeout(
+    config.RESPONSE_TIMEOUT_MIN,
+    config.RESPONSE_TIMEOUT,
+    config.TIMEOUT_EXPECTED_TOKENS,
+    config.TIMEOUT_SLACK
+)
@@ -0,0 +1,15 @@
+import re
+import logging
+
+logger = logging.getLogger('evil_bot')
+
+def compile_triggers(words, word_boundary=False):
+    # one big alternation instead of checking every word on its own, longest first so
+    # "evil bot" wins over "evil" when both are there
+    words = sorted({word.lower() for word in words if word}, key=len, reverse=True)
+    if not words:
+        return None
+    pattern = '|'.join(re.escape(word) for word in words)
+    if word_boundary:
+        pattern = rf'(?<!\w)(?:{pattern})(?!\w)'
+    return re.compile(pattern)
@@ -1,20 +1,127 @@
 import asyncio
-import ollama
-import functools
-import random
+import contextlib
+import time
+from datetime import datetime
 import discord
-from concurrent.futures import ThreadPoolExecutor
-import database
+import metrics
 import config
+import backends
+import prompt
+from response_cache import response_cache
 import logging
+from timeouts import adaptive_timeout
+from scheduler import scheduler, QueueFullError, REASON_PRIORITIES, PRIORITY_DIRECT
 
 logger = logging.getLogger('evil_bot')
 
-# create a thread pool for ollama, i just chose 2 threads cause I don't really need more
-thread_pool = ThreadPoolExecutor(max_workers=2)
+def generation_slot(message, reason=None):
+    priority = REASON_PRIORITIES.get(reason, PRIORITY_DIRECT)
+    return scheduler.slot(scheduler.queue_key(message), message.author.id, priority)
+
+# generations currently running, keyed by fingerprint, so a pile on of the same question shares one
+_inflight = {}
+# newest trigger seen per channel while debouncing
+_latest_trigger = {}
+
+def coalesce_key(model_name, system_prompt, channel_id, content):
+    # the history differs between pile on messages (it has the earlier ones in it), so this only
+    # looks at what's being asked, where and by which persona
+    return response_cache.make_key(model_name, system_prompt, channel_id, content)
+
+async def generate_once(key, generate):
+    # single flight: the first caller runs generate(), anyone asking the same thing meanwhile waits
+    # for its result. Returns (result, True) for the caller that generated it
+    while key in _inflight:
+        future = _inflight[key]
+        logger.debug("Joining in flight generation %s", key[:12])
+        try:
+            result = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # the generation we joined got cancelled (its message was deleted or superseded), that's
+            # not a reason to drop this one too, so go again. If we were cancelled ourselves the future is fine
+            if future.cancelled():
+                continue
+            raise
+        metrics.generations_coalesced.inc()
+        return result, False
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        result = await generate()
+    except BaseException as e:
+        if isinstance(e, asyncio.CancelledError):
+            future.cancel()
+        else:
+            future.set_exception(e)
+            # there might be nobody waiting on it, so mark it retrieved to keep asyncio quiet
+            future.exception()
+        raise
+    else:
+        future.set_result(result)
+        return result, True
+    finally:
+        _inflight.pop(key, None)
+
+def in_active_hours(hours, now=None):
+    # hours is "start-end" in local time, end is exclusive and it can wrap past midnight
+    if not hours:
+        return True
+    try:
+        start, end = (int(part) % 24 for part in hours.split('-'))
+    except ValueError:
+        logger.warning("Invalid KEEP_WARM_HOURS %r, treating it as always", hours)
+        return True
+    hour = (now or datetime.now()).hour
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+# generations that are running, so they can be cancelled when their message goes away or the user moves on
+_generations = {}
+# latest message being answered for each (channel, user)
+_conversations = {}
+
+@contextlib.asynccontextmanager
+async def track_generation(message):
+    key = (message.channel.id, message.author.id)
+    previous = _conversations.get(key)
+    if previous is not None and previous != message.id:
+        # they've said something newer, nobody wants the answer to the old message anymore
+        cancel_generation(previous, 'superseded')
+    _conversations[key] = message.id
+    _generations[message.id] = asyncio.current_task()
+    try:
+        yield
+    finally:
+        _generations.pop(message.id, None)
+        if _conversations.get(key) == message.id:
+            del _conversations[key]
+
+def cancel_generation(message_id, why):
+    task = _generations.pop(message_id, None)
+    if task is None or task.done():
+        return False
+    logger.info("Cancelling response to message %s (%s)", message_id, why)
+    metrics.generations_cancelled.inc(why)
+    task.cancel()
+    return True
+
+def generation_timeout(model_name, options=None):
+    return adaptive_timeout.timeout(model_name, (options or {}).get('num_predict'), scheduler.queued, scheduler.capacity)
+
+async def debounce(message, delay):
+    # waits out a burst of triggers in a channel, only the last one in the burst gets to reply
+    channel_id = message.channel.id
+    _latest_trigger[channel_id] = message.id
+    await asyncio.sleep(delay)
+    if _latest_trigger.get(channel_id) != message.id:
+        return False
+    del _latest_trigger[channel_id]
+    return True
 
 def create_embed(title, description=None, fields=None, error=False):
-    logger.debug(f"Creating embed - Title: {title}, Error: {error}")
+    logger.debug("Creating embed - Title: %s, Error: %s", title, error)
     emoji = "🌑" if error else "😈"
     em = discord.Embed(
         title=f"{title} {emoji}",
@@ -32,7 +139,7 @@ def create_embed(title, description=None, fields=None, error=False):
     return em
 
 def error_embed(title, description=None, fields=None):
-    logger.debug(f"Creating error embed - Title: {title}")
+    logger.debug("Creating error embed - Title: %s", title)
     return create_embed(title, description, fields, error=True)
 
 def no_permission_embed():
@@ -43,7 +150,7 @@ def no_permission_embed():
     )
 
 def create_help_embed(command_name, description, examples=None, fields=None):
-    logger.debug(f"Creating help embed for command: {command_name}")
+    logger.debug("Creating help embed for command: %s", command_name)
     em = create_embed(f"Help: {command_name}", description)
     
     if examples:
@@ -56,51 +163,21 @@ def create_help_embed(command_name, description, examples=None, fields=None):
             
     return em
 
-# This function is just a bool that determines if the bot should respond or fuck off
-def should_respond(message):
-    if message.author.bot:
-        logger.debug("Skipping bot message")
-        return False
-        
-    # The bot always responds to dms
-    if isinstance(message.channel, discord.DMChannel):
-        logger.debug("Message is in DM, should respond")
-        return True
-        
-    # get the server settings
-    settings = database.get_server_settings(message.guild.id)
-    if not settings:
-        logger.warning(f"No settings found for server {message.guild.id}")
-        return False
-        
-    content_lower = message.content.lower()
-    
-    # if any trigger words are in the message, then respond
-    triggered = any([
-        message.mentions and any(user.bot for user in message.mentions),
-        any(word in content_lower for word in settings['trigger_words']),
-        message.reference and message.reference.resolved and 
-        message.reference.resolved.author.bot
-    ])
-
-    if triggered:
-        logger.debug("Message triggered response")
-        return True
-        
-    # Check and roll for random responses
-    if settings['random_responses_enabled']:
-        chance = random.randint(1, 100) <= settings['random_response_chance']
-        if chance:
-            logger.debug("Random response triggered")
-        return chance
-        
-    return False
+def find_split_index(content):
+    # where to cut a message that's too long: last full stop, otherwise last space, otherwise just hard cut it
+    split_index = content[:config.MAX_MESSAGE_LENGTH].rfind('.')
+    if split_index == -1:
+        split_index = content[:config.MAX_MESSAGE_LENGTH].rfind(' ')
+        if split_index == -1:
+            split_index = config.MAX_MESSAGE_LENGTH - 1
+    return split_index
 
 async def split_and_send_message(message, content):
-    logger.debug(f"Splitting message of length {len(content)}")
+    logger.debug("Splitting message of length %s", len(content))
     # This function splits really long messages because discords char limits suck
     if len(content) <= config.MAX_MESSAGE_LENGTH:
-        await message.reply(content)
+        with metrics.discord_send_seconds.time('send'):
+            await message.reply(content)
         return
 
     chunks = []
@@ -109,40 +186,168 @@ async def split_and_send_message(message, content):
             chunks.append(content)
             break
 
-        split_index = content[:config.MAX_MESSAGE_LENGTH].rfind('.')
-        if split_index == -1:
-            split_index = content[:config.MAX_MESSAGE_LENGTH].rfind(' ')
-            if split_index == -1:
-                split_index = config.MAX_MESSAGE_LENGTH - 1
-
+        split_index = find_split_index(content)
         chunks.append(content[:split_index + 1])
         content = content[split_index + 1:].strip()
 
-    logger.debug(f"Split into {len(chunks)} chunks")
+    logger.debug("Split into %s chunks", len(chunks))
     first = True
     for chunk in chunks:
-        if first:
-            await message.reply(chunk)
-            first = False
+        with metrics.discord_send_seconds.time('send'):
+            if first:
+                await message.reply(chunk)
+                first = False
+            else:
+                await message.channel.send(chunk)
+
+class StreamingReply:
+    # Shows a response while it's still being generated. The first reply goes out as soon as there's
+    # text and then gets edited every STREAM_EDIT_INTERVAL seconds so we don't hit discords rate limits.
+    # Anything past MAX_MESSAGE_LENGTH rolls over into a new message using the same split rules as above.
+    def __init__(self, message):
+        self.message = message
+        self.sent = None
+        self.sent_text = ''
+        self.text = ''
+        self.last_edit = 0.0
+        self.message_count = 0
+
+    async def feed(self, text):
+        self.text += text
+        while len(self.text) > config.MAX_MESSAGE_LENGTH:
+            split_index = find_split_index(self.text)
+            head, self.text = self.text[:split_index + 1], self.text[split_index + 1:].lstrip()
+            await self._show(head)
+            # start a fresh message for whatever is left over
+            self.sent = None
+            self.sent_text = ''
+        if asyncio.get_running_loop().time() - self.last_edit >= config.STREAM_EDIT_INTERVAL:
+            await self._show(self.text)
+
+    async def finish(self):
+        await self._show(self.text)
+        logger.debug("Streamed response over %s messages", self.message_count)
+
+    async def _show(self, text):
+        if not text.strip() or text == self.sent_text:
+            return
+        if self.sent is None:
+            with metrics.discord_send_seconds.time('send'):
+                if self.message_count == 0:
+                    self.sent = await self.message.reply(text)
+                else:
+                    self.sent = await self.message.channel.send(text)
+            self.message_count += 1
         else:
-            await message.channel.send(chunk)
+            with metrics.discord_send_seconds.time('edit'):
+                await self.sent.edit(content=text)
+        self.sent_text = text
+        self.last_edit = asyncio.get_running_loop().time()
+
+def parse_keep_alive(value):
+    # ollama takes either a number of seconds or a duration string like "30m". A string without a unit
+    # gets rejected ("1.5" included), so anything that's just a number goes over as one
+    try:
+        seconds = float(value)
+    except ValueError:
+        return value
+    return int(seconds) if seconds.is_integer() else seconds
+
+def generation_settings(settings):
+    # turns a guild's overrides into what ollama.chat wants, anything unset falls back to the globals
+    settings = settings or {}
+    model_name = settings.get('model_name') or config.MODEL_NAME
+    options = {key: settings[key] for key in ('num_predict', 'temperature', 'num_ctx') if settings.get(key) is not None}
+    keep_alive = parse_keep_alive(settings['keep_alive']) if settings.get('keep_alive') else config.OLLAMA_KEEP_ALIVE
+    return model_name, options, keep_alive
+
+def record_prompt_eval(model_name, context, response):
+    # ollama only counts the prompt tokens it actually had to evaluate, anything it reused from its
+    # cache is left out. Comparing that to the whole prompt shows how often the cache hits
+    if not response.get('prompt_eval_count'):
+        return
+    metrics.prompt_tokens.inc(model_name, amount=sum(prompt.message_tokens(m) for m in context))
+    metrics.prompt_eval_tokens.inc(model_name, amount=response['prompt_eval_count'])
+    metrics.prompt_eval_seconds.observe((response.get('prompt_eval_duration') or 0) / 1e9, model_name)
+
+async def stream_ollama_chunks(context, model_name, affinity=None, options=None, keep_alive=None):
+    # which ollama host this runs on is up to the backend pool, the scheduler only decides when
+    if keep_alive is None:
+        keep_alive = config.OLLAMA_KEEP_ALIVE
+    async for chunk in backends.pool.chat_stream(model_name, context, affinity=affinity, options=options, keep_alive=keep_alive):
+        if chunk.get('done'):
+            record_prompt_eval(model_name, context, chunk)
+            adaptive_timeout.observe(model_name, tokens=chunk.get('eval_count'), seconds=(chunk.get('eval_duration') or 0) / 1e9)
+        yield chunk['message']['content']
+
+async def stream_ollama_response(message, context, model_name, reason=None, options=None, keep_alive=None):
+    logger.debug("Streaming Ollama response using model: %s", model_name)
+    reply = StreamingReply(message)
+    content = []
+
+    async def consume():
+        start = time.perf_counter()
+        async for text in stream_ollama_chunks(context, model_name, message.channel.id, options, keep_alive):
+            if not content:
+                logger.debug("Got first token from Ollama")
+                metrics.first_token_seconds.observe(time.perf_counter() - start, model_name)
+                adaptive_timeout.observe(model_name, first_token=time.perf_counter() - start)
+            content.append(text)
+            await reply.feed(text)
+        metrics.generation_seconds.observe(time.perf_counter() - start, model_name)
+        await reply.finish()
 
-async def get_ollama_response(context, model_name):
-    logger.debug(f"Getting Ollama response using model: {model_name}")
-    loop = asyncio.get_event_loop()
     try:
-        response = await asyncio.wait_for(
-            loop.run_in_executor(
-                thread_pool,
-                functools.partial(ollama.chat, model=model_name, messages=context)
-            ),
-            timeout=config.RESPONSE_TIMEOUT
+        # waiting for a free slot doesn't count towards the timeout, only the generation itself does
+        # cancelling consume() closes the http stream, which is what makes ollama stop generating
+        async with generation_slot(message, reason):
+            timeout = generation_timeout(model_name, options)
+            logger.debug("Generation timeout is %.1fs", timeout)
+            await asyncio.wait_for(consume(), timeout=timeout)
+        logger.debug("Successfully streamed Ollama response")
+        return ''.join(content)
+    except asyncio.TimeoutError:
+        logger.error("Ollama response timed out")
+        metrics.errors.inc('timeout')
+        # at least show whatever made it out before the cutoff
+        if content:
+            await reply.finish()
+        raise
+    except QueueFullError:
+        raise
+    except Exception as e:
+        logger.error("Error streaming Ollama response: %s", e, exc_info=True)
+        metrics.errors.inc('ollama')
+        raise
+
+async def get_ollama_response(message, context, model_name, reason=None, options=None, keep_alive=None):
+    logger.debug("Getting Ollama response using model: %s", model_name)
+    if keep_alive is None:
+        keep_alive = config.OLLAMA_KEEP_ALIVE
+    try:
+        async with generation_slot(message, reason):
+            with metrics.generation_seconds.time(model_name):
+                response = await asyncio.wait_for(
+                    backends.pool.chat(model_name, context, affinity=message.channel.id, options=options, keep_alive=keep_alive),
+                    timeout=generation_timeout(model_name, options)
+                )
+        record_prompt_eval(model_name, context, response)
+        # without streaming, loading plus prompt eval is as close as we get to time to first token
+        adaptive_timeout.observe(
+            model_name,
+            first_token=((response.get('load_duration') or 0) + (response.get('prompt_eval_duration') or 0)) / 1e9,
+            tokens=response.get('eval_count'),
+            seconds=(response.get('eval_duration') or 0) / 1e9
         )
         logger.debug("Successfully got Ollama response")
         return response
     except asyncio.TimeoutError:
         logger.error("Ollama response timed out")
+        metrics.errors.inc('timeout')
+        raise
+    except QueueFullError:
         raise
     except Exception as e:
-        logger.error(f"Error getting Ollama response: {e}", exc_info=True)
+        logger.error("Error getting Ollama response: %s", e, exc_info=True)
+        metrics.errors.inc('ollama')
         raise